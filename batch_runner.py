@@ -0,0 +1,97 @@
+# Runs independent scripts in parallel across several engines
+#
+# Each engine runs one script at a time through a background call, and every
+# script gets its own stdout/stderr capture, status and timing. Every engine
+# is cleared and moved to the folder of the terminal before each script, so
+# the scripts do not see the workspace of the previous ones and relative paths
+# resolve as in the terminal.
+
+import threading
+from io import StringIO
+from collections import deque, namedtuple
+from time import perf_counter
+from engine import start_matlab, MatlabTerminated
+from helper import cd_cmd
+
+# status is 'ok', 'error' (handled by MATLAB) or 'terminated' (engine crashed)
+ScriptResult = namedtuple('ScriptResult', 'path status output errors duration')
+
+def run_captured(eng, script_path: str, on_start = None, setup: str = None) -> ScriptResult:
+    # Runs a script with its output captured, like MatlabInterface.run_script.
+    # on_start receives the future of the background call, e.g. to cancel it.
+    # setup is MATLAB code evaluated before the script
+    stream = StringIO()
+    err_stream = StringIO()
+    start = perf_counter()
+    try:
+        if setup:
+            eng.eval(setup, nargout=0, stdout=stream, stderr=err_stream)
+        future = eng.run(script_path, nargout=0, stdout=stream, stderr=err_stream, background=True)
+        if on_start is not None:
+            on_start(future)
+        future.result()
+        status = 'ok'
+    except MatlabTerminated:
+        status = 'terminated'
+    except Exception as e: # The other exceptions are handled by Matlab
+        status = 'error'
+        if not err_stream.getvalue():
+            err_stream.write(str(e))
+    return ScriptResult(script_path, status, stream.getvalue(), err_stream.getvalue(),
+                        perf_counter() - start)
+
+class BatchRunner:
+    def __init__(self, engines: list, engine_factory = start_matlab, folder: str = None):
+        # engines: one running script per engine. A terminated engine is
+        # replaced with engine_factory. folder: current folder of the terminal
+        self.engines = list(engines)
+        self.engine_factory = engine_factory
+        self.setup = 'clear;'
+        if folder is not None:
+            self.setup = 'clear;\n' + cd_cmd(folder)
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.futures = {}
+
+    def run(self, script_paths: list, callback = None) -> list:
+        # Returns the ScriptResult of every script, in the order of
+        # script_paths. callback is called with each result as soon as it is
+        # available
+        results = [None] * len(script_paths)
+        self.queue = deque(enumerate(script_paths))
+
+        def worker(slot: int):
+            while True:
+                with self.lock:
+                    if not self.queue:
+                        return
+                    idx, path = self.queue.popleft()
+                result = run_captured(self.engines[slot], path,
+                                      lambda future: self.futures.__setitem__(slot, future),
+                                      self.setup)
+                self.futures.pop(slot, None)
+                if result.status == 'terminated':
+                    self.engines[slot] = self.engine_factory()
+                results[idx] = result
+                if callback is not None:
+                    with self.lock:
+                        callback(result)
+
+        threads = [threading.Thread(target=worker, args=(slot,), daemon=True)
+                   for slot in range(min(len(self.engines), len(script_paths)))]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        return results
+
+    def cancel(self):
+        # Drops the scripts not started yet and cancels the running ones
+        with self.lock:
+            self.queue.clear()
+        for future in list(self.futures.values()):
+            future.cancel()
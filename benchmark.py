@@ -0,0 +1,734 @@
+# Benchmarks for the Python side of the interpreter
+#
+# No MATLAB installation is needed: the engine is replaced by a stand-in which
+# answers immediately, so the timings only reflect the interpreter overhead.
+#
+# Usage: python benchmark.py [suite ...]
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+from contextlib import redirect_stdout
+from io import StringIO
+from engine import FakeEngine, fake_engine_factory
+from helper import IndexedFile, MappedIndexedFile, redirect_stdin
+from engine_pool import EnginePool
+from parse_cache import ParseCache
+from query_cache import QueryCache
+from checkpoint import WorkspaceCheckpointer
+from completion import SymbolIndex
+from profiler import ScriptProfiler, ProfiledEngine
+from engine_server import EngineServer, RemoteEngine
+from workspace import whos_expr, fingerprint_expr, WorkspaceTracker
+from matlab_interface import MatlabInterface, MatlabTerminated
+from script_parser import parse_lines
+from script_compiler import compile_body
+
+class QuietInterface(MatlabInterface):
+    def clear(self):
+        pass
+
+def run_lines(script, engine, batch: bool = True, answers: str = ''):
+    # Run a parsed script on engine, returning the wall time in seconds
+    interface = MatlabInterface(engine)
+    interface.batch_statements = batch
+    start = perf_counter()
+    with redirect_stdout(StringIO()), redirect_stdin(StringIO(answers)):
+        interface.run_sequential(script.body)
+    return perf_counter() - start
+
+def gen_script(n_statements: int, depth: int, iterations: int = 2) -> list:
+    # n_statements plain statements, wrapped in depth nested blocks alternating
+    # between for loops and if/else blocks
+    lines = []
+    indent = ''
+    for level in range(depth):
+        if level % 2 == 0:
+            lines.append('{}for k{} = 1:{}'.format(indent, level, iterations))
+        else:
+            lines.append('{}if false'.format(indent))
+            lines.append('{}    x = 0;'.format(indent))
+            lines.append('{}else'.format(indent))
+        indent = indent + '    '
+    for i in range(n_statements):
+        lines.append('{}x{} = {};'.format(indent, i % 16, i))
+    for level in reversed(range(depth)):
+        indent = indent[:-4]
+        lines.append('{}end'.format(indent))
+    return lines
+
+def bench_block_tree(args):
+    print('Block tree executor: Python overhead per executed statement')
+    print('{:>8} {:>6} {:>10} {:>10} {:>12}'.format('lines', 'depth', 'parse ms', 'evals', 'us/eval'))
+    for n_statements in (100, 1000, 5000):
+        for depth in (0, 4, 8):
+            lines = gen_script(n_statements, depth)
+            start = perf_counter()
+            script = parse_lines(lines)
+            parse_time = perf_counter() - start
+
+            # Step through every statement, as for scripts full of breakpoints
+            engine = FakeEngine()
+            run_time = run_lines(script, engine, batch = False) - engine.engine_time()
+            print('{:>8} {:>6} {:>10.2f} {:>10} {:>12.2f}'.format(
+                len(lines), depth, parse_time * 1e3, engine.calls, run_time / engine.calls * 1e6))
+
+def bench_batching(args):
+    print('Statement batching: engine round trips for straight-line code ({} ms per call)'.format(
+        args.latency * 1e3))
+    print('{:>8} {:>8} {:>10} {:>10} {:>10}'.format('lines', 'batch', 'calls', 'total ms', 'ms/line'))
+    for n_statements in (20, 200):
+        # Every 50th line is a breakpoint-free pause, which splits the batches
+        lines = []
+        for i in range(n_statements):
+            lines.append('pause' if i % 50 == 49 else 'x{} = {};'.format(i % 16, i))
+        script = parse_lines(lines)
+        workspaces = []
+        for batch in (False, True):
+            engine = FakeEngine(args.latency)
+            run_time = run_lines(script, engine, batch, '\n' * n_statements)
+            workspaces.append(dict(engine.workspace))
+            print('{:>8} {:>8} {:>10} {:>10.1f} {:>10.3f}'.format(
+                n_statements, 'on' if batch else 'off', engine.calls, run_time * 1e3,
+                run_time / n_statements * 1e3))
+        # Batching must not change the result
+        assert workspaces[0] == workspaces[1] and workspaces[0]
+
+def bench_loop_offload(args):
+    print('Loop offload: per-iteration stepping vs whole-block eval ({} ms per call)'.format(
+        args.latency * 1e3))
+    print('{:>10} {:>8} {:>10} {:>10}'.format('iterations', 'offload', 'calls', 'total ms'))
+    for iterations in (10, 100, 500):
+        lines = ['for k = 1:{}'.format(iterations),
+                 '    for j = 1:2',
+                 '        x = k + j;',
+                 '    end',
+                 '    y = x * 2;',
+                 'end']
+        script = parse_lines(lines)
+        for offload in (False, True):
+            engine = FakeEngine(args.latency)
+            run_time = run_lines(script, engine, offload)
+            print('{:>10} {:>8} {:>10} {:>10.1f}'.format(
+                iterations, 'on' if offload else 'off', engine.calls, run_time * 1e3))
+            workspace = dict(engine.workspace)
+            assert (workspace['x'], workspace['y']) == (iterations + 2, (iterations + 2) * 2)
+
+def bench_overhead(args):
+    # Regression suite: fails (exit status 1) when the Python overhead per
+    # executed statement exceeds --max-overhead microseconds
+    print('Interpreter overhead: calls per executed statement and Python time per call')
+    print('{:>8} {:>6} {:>6} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'lines', 'depth', 'iters', 'batch', 'calls', 'calls/stm', 'us/call', 'us/stm'))
+    failed = False
+    for n_statements in (100, 1000):
+        for depth in (0, 2, 4):
+            for iterations in (2, 10):
+                if depth == 0 and iterations != 2:
+                    continue
+                lines = gen_script(n_statements, depth, iterations)
+                script = parse_lines(lines)
+                # Statements run iterations times per enclosing for loop
+                executed = n_statements * iterations ** ((depth + 1) // 2)
+                for batch in (False, True):
+                    engine = FakeEngine()
+                    run_time = run_lines(script, engine, batch)
+                    overhead = (run_time - engine.engine_time()) * 1e6
+                    per_statement = overhead / executed
+                    failed = failed or 0 < args.max_overhead < per_statement
+                    print('{:>8} {:>6} {:>6} {:>8} {:>10} {:>10.3f} {:>10.2f} {:>10.2f}'.format(
+                        len(lines), depth, iterations, 'on' if batch else 'off', engine.calls,
+                        engine.calls / executed, overhead / engine.calls, per_statement))
+    if failed:
+        print('Python overhead per statement exceeds {} us'.format(args.max_overhead))
+        sys.exit(1)
+
+def bench_startup(args):
+    print('Asynchronous startup: prompt availability and time to first command')
+    print('{:>10} {:>10} {:>12} {:>12} {:>14}'.format(
+        'launch s', 'prompt ms', 'ready s', 'ready lag ms', 'first result s'))
+    for launch in (0.2, 1.0):
+        with redirect_stdout(StringIO()):
+            start = perf_counter()
+            interface = QuietInterface(engine_factory = fake_engine_factory(launch))
+            prompt = perf_counter() - start
+            # Typed at the prompt before the engine is ready, so it is queued
+            interface.submit_command('x = 1')
+            interface.engine_ready.wait()
+        metrics = interface.startup_metrics
+        print('{:>10.1f} {:>10.2f} {:>12.3f} {:>12.2f} {:>14.3f}'.format(
+            launch, prompt * 1e3, metrics['engine_ready'],
+            (metrics['engine_ready'] - launch) * 1e3, metrics['first_result']))
+
+def crash(engine, code, nargout):
+    raise MatlabTerminated('MATLAB process terminated')
+
+def bench_recovery(args):
+    print('Crash recovery: time until a new engine is usable')
+    print('{:>10} {:>10} {:>14}'.format('launch s', 'standby', 'recovery ms'))
+    for launch in (0.2, 1.0):
+        for standby in (0, 1):
+            factory = fake_engine_factory(launch, responses = {'crash': crash})
+            pool = EnginePool(factory, standby) if standby else None
+            interface = QuietInterface(factory(), factory, pool)
+            if pool is not None:
+                # Give the standby engine time to warm up, as during a session
+                pool.standby[0].result()
+            with redirect_stdout(StringIO()):
+                interface.run_line('crash')
+            print('{:>10.1f} {:>10} {:>14.2f}'.format(
+                launch, standby, interface.recovery_times[-1] * 1e3))
+            if pool is not None:
+                pool.close()
+
+def bench_parallel(args):
+    print('Parallel script runner: throughput against the number of engines (0.1 s per script)')
+    print('{:>8} {:>8} {:>10} {:>12} {:>10}'.format('scripts', 'engines', 'wall s', 'scripts/s', 'speedup'))
+    n_scripts = 16
+    paths = ['sweep_{}.m'.format(i) for i in range(n_scripts)]
+    baseline = None
+    for jobs in (1, 2, 4, 8):
+        factory = fake_engine_factory(latency = 0.1)
+        interface = QuietInterface(factory(), factory)
+        with redirect_stdout(StringIO()):
+            interface.get_batch_engines(jobs)
+        start = perf_counter()
+        results = interface.run_scripts_parallel(paths, jobs)
+        wall_time = perf_counter() - start
+        assert all(result.status == 'ok' for result in results)
+        baseline = baseline or wall_time
+        print('{:>8} {:>8} {:>10.2f} {:>12.1f} {:>10.2f}'.format(
+            n_scripts, jobs, wall_time, n_scripts / wall_time, baseline / wall_time))
+
+class FirstWrite(StringIO):
+    # Records when the first output reaches the terminal and how much is kept
+    def __init__(self):
+        super().__init__()
+        self.first_write = None
+
+    def write(self, text):
+        if self.first_write is None and text.strip() and not text.startswith('File:'):
+            self.first_write = perf_counter()
+        return len(text)
+
+def chatty_script(n_lines: int, delay: float):
+    def script(engine, stdout, stderr):
+        for i in range(n_lines):
+            stdout.write('iteration {:>8}: residual {:.6e}\n'.format(i, 1.0 / (i + 1)))
+            if delay:
+                sleep(delay)
+    return script
+
+def bench_streaming(args):
+    # FakeEngine only: the diary file written by the fake stands for the one of
+    # MATLAB, whose flushing delay is not modelled
+    print('Streaming output (fake engine only): time to first output and output kept in memory')
+    print('{:>8} {:>10} {:>10} {:>14} {:>14}'.format('lines', 'mode', 'total s', 'first out ms', 'peak KB'))
+    for n_lines in (1000, 20000):
+        script = chatty_script(n_lines, 1.0 / n_lines)
+        for streaming in (False, True):
+            captured = []
+            def capture(engine, stdout, stderr):
+                captured.append(stdout)
+                script(engine, stdout, stderr)
+            engine = FakeEngine(scripts = {'sim.m': capture})
+            interface = QuietInterface(engine, streaming = streaming)
+            out = FirstWrite()
+            start = perf_counter()
+            with redirect_stdout(out):
+                interface.run_script('sim.m')
+            total = perf_counter() - start
+            # The stdout given to the engine, behind the fake diary
+            stream = captured[0].stream
+            peak = stream.peak_bytes if streaming else len(stream.getvalue())
+            print('{:>8} {:>10} {:>10.2f} {:>14.2f} {:>14.1f}'.format(
+                n_lines, 'stream' if streaming else 'buffer', total,
+                (out.first_write - start) * 1e3, peak / 1024))
+
+def fake_whos(engine, code, nargout):
+    return '\n'.join('{}\tdouble\t1 1\t8'.format(name) for name in dict.keys(engine.workspace))
+
+def fake_who(engine, code, nargout):
+    return list(dict.keys(engine.workspace))
+
+def fake_fingerprints(engine, code, nargout):
+    return '\n'.join('{}\tdouble\t1 1\t8\t{}'.format(name, hash(repr(value)))
+                     for name, value in dict.items(engine.workspace))
+
+def bench_watch(args):
+    print('watch: per-variable display vs bulk snapshot ({} ms per call)'.format(args.latency * 1e3))
+    print('{:>10} {:>10} {:>10} {:>10}'.format('variables', 'mode', 'calls', 'total ms'))
+    for n_vars in (30, 300):
+        for bulk in (False, True):
+            engine = FakeEngine(args.latency, responses = {whos_expr: fake_whos, 'who': fake_who})
+            for i in range(n_vars):
+                dict.__setitem__(engine.workspace, 'v{}'.format(i), float(i))
+            interface = QuietInterface(engine)
+            start = perf_counter()
+            with redirect_stdout(StringIO()):
+                if bulk:
+                    interface.watch([])
+                else:
+                    # What watch used to do: who, then one display per variable
+                    for name in interface.run_line('who', output = False):
+                        interface.run_line(name)
+            run_time = perf_counter() - start
+            print('{:>10} {:>10} {:>10} {:>10.1f}'.format(
+                n_vars, 'bulk' if bulk else 'per-var', engine.calls, run_time * 1e3))
+
+def bench_watch_diff(args):
+    print('step + watch: full workspace display vs changed variables only ({} ms per call)'.format(
+        args.latency * 1e3))
+    print('{:>10} {:>10} {:>12} {:>12}'.format('variables', 'mode', 'calls/step', 'ms/step'))
+    n_steps = 3
+    for n_vars in (30, 300, 1000):
+        for diff in (False, True):
+            engine = FakeEngine(args.latency, responses = {
+                WorkspaceTracker().expr: fake_fingerprints, 'who': fake_who})
+            for i in range(n_vars):
+                dict.__setitem__(engine.workspace, 'v{}'.format(i), float(i))
+            interface = QuietInterface(engine)
+            with redirect_stdout(StringIO()):
+                interface.watch_changed()
+                engine.reset_log()
+                start = perf_counter()
+                for step in range(n_steps):
+                    # Every step modifies one variable
+                    interface.run_line('v{} = {};'.format(step, step + 0.5))
+                    if diff:
+                        interface.watch_changed()
+                    else:
+                        for name in interface.run_line('who', output = False):
+                            interface.run_line(name)
+                run_time = perf_counter() - start
+            print('{:>10} {:>10} {:>12.1f} {:>12.1f}'.format(
+                n_vars, 'changed' if diff else 'full', engine.calls / n_steps, run_time / n_steps * 1e3))
+
+class FakeMatFiles:
+    # Engine handler standing in for MATLAB's save and load: the values of the
+    # fake workspace (bytes) are written to and read from the checkpoint files
+    save_matcher = re.compile(r"^save\('(.*)', '(\w+)', '[^']*'\);$")
+    load_matcher = re.compile(r"^try, load\('(.*)'\); catch, end$")
+
+    def __init__(self):
+        self.written = 0
+
+    def __call__(self, engine, code, nargout):
+        if code == fingerprint_expr():
+            return '\n'.join('{}\tuint8\t1 {}\t{}\t{}'.format(name, len(value), len(value), hash(value))
+                             for name, value in dict.items(engine.workspace))
+        handled = False
+        for line in code.split('\n'):
+            match = self.save_matcher.match(line)
+            if match:
+                value = dict.__getitem__(engine.workspace, match.group(2))
+                with open(match.group(1), 'wb') as f:
+                    f.write(value)
+                self.written = self.written + len(value)
+                handled = True
+            match = self.load_matcher.match(line)
+            if match:
+                with open(match.group(1), 'rb') as f:
+                    name = os.path.splitext(os.path.basename(match.group(1)))[0]
+                    dict.__setitem__(engine.workspace, name, f.read())
+                handled = True
+        if not handled:
+            return engine.evaluate(code, nargout, None, None)
+
+def bench_checkpoint(args):
+    # Every step modifies one variable of the workspace, then checkpoints it
+    print('workspace checkpoint after each step: full save vs changed variables only')
+    print('{:>10} {:>10} {:>10} {:>14} {:>10} {:>12}'.format(
+        'variables', 'MB each', 'mode', 'MB/checkpoint', 'ms/step', 'restore ms'))
+    n_steps = 5
+    for n_vars, size in ((20, 2 ** 20), (200, 2 ** 17)):
+        for incremental in (False, True):
+            files = FakeMatFiles()
+            engine = FakeEngine(handler=files)
+            for i in range(n_vars):
+                dict.__setitem__(engine.workspace, 'v{}'.format(i), bytes([i % 256]) * size)
+            with tempfile.TemporaryDirectory() as directory:
+                checkpointer = WorkspaceCheckpointer(directory)
+                checkpointer.checkpoint(engine)
+                files.written = 0
+                start = perf_counter()
+                for step in range(n_steps):
+                    dict.__setitem__(engine.workspace, 'v{}'.format(step), bytes([255 - step]) * size)
+                    if not incremental:
+                        # Everything is saved again
+                        checkpointer.saved = {}
+                    checkpointer.checkpoint(engine)
+                run_time = perf_counter() - start
+                checkpointer.release()
+                # A crash: the workspace comes back in a new engine
+                restored = FakeEngine(handler=files)
+                restore_start = perf_counter()
+                WorkspaceCheckpointer(directory).restore(restored)
+                restore_time = perf_counter() - restore_start
+                assert dict(restored.workspace) == dict(engine.workspace)
+            print('{:>10} {:>10.3f} {:>10} {:>14.2f} {:>10.2f} {:>12.1f}'.format(
+                n_vars, size / 2 ** 20, 'changed' if incremental else 'full',
+                files.written / n_steps / 2 ** 20, run_time / n_steps * 1e3, restore_time * 1e3))
+
+def bench_completion(args):
+    # A path of n_folders folders of 100 functions each, scanned once, then
+    # reloaded from the persisted index. Completion only reads the index
+    print('tab completion: symbol index over the MATLAB path')
+    print('{:>10} {:>12} {:>12} {:>14} {:>12} {:>12}'.format(
+        'functions', 'build ms', 'reload ms', 'workspace ms', 'complete us', 'max us'))
+    for n_folders in (100, 500):
+        with tempfile.TemporaryDirectory() as root:
+            folders = []
+            for i in range(n_folders):
+                folder = os.path.join(root, 'toolbox{}'.format(i))
+                os.mkdir(folder)
+                for j in range(100):
+                    open(os.path.join(folder, 'fn{}_{}.m'.format(j, i)), 'w').close()
+                folders.append(folder)
+            engine = FakeEngine(responses={'path': os.pathsep.join(folders), 'pwd': root,
+                                           'who': ['v{}'.format(i) for i in range(300)]})
+            query = lambda expr: engine.eval(expr, nargout=1)
+            index_path = os.path.join(root, 'symbols.json')
+            times = []
+            for _ in range(2):
+                # The second index reloads the folder listings saved by the first
+                index = SymbolIndex(query, index_path)
+                start = perf_counter()
+                index.refresh()
+                times.append(perf_counter() - start)
+            start = perf_counter()
+            index.refresh(path=False, cwd=False)
+            workspace_time = perf_counter() - start
+            latencies = []
+            for prefix in ('f', 'fn1', 'fn12_3', 'v', 'v1', 'x'):
+                start = perf_counter()
+                index.complete(prefix)
+                latencies.append(perf_counter() - start)
+            assert len(index.complete('fn7_')) == n_folders
+        print('{:>10} {:>12.1f} {:>12.1f} {:>14.2f} {:>12.1f} {:>12.1f}'.format(
+            n_folders * 100, times[0] * 1e3, times[1] * 1e3, workspace_time * 1e3,
+            sum(latencies) / len(latencies) * 1e6, max(latencies) * 1e6))
+
+def bench_parse_cache(args):
+    print('Persistent parse cache: cold parse vs warm load')
+    print('{:>8} {:>12} {:>12} {:>10}'.format('lines', 'cold ms', 'warm ms', 'speedup'))
+    with tempfile.TemporaryDirectory() as directory:
+        for n_statements in (2000, 5000, 20000):
+            path = os.path.join(directory, 'script_{}.m'.format(n_statements))
+            with open(path, 'w') as f:
+                f.write('\n'.join(gen_script(n_statements, 6)))
+            cache = ParseCache(os.path.join(directory, 'cache'))
+            start = perf_counter()
+            cache.load(path)
+            cold = perf_counter() - start
+            # A new session, with only the cache directory in common
+            cache = ParseCache(cache.directory)
+            start = perf_counter()
+            cache.load(path)
+            warm = perf_counter() - start
+            assert cache.hits == 1
+            print('{:>8} {:>12.2f} {:>12.2f} {:>10.1f}'.format(
+                n_statements, cold * 1e3, warm * 1e3, cold / warm))
+
+def bench_indexed_file(args):
+    print('Indexed file: re-reading a loop body on every iteration')
+    print('{:>8} {:>10} {:>12} {:>12} {:>10}'.format('body', 'iters', 'IndexedFile', 'Mapped', 'speedup'))
+    with tempfile.TemporaryDirectory() as directory:
+        for body, iterations in ((10, 10000), (100, 1000), (1000, 100)):
+            path = os.path.join(directory, 'loop.m')
+            with open(path, 'w') as f:
+                f.write('\n'.join(gen_script(body, 1, iterations)))
+            timings = []
+            for cls in (IndexedFile, MappedIndexedFile):
+                with cls(path) as f:
+                    start = perf_counter()
+                    f.readline()
+                    pos_begin = f.tell()
+                    for _ in range(iterations):
+                        f.seek(pos_begin)
+                        for _ in range(body):
+                            f.readline().strip()
+                    timings.append(perf_counter() - start)
+            print('{:>8} {:>10} {:>10.1f}ms {:>10.1f}ms {:>10.1f}'.format(
+                body, iterations, timings[0] * 1e3, timings[1] * 1e3, timings[0] / timings[1]))
+
+def bench_dispatch(args):
+    # Nesting far beyond the Python recursion limit, stepped statement by statement
+    print('Flat instruction dispatch: compile time and Python time per instruction')
+    print('{:>8} {:>8} {:>12} {:>12} {:>10} {:>12}'.format(
+        'depth', 'lines', 'instructions', 'compile ms', 'evals', 'us/instr'))
+    for depth in (10, 100, 2000, 10000):
+        lines = gen_script(8, depth, 1)
+        script = parse_lines(lines)
+        start = perf_counter()
+        program = compile_body(script.body, batch = False)
+        compile_time = perf_counter() - start
+
+        engine = FakeEngine()
+        interface = MatlabInterface(engine)
+        start = perf_counter()
+        with redirect_stdout(StringIO()):
+            interface.run_program(program)
+        run_time = perf_counter() - start - engine.engine_time()
+        print('{:>8} {:>8} {:>12} {:>12.2f} {:>10} {:>12.2f}'.format(
+            depth, len(lines), len(program), compile_time * 1e3, engine.calls,
+            run_time / len(program) * 1e6))
+
+def bench_for_range(args):
+    # The fake engine transfers data for free, so the values crossing the
+    # Python boundary are counted to show what the real engine has to convert
+    print('for loop over a range: range pulled into Python vs bound engine-side')
+    print('{:>10} {:>12} {:>10} {:>12} {:>12} {:>10} {:>12}'.format(
+        'elements', 'binding', 'calls', 'to Python', 'to MATLAB', 'total s', 'us/iter'))
+    for n_elements in (10000, 1000000):
+        script = parse_lines(['for k = 1:{}'.format(n_elements), 'end'])
+        for engine_side in (False, True):
+            engine = FakeEngine()
+            interface = QuietInterface(engine)
+            start = perf_counter()
+            with redirect_stdout(StringIO()):
+                if engine_side:
+                    interface.batch_statements = False
+                    interface.run_sequential(script.body)
+                    received = sent = 0
+                else:
+                    # What run_for_block used to do
+                    values = interface.run_line('1:{}'.format(n_elements), output = False)
+                    for value in values[0]:
+                        engine.workspace['k'] = value
+                    received = sent = len(values[0])
+            run_time = perf_counter() - start
+            assert dict.__getitem__(engine.workspace, 'k') == n_elements
+            # Python time per iteration, without the time spent in the engine
+            overhead = (run_time - engine.engine_time()) / n_elements
+            print('{:>10} {:>12} {:>10} {:>12} {:>12} {:>10.2f} {:>12.2f}'.format(
+                n_elements, 'engine' if engine_side else 'python', engine.calls,
+                received, sent, run_time, overhead * 1e6))
+
+def bench_query_cache(args):
+    print('Query cache: engine round trips of a debug session ({} ms per call)'.format(args.latency * 1e3))
+    print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'stops', 'cache', 'calls', 'hits', 'misses', 'total ms'))
+    n_stops = 20
+    # Stepping through a script, looking at the workspace a few times per stop
+    lines = ['x{} = {}; dbg'.format(i, i) for i in range(n_stops)]
+    answers = 'watch\nwatch --changed\nwatch x0\nwatch\nwatch --changed\nstep\n' * n_stops
+    script = parse_lines(lines)
+    outputs = []
+    for cached in (False, True):
+        engine = FakeEngine(args.latency, responses = {
+            whos_expr: fake_whos, WorkspaceTracker().expr: fake_fingerprints})
+        interface = QuietInterface(engine, query_cache = QueryCache(64 if cached else 0))
+        interface.debug_mode = True
+        out = StringIO()
+        start = perf_counter()
+        with redirect_stdout(out), redirect_stdin(StringIO(answers)):
+            interface.run_sequential(script.body)
+        run_time = perf_counter() - start
+        outputs.append(out.getvalue())
+        cache = interface.query_cache
+        print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>10.1f}'.format(
+            n_stops, 'on' if cached else 'off', engine.calls, cache.hits if cached else 0,
+            cache.misses, run_time * 1e3))
+    # Never stale: the session looks the same with and without the cache
+    assert outputs[0] == outputs[1]
+
+def bench_profiler(args):
+    print('Profiler: time spent in Python, stepped and batched')
+    print('{:>8} {:>6} {:>10} {:>8} {:>10} {:>10} {:>8}'.format(
+        'lines', 'depth', 'profiler', 'batch', 'evals', 'python ms', 'lines'))
+    for n_statements, depth in ((1000, 0), (1000, 4)):
+        script = parse_lines(gen_script(n_statements, depth))
+        workspaces = []
+        for profiled, batch in ((False, False), (True, False), (False, True), (True, True)):
+            engine = FakeEngine()
+            interface = QuietInterface(engine)
+            interface.batch_statements = batch
+            if profiled:
+                interface.profiler = ScriptProfiler()
+                interface.eng = ProfiledEngine(engine, interface.profiler)
+            start = perf_counter()
+            with redirect_stdout(StringIO()):
+                interface.run_sequential(script.body)
+            run_time = perf_counter() - start - engine.engine_time()
+            workspaces.append(dict(engine.workspace))
+            # The batched profile still has a row for every statement run
+            n_lines = len(interface.profiler.lines) if profiled else 0
+            print('{:>8} {:>6} {:>10} {:>8} {:>10} {:>10.2f} {:>8}'.format(
+                n_statements, depth, 'on' if profiled else 'off', 'on' if batch else 'off',
+                engine.calls, run_time * 1e3, n_lines if profiled else '-'))
+        assert all(workspace == workspaces[0] for workspace in workspaces)
+
+def bench_server(args):
+    launch = 1.0
+    print('Engine server: time until a terminal gets an engine ({} s MATLAB launch)'.format(launch))
+    print('{:<34} {:>12} {:>14}'.format('terminal', 'engine ms', 'us/round trip'))
+    factory = fake_engine_factory(launch)
+    start = perf_counter()
+    factory().quit()
+    print('{:<34} {:>12.1f} {:>14}'.format('own engine (cold start)', (perf_counter() - start) * 1e3, '-'))
+
+    authkey = os.urandom(32)
+    server = EngineServer(('localhost', 0), factory, max_engines = 2, warm = 2, authkey = authkey).start()
+    sleep(launch * 1.2) # The server has been up for a while
+    for label in ('server, warm engine', 'server, engine reused'):
+        start = perf_counter()
+        remote = RemoteEngine(server.address, authkey)
+        connect_time = perf_counter() - start
+        n_calls = 500
+        start = perf_counter()
+        for i in range(n_calls):
+            remote.eval('x = {};'.format(i), nargout = 0)
+        round_trip = (perf_counter() - start) / n_calls
+        print('{:<34} {:>12.1f} {:>14.1f}'.format(label, connect_time * 1e3, round_trip * 1e6))
+        remote.quit()
+        sleep(0.1)
+
+    # Both engines busy: the third terminal waits in line for a release
+    sessions = [RemoteEngine(server.address, authkey) for _ in range(2)]
+    positions = []
+    release = threading.Timer(0.5, sessions[0].quit)
+    release.start()
+    start = perf_counter()
+    queued = RemoteEngine(server.address, authkey, on_queued = positions.append)
+    print('{:<34} {:>12.1f} {:>14}'.format('server, queued behind 2 sessions', (perf_counter() - start) * 1e3,
+                                           '-'))
+    assert positions == [1]
+    for remote in sessions[1:] + [queued]:
+        remote.quit()
+    server.close()
+
+def bench_input(args):
+    # The fake engine does not parse MATLAB, so what MATLAB would have to
+    # parse is given as the size of the evaluated code
+    print('input(): pasted values formatted into an eval vs a typed workspace write')
+    print('{:>10} {:>8} {:>8} {:>10} {:>12} {:>12}'.format(
+        'elements', 'shape', 'mode', 'calls', 'code bytes', 'python ms'))
+    for n_rows, n_cols in ((1, 100000), (1000, 100)):
+        text = '[' + '; '.join(' '.join(str(0.5 * (i * n_cols + j)) for j in range(n_cols))
+                               for i in range(n_rows)) + ']'
+        for typed in (False, True):
+            engine = FakeEngine()
+            interface = QuietInterface(engine)
+            start = perf_counter()
+            with redirect_stdout(StringIO()), redirect_stdin(StringIO(text + '\n')):
+                if typed:
+                    interface.process_input("x = input('Data: ');")
+                else:
+                    # What process_input used to do
+                    interface.run_line("assignin('base','{}',{})".format('x', input()))
+            run_time = perf_counter() - start - engine.engine_time()
+            code_bytes = sum(len(call.args[0]) for call in engine.call_log if call.kind == 'eval')
+            if typed:
+                value = dict.__getitem__(engine.workspace, 'x')
+                assert len(value) == n_rows and len(value[0]) == n_cols
+            print('{:>10} {:>8} {:>8} {:>10} {:>12} {:>12.1f}'.format(
+                n_rows * n_cols, '{}x{}'.format(n_rows, n_cols), 'typed' if typed else 'eval',
+                engine.calls, code_bytes, run_time * 1e3))
+
+def bench_breakpoints(args):
+    # Reaching the last iteration of a loop: a plain breakpoint continued at
+    # every pass (the loop is stepped), a conditional and a hit-count one
+    # (the loop runs natively up to the stop), and no breakpoint at all (the
+    # loop runs natively)
+    print('breakpoint in a loop: plain dbg continued every pass vs dbg if / dbg hits=N vs batched')
+    print('{:>10} {:>12} {:>8} {:>10} {:>12} {:>12}'.format(
+        'passes', 'breakpoint', 'stops', 'calls', 'total s', 'us/pass'))
+    for n_passes in (1000, 10000):
+        for label, marker in (('none', ''), ('dbg', 'dbg'), ('dbg if', 'dbg if k == {}'.format(n_passes)),
+                              ('dbg hits', 'dbg hits={}'.format(n_passes))):
+            script = parse_lines(['x = 0;', 'for k = 1:{}'.format(n_passes),
+                                  'x = x + k; ' + marker, 'end'])
+            engine = FakeEngine(latency=args.latency / 100)
+            interface = QuietInterface(engine)
+            interface.debug_mode = True
+            stops = n_passes if marker == 'dbg' else 1 if marker else 0
+            start = perf_counter()
+            with redirect_stdout(StringIO()), redirect_stdin(StringIO('c\n' * stops)):
+                interface.run_sequential(script.body)
+            run_time = perf_counter() - start
+            assert dict.__getitem__(engine.workspace, 'x') == n_passes * (n_passes + 1) / 2
+            print('{:>10} {:>12} {:>8} {:>10} {:>12.3f} {:>12.2f}'.format(
+                n_passes, label, stops,
+                engine.calls, run_time, run_time / n_passes * 1e6))
+
+def bench_select(args):
+    # A stepped switch (it holds an input, say) and the same chain as if/elseif,
+    # dispatched on every case in turn
+    print('switch and if/elseif chains: one test per branch vs a single selector call')
+    print('{:>8} {:>8} {:>12} {:>10} {:>14} {:>12}'.format(
+        'chain', 'branches', 'dispatch', 'calls', 'calls/dispatch', 'us/dispatch'))
+    n_dispatches = 300
+    for n_branches in (5, 30):
+        cases = []
+        for i in range(1, n_branches + 1):
+            cases += ['case {}'.format(i), 'r = {};'.format(i)]
+        switch = parse_lines(['switch c'] + cases + ['end'])
+        chain = ['if c == 1', 'r = 1;']
+        for i in range(2, n_branches + 1):
+            chain += ['elseif c == {}'.format(i), 'r = {};'.format(i)]
+        chain = parse_lines(chain + ['end'])
+        for kind, script in (('switch', switch), ('if', chain)):
+            for single in (False, True):
+                engine = FakeEngine(latency=args.latency)
+                interface = QuietInterface(engine)
+                interface.batch_statements = False
+                start = perf_counter()
+                with redirect_stdout(StringIO()):
+                    for i in range(n_dispatches):
+                        engine.workspace['c'] = i % n_branches + 1
+                        if single:
+                            interface.run_sequential(script.body)
+                        else:
+                            # What run_switch_block and run_if_block used to do
+                            for j in range(1, n_branches + 1):
+                                if interface.run_line('c=={}'.format(j), output = False):
+                                    interface.run_line('r = {};'.format(j))
+                                    break
+                        assert dict.__getitem__(engine.workspace, 'r') == i % n_branches + 1
+                run_time = perf_counter() - start
+                calls = engine.calls - 2 * n_dispatches
+                print('{:>8} {:>8} {:>12} {:>10} {:>14.1f} {:>12.1f}'.format(
+                    kind, n_branches, 'selector' if single else 'per branch', calls,
+                    calls / n_dispatches, run_time / n_dispatches * 1e6))
+
+suites = {
+    'block_tree': bench_block_tree,
+    'batching': bench_batching,
+    'loop_offload': bench_loop_offload,
+    'overhead': bench_overhead,
+    'dispatch': bench_dispatch,
+    'for_range': bench_for_range,
+    'profiler': bench_profiler,
+    'server': bench_server,
+    'input': bench_input,
+    'breakpoints': bench_breakpoints,
+    'select': bench_select,
+    'startup': bench_startup,
+    'recovery': bench_recovery,
+    'parallel': bench_parallel,
+    'streaming': bench_streaming,
+    'watch': bench_watch,
+    'watch_diff': bench_watch_diff,
+    'query_cache': bench_query_cache,
+    'checkpoint': bench_checkpoint,
+    'completion': bench_completion,
+    'parse_cache': bench_parse_cache,
+    'indexed_file': bench_indexed_file,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Interpreter benchmarks (no MATLAB needed)')
+    parser.add_argument('suites', nargs='*', help='suites to run: {}'.format(', '.join(suites)))
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='simulated engine latency per call in seconds (default: 0.002)')
+    parser.add_argument('--max-overhead', type=float, default=0,
+                        help='fail when the Python overhead per statement exceeds this many us')
+    args = parser.parse_args()
+    for name in args.suites or suites:
+        suites[name](args)
+        print()
@@ -0,0 +1,160 @@
+# Incremental checkpoints of the base workspace
+#
+# Every variable is saved by MATLAB itself to a MAT-file of its own in the
+# checkpoint folder, so no data goes through Python, and a checkpoint only
+# rewrites the variables changed since the previous one. Changes are found
+# with the engine-side hashes of workspace.py, fetched in one call, and a
+# variable without a hash is saved again at every checkpoint: nothing is kept
+# as unchanged unless its content is known to be. A manifest keeps the fingerprint of every saved variable, so a later session
+# can restore the folder and carry on checkpointing incrementally. Restoring
+# loads all files with one eval.
+#
+# A folder is used by one session at a time: the first checkpoint or restore
+# locks it, and when another running session holds the lock (e.g. another
+# client of the engine server), this session uses a folder of its own
+# instead, so neither deletes the files of the other.
+
+import os
+import json
+from time import monotonic
+from helper import cache_path, matlab_quote
+from workspace import fingerprint_expr, parse_fingerprints, unfingerprinted
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+manifest_name = 'manifest.json'
+lock_name = 'lock'
+
+def default_checkpoint_dir() -> str:
+    return cache_path('checkpoint')
+
+def lock_folder(directory: str):
+    # Returns the open lock file of directory, or None when another process
+    # holds it. The lock goes with the process, even if it crashes
+    os.makedirs(directory, exist_ok=True)
+    lock_file = open(os.path.join(directory, lock_name), 'a')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+class WorkspaceCheckpointer:
+    def __init__(self, directory: str = None, every: int = None, interval: float = None,
+                 mat_format: str = '-v7'):
+        # every: checkpoint after this many statements, interval: after this
+        # many seconds (checked between statements). Neither: manual only.
+        # mat_format: option of save, e.g. '-v7.3' for variables over 2 GB
+        self.directory = directory or default_checkpoint_dir()
+        self.every = every
+        self.interval = interval
+        self.mat_format = mat_format
+        self.lock_file = None
+        self.expr = fingerprint_expr()
+        # name -> [class, size, bytes, fingerprint] of the saved variables
+        self.saved = self.load_manifest()
+        self.statements = 0
+        self.last_time = monotonic()
+        # Set once a checkpoint of this session exists, so restarts restore it
+        self.active = False
+
+    @property
+    def automatic(self) -> bool:
+        return bool(self.every or self.interval)
+
+    def tick(self, n_statements: int = 1) -> bool:
+        # Counts executed statements, returns True when a checkpoint is due
+        if not self.automatic:
+            return False
+        self.statements = self.statements + n_statements
+        if self.every and self.statements >= self.every:
+            return True
+        return bool(self.interval) and monotonic() - self.last_time >= self.interval
+
+    def file_path(self, name: str) -> str:
+        return os.path.join(self.directory, name + '.mat')
+
+    def load_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, manifest_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def claim(self):
+        # Locks the folder for this session, or switches to a folder of its own
+        if self.lock_file is not None:
+            return
+        self.lock_file = lock_folder(self.directory)
+        if self.lock_file is None:
+            self.directory = '{}-{}'.format(self.directory, os.getpid())
+            self.saved = self.load_manifest()
+            self.lock_file = lock_folder(self.directory)
+
+    def release(self):
+        # Unlocks the folder, e.g. for another session to resume from it
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def save_manifest(self):
+        path = os.path.join(self.directory, manifest_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.saved, f)
+        os.replace(path + '.tmp', path)
+
+    def checkpoint(self, eng) -> tuple:
+        # Saves the new, changed and unhashed variables and drops the removed
+        # ones. Every variable is hashed, as saving it would cost more. Returns (saved names, removed names, saved bytes)
+        self.claim()
+        fingerprints = parse_fingerprints(eng.eval(self.expr, nargout=1))
+        current = {}
+        changed = []
+        for name, (info, fingerprint) in fingerprints.items():
+            current[name] = [info.cls, list(info.size), info.bytes, fingerprint]
+            if self.saved.get(name) != current[name] or fingerprint == unfingerprinted:
+                changed.append(name)
+        removed = [name for name in self.saved if name not in current]
+
+        if changed:
+            eng.eval('\n'.join("save({}, {}, {});".format(
+                matlab_quote(self.file_path(name)), matlab_quote(name), matlab_quote(self.mat_format))
+                for name in changed), nargout=0)
+        for name in removed:
+            try:
+                os.remove(self.file_path(name))
+            except OSError:
+                pass
+        self.saved = current
+        self.save_manifest()
+        self.statements = 0
+        self.last_time = monotonic()
+        self.active = True
+        return changed, removed, sum(current[name][2] for name in changed)
+
+    def restore(self, eng) -> int:
+        # Loads the saved variables into the base workspace of eng. Returns
+        # the number of variables restored
+        self.claim()
+        names = [name for name in self.saved if os.path.exists(self.file_path(name))]
+        if not names:
+            return 0
+        # A damaged file only loses its own variable
+        eng.eval('\n'.join("try, load({}); catch, end".format(matlab_quote(self.file_path(name)))
+                           for name in names), nargout=0)
+        self.statements = 0
+        self.last_time = monotonic()
+        self.active = True
+        return len(names)
+
+    def summary(self) -> str:
+        return '{} variable(s), {} byte(s) in {}'.format(
+            len(self.saved), sum(entry[2] for entry in self.saved.values()), self.directory)
@@ -0,0 +1,185 @@
+# Tab completion of the terminal from a local symbol index
+#
+# Asking the engine (who, exist, which) at every Tab would take far too long,
+# so completion only reads a local index of the workspace variables, the
+# functions on the MATLAB path and the scripts of the current folder. The
+# names are kept sorted, so a completion is a binary search. The index is
+# built in the background once the engine is ready, and refreshed in the
+# background after the statements which may change it: the folders of the
+# path are only rescanned when their mtime changed, and their listings are
+# persisted across sessions.
+
+import os
+import re
+import json
+import threading
+from bisect import bisect_left
+from helper import cache_path
+from workspace import internal_prefix
+
+try:
+    import readline
+except ImportError:
+    readline = None
+
+# Files and folders defining a function, class or package
+function_matcher = re.compile(r'^([A-Za-z]\w*)\.(m|p|mlx|mlapp|mex\w+)$')
+class_matcher = re.compile(r'^[@+]([A-Za-z]\w*)$')
+
+# Commands changing the path or the current folder
+path_matcher = re.compile(r'^\s*(addpath|rmpath|path|restoredefaultpath|userpath)\b')
+cd_matcher = re.compile(r'^\s*cd\b')
+# Commands which do not modify the workspace (every other may: assignments,
+# clear, load, scripts, ...)
+read_only_matcher = re.compile(r'^\s*(disp|fprintf|help|doc|who|whos|which|exist|type|clc|pwd|ls|dir)\b')
+
+completer_delims = ' \t\n()[]{},;:=+-*/\\^&|~<>!\'"@'
+
+def default_index_path() -> str:
+    return cache_path('symbols.json')
+
+def scan_folder(folder: str) -> list:
+    names = []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                match = function_matcher.match(entry.name) or class_matcher.match(entry.name)
+                if match:
+                    names.append(match.group(1))
+    except OSError:
+        pass
+    return names
+
+def merge(*sources) -> tuple:
+    return tuple(sorted(set().union(*sources)))
+
+def prefixed(names: tuple, prefix: str) -> list:
+    start = bisect_left(names, prefix)
+    return list(names[start:bisect_left(names, prefix + '\uffff', start)])
+
+class SymbolIndex:
+    def __init__(self, query, path: str = None):
+        # query evaluates an expression on the engine and returns its value
+        self.query = query
+        self.path = path or default_index_path()
+        # folder -> (mtime, names), loaded from and saved to path
+        self.folders = self.load()
+        self.path_names = ()
+        self.cwd_names = ()
+        # Sorted names of the path and the current folder, and of the
+        # variables, each replaced as a whole so the completer needs no lock.
+        # A workspace refresh does not sort the path again
+        self.names = ()
+        self.variables = ()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return {folder: (entry[0], entry[1]) for folder, entry in json.load(f).items()}
+        except (OSError, ValueError, TypeError, IndexError):
+            return {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.folders, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            pass
+
+    def folder_names(self, folder: str) -> tuple:
+        # Listing of folder, rescanned only if it changed. Returns (names, rescanned)
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            return [], False
+        entry = self.folders.get(folder)
+        if entry is not None and entry[0] == mtime:
+            return entry[1], False
+        names = scan_folder(folder)
+        self.folders[folder] = (mtime, names)
+        return names, True
+
+    def refresh_path(self):
+        folders = [folder for folder in str(self.query('path')).split(os.pathsep) if folder]
+        names = set()
+        rescanned = False
+        for folder in folders:
+            folder_names, changed = self.folder_names(folder)
+            names.update(folder_names)
+            rescanned = rescanned or changed
+        self.path_names = tuple(names)
+        if rescanned:
+            self.save()
+
+    def refresh_cwd(self):
+        # Scripts are also completed with their extension, for the script runner
+        names = scan_folder(str(self.query('pwd')))
+        self.cwd_names = tuple(names + [name + '.m' for name in names])
+
+    def refresh_workspace(self):
+        self.variables = merge(str(name) for name in self.query('who')
+                               if not str(name).startswith(internal_prefix))
+
+    def refresh(self, path: bool = True, cwd: bool = True, workspace: bool = True):
+        with self.lock:
+            for enabled, step in ((path, self.refresh_path), (cwd, self.refresh_cwd),
+                                  (workspace, self.refresh_workspace)):
+                if enabled:
+                    try:
+                        step()
+                    except Exception:
+                        # Completion is best effort, e.g. while the engine restarts
+                        pass
+            if path or cwd:
+                self.names = merge(self.path_names, self.cwd_names)
+            self.ready.set()
+
+    def refresh_async(self, **kinds):
+        threading.Thread(target=self.refresh, kwargs=kinds, daemon=True).start()
+
+    def after_command(self, command: str):
+        # Refreshes in the background what command may have changed
+        tokens = command.split()
+        if tokens and tokens[0].endswith('.m'):
+            # Scripts may do anything
+            self.refresh_async()
+        elif path_matcher.match(command):
+            self.refresh_async(cwd=False, workspace=False)
+        elif cd_matcher.match(command):
+            self.refresh_async(path=False, workspace=False)
+        elif not read_only_matcher.match(command):
+            self.refresh_async(path=False, cwd=False)
+
+    def complete(self, prefix: str) -> list:
+        variables = prefixed(self.variables, prefix)
+        names = prefixed(self.names, prefix)
+        if not variables:
+            return names
+        return sorted(set(variables).union(names))
+
+class Completer:
+    # readline completer function over a SymbolIndex
+    def __init__(self, index: SymbolIndex):
+        self.index = index
+        self.matches = []
+
+    def __call__(self, text: str, state: int):
+        if state == 0:
+            self.matches = self.index.complete(text)
+        return self.matches[state] if state < len(self.matches) else None
+
+def install_completer(index: SymbolIndex) -> bool:
+    # Returns False when readline is not available (e.g. on Windows)
+    if readline is None:
+        return False
+    readline.set_completer(Completer(index))
+    readline.set_completer_delims(completer_delims)
+    if 'libedit' in (readline.__doc__ or ''):
+        readline.parse_and_bind('bind ^I rl_complete')
+    else:
+        readline.parse_and_bind('tab: complete')
+    return True
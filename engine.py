@@ -0,0 +1,495 @@
+# Engine backends for MatlabInterface
+#
+# MatlabInterface only needs eval, run, workspace and quit from its engine. The
+# real backend is the MATLAB Engine for Python; FakeEngine and LatencyEngine are
+# stand-ins used to measure the interpreter without a MATLAB installation.
+
+import os
+import re
+import threading
+from collections import namedtuple
+from time import perf_counter, sleep
+from streaming import diary_state_expr
+
+try:
+    import matlab.engine
+    from matlab.engine import RejectedExecutionError as MatlabTerminated
+except ImportError:
+    matlab = None
+    # Placeholder keeping the exception handlers valid without the engine
+    class MatlabTerminated(Exception):
+        pass
+
+EngineCall = namedtuple('EngineCall', 'kind args duration')
+
+word_matcher = re.compile(r'^[A-Za-z]\w*')
+
+def start_matlab(background: bool = False):
+    if matlab is None:
+        raise RuntimeError('MATLAB Engine for Python is not installed')
+    return matlab.engine.start_matlab(background=background)
+
+class FakeEngineError(Exception):
+    pass
+
+class FakeWorkspace(dict):
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+
+    def __getitem__(self, name):
+        start = perf_counter()
+        self.engine.wait()
+        try:
+            return super().__getitem__(name)
+        finally:
+            self.engine.log('workspace_get', (name,), start)
+
+    def __setitem__(self, name, value):
+        start = perf_counter()
+        self.engine.wait()
+        super().__setitem__(name, value)
+        self.engine.log('workspace_set', (name,), start)
+
+class FakeEngine:
+    # Scriptable in-process engine
+    #
+    # responses maps code to the value returned by eval, or to a callable
+    # receiving (engine, code, nargout). Any other code goes to handler if one
+    # is given, or else to a tiny evaluator understanding assignments, ranges
+    # (a:b), column indexing (x(:,k)), size(x(:,:), 2), clear, error(...),
+    # the markers (also those of guarded loops) and the profiling commands
+    # of script_compiler (timed with perf_counter), exist(name, 'var'),
+    # if/elseif/else, for, while, switch, break, continue and
+    # Python-compatible expressions over the workspace. An assignment it
+    # cannot evaluate raises FakeEngineError, and other
+    # statements (function calls) are ignored. pwd is the current folder of
+    # Python when the engine is created. diary(file) and diary off are
+    # understood: the output of background calls reaches the diary file as it
+    # is produced, and the stdout of the caller only within result(), as with
+    # the engine API.
+    # scripts maps script paths to callables receiving (engine, stdout,
+    # stderr), which simulate the script run.
+    # Each call sleeps for latency seconds and is appended to call_log.
+    range_matcher = re.compile(r'^([^:()\[\]{}]+):([^:()\[\]{}]+)$')
+    assign_matcher = re.compile(r'^([A-Za-z]\w*)\s*=(?!=)\s*(.*)$')
+    # Batch, select and stop markers, and the state of guarded loops
+    marker_matcher = re.compile(r"^fprintf\('%c%d\\n', (29|30|31), (\d+)\);?$")
+    state_marker_matcher = re.compile(r"^fprintf\('%c%d((?: %d)+)\\n', 31, (.+)\);$")
+    openers = ('if', 'for', 'while', 'switch', 'try', 'parfor', 'spmd', 'function')
+    diary_matcher = re.compile(r"^diary\('(.*)'\);?$")
+    # Profiling commands of script_compiler
+    timer_expr = 'toc(uint64(0))'
+    exist_matcher = re.compile(r"^exist\('([A-Za-z]\w*)', 'var'\)$")
+    profile_init_matcher = re.compile(r'^pymatlab_prof = zeros\(2, \d+\);$')
+    profile_add_matcher = re.compile(r'^pymatlab_prof\(:, (\d+)\) = pymatlab_prof\(:, \d+\) \+ '
+                                     r'\[1; toc\(uint64\(0\)\) - pymatlab_t\];$')
+    profile_report_matcher = re.compile(r"^fprintf\('%c%d %d %\.9f\\n', \[28 \* ones\(1, \d+\); "
+                                        r"\[([\d ]+)\]; pymatlab_prof\(:, \[[\d ]+\]\)\]\);$")
+    column_matcher = re.compile(r'^([A-Za-z]\w*)\(:\s*,\s*(\d+)\)$')
+    n_columns_matcher = re.compile(r'^size\(([A-Za-z]\w*)\(:\s*,\s*:\)\s*,\s*2\)$')
+    operators = [(re.compile(r'~='), '!='), (re.compile(r'~'), ' not '),
+                 (re.compile(r'&&'), ' and '), (re.compile(r'\|\|'), ' or '),
+                 (re.compile(r'\^'), '**'), (re.compile(r'\btrue\b'), 'True'),
+                 (re.compile(r'\bfalse\b'), 'False')]
+
+    def __init__(self, latency: float = 0.0, responses: dict = None, handler = None,
+                 scripts: dict = None):
+        self.latency = latency
+        self.responses = {"version('-release');": '2023a', 'pwd': os.getcwd(),
+                          diary_state_expr: lambda engine, code, nargout: [
+                              'on' if engine.diary_file else 'off', engine.diary_file or 'diary']}
+        self.responses.update(responses or {})
+        self.handler = handler
+        self.scripts = scripts or {}
+        self.call_log = []
+        self.workspace = FakeWorkspace(self)
+        self.closed = False
+        self.diary_file = None
+
+    @property
+    def calls(self) -> int:
+        return len(self.call_log)
+
+    def engine_time(self) -> float:
+        return sum(call.duration for call in self.call_log)
+
+    def reset_log(self):
+        self.call_log = []
+
+    def wait(self):
+        if self.closed:
+            raise FakeEngineError('The engine has been closed')
+        if self.latency:
+            sleep(self.latency)
+
+    def log(self, kind: str, args: tuple, start: float):
+        self.call_log.append(EngineCall(kind, args, perf_counter() - start))
+
+    def eval(self, code: str, nargout: int = 1, stdout = None, stderr = None, background = False):
+        if background:
+            return self.background(lambda output: self.eval(code, nargout, output, stderr), stdout)
+        start = perf_counter()
+        self.wait()
+        try:
+            if code in self.responses:
+                response = self.responses[code]
+                return response(self, code, nargout) if callable(response) else response
+            if self.handler is not None:
+                return self.handler(self, code, nargout)
+            return self.evaluate(code, nargout, stdout, stderr)
+        finally:
+            self.log('eval', (code, nargout), start)
+
+    def run(self, script_path: str, nargout: int = 0, stdout = None, stderr = None, background = False):
+        if background:
+            return self.background(lambda output: self.run(script_path, nargout, output, stderr), stdout)
+        start = perf_counter()
+        self.wait()
+        try:
+            if script_path in self.scripts:
+                self.scripts[script_path](self, stdout, stderr)
+        finally:
+            self.log('run', (script_path,), start)
+
+    def background(self, call, stdout):
+        if stdout is None:
+            return FakeFuture(lambda: call(None))
+        output = DeferredOutput(stdout, self.diary_file)
+        def target():
+            try:
+                return call(output)
+            finally:
+                output.close()
+        return FakeFuture(target, on_result = output.deliver)
+
+    def quit(self):
+        self.closed = True
+
+    def to_python(self, expr: str):
+        for matlab_op, python_op in self.operators:
+            expr = matlab_op.sub(python_op, expr)
+        return expr
+
+    def rows(self, name: str) -> list:
+        # Workspace values as a list of rows, like ranges are stored
+        try:
+            value = dict.__getitem__(self.workspace, name)
+        except KeyError:
+            raise FakeEngineError("Unrecognized function or variable '{}'.".format(name))
+        return as_rows(value)
+
+    def value_of(self, expr: str):
+        expr = expr.strip().rstrip(';').strip()
+        if expr == self.timer_expr:
+            return perf_counter()
+        match = self.exist_matcher.match(expr)
+        if match:
+            return float(match.group(1) in self.workspace)
+        match = self.column_matcher.match(expr)
+        if match:
+            column = [row[int(match.group(2)) - 1] for row in self.rows(match.group(1))]
+            return column[0] if len(column) == 1 else [[value] for value in column]
+        match = self.n_columns_matcher.match(expr)
+        if match:
+            rows = self.rows(match.group(1))
+            return float(len(rows[0])) if rows else 0.0
+        match = self.range_matcher.match(expr)
+        if match:
+            first, last = (self.value_of(bound) for bound in match.groups())
+            return [[float(i) for i in range(int(first), int(last) + 1)]]
+        try:
+            return eval(self.to_python(expr), {}, dict(self.workspace))
+        except Exception:
+            raise FakeEngineError("Unrecognized function or variable '{}'.".format(expr))
+
+    def evaluate(self, code: str, nargout: int, stdout, stderr):
+        if nargout > 0:
+            return self.value_of(code)
+        self.execute(code.split('\n'), stdout, stderr)
+        return None
+
+    def execute(self, lines: list, stdout, stderr):
+        # Runs lines, returns 'break' or 'continue' when one of them is met
+        i = 0
+        while i < len(lines):
+            line = lines[i].strip()
+            word = first_word(line)
+            if word in ('if', 'for', 'while', 'switch'):
+                end, heads = self.split_block(lines, i)
+                signal = getattr(self, 'run_' + word)(lines, [i] + heads + [end], stdout, stderr)
+                if signal is not None:
+                    return signal
+                i = end + 1
+                continue
+            if word in ('try', 'parfor', 'spmd', 'function'):
+                raise FakeEngineError('FakeEngine cannot run {} blocks'.format(word))
+            if word in ('break', 'continue'):
+                return word
+            self.statement(line, stdout, stderr)
+            i = i + 1
+        return None
+
+    def split_block(self, lines: list, start: int) -> tuple:
+        # Line of the end of the block opened at start, and lines of its
+        # else/elseif/case/otherwise
+        depth = 0
+        heads = []
+        for i in range(start, len(lines)):
+            word = first_word(lines[i].strip())
+            if word in self.openers:
+                depth = depth + 1
+            elif word == 'end':
+                depth = depth - 1
+                if depth == 0:
+                    return i, heads
+            elif depth == 1 and word in ('elseif', 'else', 'case', 'otherwise'):
+                heads.append(i)
+        raise FakeEngineError('The end of the {} block is missing'.format(first_word(lines[start].strip())))
+
+    def run_if(self, lines: list, heads: list, stdout, stderr):
+        for head, next_head in zip(heads, heads[1:]):
+            line = lines[head].strip()
+            word = first_word(line)
+            if word == 'else' or is_true(self.value_of(line[len(word):])):
+                return self.execute(lines[head + 1:next_head], stdout, stderr)
+        return None
+
+    def run_for(self, lines: list, heads: list, stdout, stderr):
+        name, expr = lines[heads[0]].strip()[3:].split('=', 1)
+        rows = as_rows(self.value_of(expr))
+        body = lines[heads[0] + 1:heads[-1]]
+        for k in range(len(rows[0]) if rows else 0):
+            column = [row[k] for row in rows]
+            dict.__setitem__(self.workspace, name.strip(),
+                             column[0] if len(column) == 1 else [[value] for value in column])
+            if self.execute(body, stdout, stderr) == 'break':
+                break
+        return None
+
+    def run_while(self, lines: list, heads: list, stdout, stderr):
+        condition = lines[heads[0]].strip()[5:]
+        body = lines[heads[0] + 1:heads[-1]]
+        while is_true(self.value_of(condition)):
+            if self.execute(body, stdout, stderr) == 'break':
+                break
+        return None
+
+    def run_switch(self, lines: list, heads: list, stdout, stderr):
+        value = self.value_of(lines[heads[0]].strip()[6:])
+        for head, next_head in zip(heads[1:], heads[2:]):
+            line = lines[head].strip()
+            if line == 'otherwise' or value in self.case_values(line[4:]):
+                return self.execute(lines[head + 1:next_head], stdout, stderr)
+        return None
+
+    def statement(self, line: str, stdout, stderr):
+        match = self.marker_matcher.match(line)
+        if match:
+            if stdout is not None:
+                stdout.write('{}{}\n'.format(chr(int(match.group(1))), match.group(2)))
+            return
+        match = self.state_marker_matcher.match(line)
+        if match:
+            values = [int(self.value_of(arg)) for arg in split_call_args(match.group(2))]
+            if stdout is not None:
+                stdout.write('\x1f{}\n'.format(' '.join(str(value) for value in values)))
+            return
+        match = self.diary_matcher.match(line)
+        if match:
+            self.diary_file = match.group(1).replace("''", "'")
+            return
+        if line.rstrip(';') == 'diary off':
+            self.diary_file = None
+            return
+        if line.rstrip(';') in ('clear', 'clear all'):
+            dict.clear(self.workspace)
+            return
+        if line.startswith('clear '):
+            for name in line[6:].rstrip(';').split():
+                dict.pop(self.workspace, name, None)
+            return
+        if self.profile_init_matcher.match(line):
+            dict.__setitem__(self.workspace, 'pymatlab_prof', {})
+            return
+        match = self.profile_add_matcher.match(line)
+        if match:
+            times = self.profile_times()
+            count, time = times.get(int(match.group(1)), (0, 0.0))
+            start = dict.__getitem__(self.workspace, 'pymatlab_t')
+            times[int(match.group(1))] = (count + 1, time + perf_counter() - start)
+            return
+        match = self.profile_report_matcher.match(line)
+        if match:
+            times = self.profile_times()
+            for line_no in match.group(1).split():
+                count, time = times.get(int(line_no), (0, 0.0))
+                if stdout is not None:
+                    stdout.write('\x1c{} {} {:.9f}\n'.format(line_no, count, time))
+            return
+        if line.startswith('error('):
+            if stderr is not None:
+                stderr.write(line + '\n')
+            raise FakeEngineError(line)
+        match = self.assign_matcher.match(line)
+        if match:
+            name, expr = match.groups()
+            # Raises when the value cannot be evaluated, as MATLAB would
+            dict.__setitem__(self.workspace, name, self.value_of(expr))
+            if not line.endswith(';') and stdout is not None:
+                stdout.write('{} = {}\n'.format(name, expr))
+
+    def profile_times(self) -> dict:
+        try:
+            return dict.__getitem__(self.workspace, 'pymatlab_prof')
+        except KeyError:
+            raise FakeEngineError("Unrecognized function or variable 'pymatlab_prof'.")
+
+    def case_values(self, expr: str) -> list:
+        expr = expr.strip()
+        if expr.startswith('{') and expr.endswith('}'):
+            return [self.value_of(item) for item in expr[1:-1].split(',')]
+        return [self.value_of(expr)]
+
+def split_call_args(text: str) -> list:
+    # Splits at the commas outside of parentheses
+    args = ['']
+    depth = 0
+    for char in text:
+        if char == ',' and depth == 0:
+            args.append('')
+            continue
+        depth = depth + (char in '([{') - (char in ')]}')
+        args[-1] = args[-1] + char
+    return args
+
+def first_word(line: str) -> str:
+    match = word_matcher.match(line)
+    return match.group(0) if match else ''
+
+def as_rows(value) -> list:
+    if isinstance(value, list) and all(isinstance(row, list) for row in value):
+        return value
+    return [[value]]
+
+def is_true(value) -> bool:
+    # Like MATLAB, an array is true when it is not empty and all its elements are
+    rows = as_rows(value)
+    return bool(rows) and bool(rows[0]) and all(bool(item) for row in rows for item in row)
+
+class DeferredOutput:
+    # stdout of a FakeEngine background call: written to the diary file, if
+    # any, as it is produced, and to the stream of the caller by deliver()
+    def __init__(self, stream, diary_file: str = None):
+        self.stream = stream
+        self.diary = open(diary_file, 'a') if diary_file else None
+        self.chunks = []
+
+    def write(self, text: str) -> int:
+        if self.diary is not None:
+            self.diary.write(text)
+            self.diary.flush()
+        self.chunks.append(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.diary is not None:
+            self.diary.close()
+            self.diary = None
+
+    def deliver(self):
+        text = ''.join(self.chunks)
+        self.chunks = []
+        if text:
+            self.stream.write(text)
+
+class FakeFuture:
+    # Mimics the futures returned by the engine API for background calls.
+    # on_result is called by the first result(), before it returns or raises
+    def __init__(self, target, delay: float = 0.0, on_result = None):
+        self.finished = threading.Event()
+        self.cancelled = False
+        self.value = None
+        self.error = None
+        self.on_result = on_result
+        self.thread = threading.Thread(target=self.work, args=(target, delay), daemon=True)
+        self.thread.start()
+
+    def work(self, target, delay: float):
+        try:
+            if delay:
+                sleep(delay)
+            if not self.cancelled:
+                self.value = target()
+        except Exception as e:
+            self.error = e
+        self.finished.set()
+
+    def done(self) -> bool:
+        return self.finished.is_set()
+
+    def cancel(self) -> bool:
+        if self.done():
+            return False
+        self.cancelled = True
+        return True
+
+    def result(self, timeout: float = None):
+        if not self.finished.wait(timeout):
+            raise TimeoutError('The call did not complete in {} s'.format(timeout))
+        if self.cancelled:
+            raise RuntimeError('The call has been cancelled')
+        if self.on_result is not None:
+            on_result, self.on_result = self.on_result, None
+            on_result()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def fake_engine_factory(startup: float = 0.0, **kwargs):
+    # Engine factory with the signature of start_matlab, starting FakeEngines
+    # which take startup seconds to launch
+    def factory(background: bool = False):
+        future = FakeFuture(lambda: FakeEngine(**kwargs), startup)
+        return future if background else future.result()
+    return factory
+
+class LatencyEngine:
+    # Wraps any engine and adds a fixed latency to every call, to emulate the
+    # IPC cost of the real engine
+    class Workspace:
+        def __init__(self, owner):
+            self.owner = owner
+
+        def __getitem__(self, name):
+            sleep(self.owner.latency)
+            return self.owner.engine.workspace[name]
+
+        def __setitem__(self, name, value):
+            sleep(self.owner.latency)
+            self.owner.engine.workspace[name] = value
+
+        def __contains__(self, name):
+            return name in self.owner.engine.workspace
+
+    def __init__(self, engine, latency: float):
+        self.engine = engine
+        self.latency = latency
+        self.workspace = self.Workspace(self)
+
+    def eval(self, *args, **kwargs):
+        sleep(self.latency)
+        return self.engine.eval(*args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        sleep(self.latency)
+        return self.engine.run(*args, **kwargs)
+
+    def quit(self):
+        return self.engine.quit()
+
+    def __getattr__(self, name: str):
+        return getattr(self.engine, name)
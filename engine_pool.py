@@ -0,0 +1,68 @@
+# Pool of standby engines started in the background
+#
+# When the engine of MatlabInterface is terminated, a standby engine is
+# promoted instead of cold-starting MATLAB, and a replacement is started
+# asynchronously.
+
+import threading
+from collections import deque
+from engine import start_matlab
+
+class EnginePool:
+    def __init__(self, engine_factory = start_matlab, size: int = 1, startup_hook = None):
+        # startup_hook: MATLAB commands (e.g. addpath or cd) or a callable
+        # receiving the engine, replayed on every promoted engine
+        self.engine_factory = engine_factory
+        self.size = size
+        self.startup_hook = startup_hook or []
+        self.lock = threading.Lock()
+        self.standby = deque()
+        for _ in range(size):
+            self.spawn()
+
+    def spawn(self):
+        self.standby.append(self.engine_factory(background=True))
+
+    def ready_count(self) -> int:
+        with self.lock:
+            return sum(1 for future in self.standby if future.done())
+
+    def acquire(self, timeout: float = None):
+        # Promotes a standby engine, preferring one which is already running
+        attempts = max(self.size, 1)
+        while True:
+            with self.lock:
+                if not self.standby:
+                    self.spawn()
+                future = next((f for f in self.standby if f.done()), self.standby[0])
+                self.standby.remove(future)
+                self.spawn()
+            try:
+                eng = future.result(timeout)
+                break
+            except Exception:
+                # The standby engine failed to start, try the next one
+                attempts = attempts - 1
+                if attempts <= 0:
+                    raise
+        self.run_hook(eng)
+        return eng
+
+    def run_hook(self, eng):
+        if callable(self.startup_hook):
+            self.startup_hook(eng)
+        else:
+            for command in self.startup_hook:
+                eng.eval(command, nargout=0)
+
+    def close(self):
+        with self.lock:
+            while self.standby:
+                future = self.standby.popleft()
+                if future.done():
+                    try:
+                        future.result().quit()
+                    except Exception:
+                        pass
+                else:
+                    future.cancel()
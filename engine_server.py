@@ -0,0 +1,392 @@
+# Engine server shared by several terminals
+#
+# The server owns the MATLAB engines and serves engine calls (eval, run,
+# workspace get/set) over a local socket. Every client connection is a
+# session bound to one engine until it disconnects, so each terminal keeps its
+# own workspace. Engines are started ahead of time, reset and reused when a
+# session ends, and at most max_engines run at once: the sessions beyond wait
+# in a queue for an engine to be released.
+#
+# RemoteEngine is the client side. It provides the engine interface used by
+# MatlabInterface, so a terminal only needs MatlabInterface(RemoteEngine(...)).
+#
+# Usage: python engine_server.py [--address HOST:PORT] [--engines N] [--warm N]
+
+import os
+import sys
+import argparse
+import secrets
+import threading
+from io import StringIO
+from collections import deque
+from multiprocessing.connection import Listener, Client
+from engine import start_matlab, MatlabTerminated, FakeFuture, fake_engine_factory
+from helper import cache_path, cd_cmd
+
+default_address = 'localhost:47800'
+
+# Run on an engine before it is given to the next session
+reset_commands = ['clear all', 'close all', 'fclose all']
+
+class RemoteEngineError(Exception):
+    # Raised by RemoteEngine for the errors MATLAB reports
+    pass
+
+def parse_address(address: str):
+    # 'host:port' for TCP, anything else is a Unix socket path
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or 'localhost', int(port))
+    return address
+
+def default_key_path() -> str:
+    return cache_path('server.key')
+
+def load_authkey(path: str = None, create: bool = False) -> bytes:
+    # The key authenticates the clients, as requests are pickled. The server
+    # creates it readable by its owner only
+    path = path or default_key_path()
+    if create and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    with open(path) as f:
+        return f.read().strip().encode()
+
+class Session:
+    def __init__(self, session_id: int, conn):
+        self.id = session_id
+        self.conn = conn
+        self.engine = None
+        self.calls = 0
+
+class EngineServer:
+    def __init__(self, address = default_address, engine_factory = start_matlab,
+                 max_engines: int = 4, warm: int = 1, authkey: bytes = None):
+        # warm: engines started right away, so the first sessions do not wait
+        # for MATLAB to launch
+        self.address = parse_address(address) if isinstance(address, str) else address
+        self.engine_factory = engine_factory
+        self.max_engines = max_engines
+        self.authkey = authkey
+        self.lock = threading.Condition()
+        self.idle = deque() # Engines released by their session
+        self.starting = deque() # Futures of the engines being started
+        self.n_engines = 0
+        self.waiting = deque()
+        self.sessions = {}
+        self.next_id = 1
+        self.served = 0
+        self.listener = None
+        self.closed = False
+        for _ in range(min(warm, max_engines)):
+            self.starting.append(self.engine_factory(background=True))
+            self.n_engines = self.n_engines + 1
+
+    def start(self):
+        # Serves in a background thread, returns once the socket is listening
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.address = self.listener.address
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        if self.listener is None:
+            self.listener = Listener(self.address, authkey=self.authkey)
+            self.address = self.listener.address
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                if self.closed:
+                    break
+                continue # e.g. a client failing the authentication
+            threading.Thread(target=self.serve_session, args=(conn,), daemon=True).start()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {'engines': self.n_engines, 'idle': len(self.idle) + len(self.starting),
+                    'sessions': len(self.sessions), 'queued': len(self.waiting),
+                    'max_engines': self.max_engines, 'served': self.served}
+
+    def acquire(self, session: Session):
+        # Idle engines first, then warm ones (started first), then a new
+        # engine while under the limit. Otherwise the session waits in line
+        # for a released engine
+        engine = future = None
+        position = 0
+        with self.lock:
+            self.waiting.append(session)
+            while True:
+                if self.closed:
+                    self.waiting.remove(session)
+                    raise RuntimeError('The server is shutting down')
+                if self.waiting[0] is session:
+                    if self.idle:
+                        engine = self.idle.popleft()
+                        break
+                    if self.starting:
+                        future = next((f for f in self.starting if f.done()), self.starting[0])
+                        self.starting.remove(future)
+                        break
+                    if self.n_engines < self.max_engines:
+                        self.n_engines = self.n_engines + 1
+                        break
+                if self.waiting.index(session) + 1 != position:
+                    position = self.waiting.index(session) + 1
+                    try:
+                        session.conn.send(('queued', position))
+                    except OSError:
+                        # The client has left the queue
+                        self.waiting.remove(session)
+                        self.lock.notify_all()
+                        raise
+                self.lock.wait()
+            self.waiting.popleft()
+            self.lock.notify_all()
+        if engine is not None:
+            return engine
+        try:
+            return future.result() if future is not None else self.engine_factory()
+        except Exception:
+            self.discard(None)
+            raise
+
+    def release(self, engine):
+        # Reset for the next session. Engines which cannot be reset are dropped
+        try:
+            for command in reset_commands:
+                engine.eval(command, nargout=0)
+        except Exception:
+            self.discard(engine)
+            return
+        with self.lock:
+            if self.closed:
+                engine.quit()
+            else:
+                self.idle.append(engine)
+            self.lock.notify_all()
+
+    def discard(self, engine):
+        if engine is not None:
+            try:
+                engine.quit()
+            except Exception:
+                pass
+        with self.lock:
+            self.n_engines = self.n_engines - 1
+            self.lock.notify_all()
+
+    def serve_session(self, conn):
+        with self.lock:
+            session = Session(self.next_id, conn)
+            self.next_id = self.next_id + 1
+            self.sessions[session.id] = session
+        try:
+            request = conn.recv()
+            folder = request[1] if request[0] == 'hello' else None
+            try:
+                session.engine = self.acquire(session)
+            except Exception as e:
+                conn.send(('error', str(e)))
+                return
+            if folder:
+                try:
+                    session.engine.eval(cd_cmd(folder), nargout=0)
+                except Exception:
+                    pass
+            conn.send(('ready', session.id))
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    break
+                if request[0] == 'bye':
+                    break
+                response = self.handle(session, request)
+                try:
+                    conn.send(response)
+                except (OSError, EOFError):
+                    break
+                except Exception as e: # The value cannot be pickled
+                    conn.send(('error', 'The value cannot be transferred: {}'.format(e), '', ''))
+                if response[0] == 'terminated':
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.sessions.pop(session.id, None)
+                self.served = self.served + 1
+            if session.engine is not None:
+                self.release(session.engine)
+            conn.close()
+
+    def handle(self, session: Session, request: tuple) -> tuple:
+        # Returns (status, value, stdout, stderr), status being 'ok', 'error'
+        # (handled by MATLAB) or 'terminated' (the engine crashed)
+        session.calls = session.calls + 1
+        eng = session.engine
+        stream = StringIO()
+        err_stream = StringIO()
+        kind = request[0]
+        try:
+            if kind == 'eval':
+                value = eng.eval(request[1], nargout=request[2], stdout=stream, stderr=err_stream)
+            elif kind == 'run':
+                value = eng.run(request[1], nargout=request[2], stdout=stream, stderr=err_stream)
+            elif kind == 'workspace_get':
+                value = eng.workspace[request[1]]
+            elif kind == 'workspace_set':
+                eng.workspace[request[1]] = request[2]
+                value = None
+            elif kind == 'status':
+                value = self.status()
+            else:
+                return ('error', 'Unknown request {!r}'.format(kind), '', '')
+            return ('ok', value, stream.getvalue(), err_stream.getvalue())
+        except MatlabTerminated as e:
+            # The session ends, and the client starts a new one
+            self.discard(eng)
+            session.engine = None
+            return ('terminated', str(e), stream.getvalue(), err_stream.getvalue())
+        except Exception as e:
+            return ('error', str(e), stream.getvalue(), err_stream.getvalue())
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            engines = list(self.idle)
+            futures = list(self.starting)
+            self.idle.clear()
+            self.starting.clear()
+            self.lock.notify_all()
+        if self.listener is not None:
+            self.listener.close()
+        for future in futures:
+            try:
+                engines.append(future.result())
+            except Exception:
+                pass
+        for engine in engines:
+            try:
+                engine.quit()
+            except Exception:
+                pass
+
+class RemoteEngine:
+    # Client of an EngineServer session, with the interface of an engine.
+    # Output is returned when the call completes, and background calls run
+    # in a thread as the connection serves one call at a time
+    class Workspace:
+        def __init__(self, owner):
+            self.owner = owner
+
+        def __getitem__(self, name):
+            return self.owner.request(None, None, 'workspace_get', name)
+
+        def __setitem__(self, name, value):
+            self.owner.request(None, None, 'workspace_set', name, value)
+
+    def __init__(self, address = default_address, authkey: bytes = None, folder: str = None,
+                 on_queued = None):
+        # folder: current folder of the session engine, the client's one by
+        # default. on_queued receives the position in the queue while waiting
+        address = parse_address(address) if isinstance(address, str) else address
+        self.conn = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.workspace = self.Workspace(self)
+        self.conn.send(('hello', folder or os.getcwd()))
+        while True:
+            message = self.conn.recv()
+            if message[0] == 'queued':
+                if on_queued is not None:
+                    on_queued(message[1])
+            elif message[0] == 'ready':
+                self.session = message[1]
+                break
+            else:
+                self.conn.close()
+                raise RuntimeError(message[1])
+
+    def request(self, stdout, stderr, *request):
+        with self.lock:
+            if self.closed:
+                raise MatlabTerminated('The session has ended')
+            try:
+                self.conn.send(request)
+                status, value, out, err = self.conn.recv()
+            except (EOFError, OSError) as e:
+                self.closed = True
+                raise MatlabTerminated('Connection to the engine server lost: {}'.format(e))
+        if out and stdout is not None:
+            stdout.write(out)
+        if err and stderr is not None:
+            stderr.write(err)
+        if status == 'ok':
+            return value
+        if status == 'terminated':
+            self.closed = True
+            raise MatlabTerminated(value)
+        raise RemoteEngineError(value)
+
+    def eval(self, code: str, nargout: int = 1, stdout = None, stderr = None, background = False):
+        if background:
+            return FakeFuture(lambda: self.request(stdout, stderr, 'eval', code, nargout))
+        return self.request(stdout, stderr, 'eval', code, nargout)
+
+    def run(self, script_path: str, nargout: int = 0, stdout = None, stderr = None, background = False):
+        if background:
+            return FakeFuture(lambda: self.request(stdout, stderr, 'run', script_path, nargout))
+        return self.request(stdout, stderr, 'run', script_path, nargout)
+
+    def server_status(self) -> dict:
+        return self.request(None, None, 'status')
+
+    def quit(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.conn.send(('bye',))
+            except OSError:
+                pass
+            self.conn.close()
+
+def remote_engine_factory(address = default_address, authkey: bytes = None):
+    # Engine factory with the signature of start_matlab, opening sessions
+    def factory(background: bool = False):
+        if background:
+            return FakeFuture(lambda: RemoteEngine(address, authkey, on_queued=print_queued))
+        return RemoteEngine(address, authkey, on_queued=print_queued)
+    return factory
+
+def print_queued(position: int):
+    print('All MATLAB engines of the server are busy, waiting ({} in line)'.format(position))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MATLAB engine server shared by several terminals')
+    parser.add_argument('--address', default=default_address,
+                        help='HOST:PORT or Unix socket path to listen on (default {})'.format(default_address))
+    parser.add_argument('--engines', type=int, default=4, help='maximum number of engines running at once')
+    parser.add_argument('--warm', type=int, default=1, help='engines started before the first session')
+    parser.add_argument('--authkey-file', default=None,
+                        help='file holding the key shared with the clients (default {})'.format(default_key_path()))
+    parser.add_argument('--fake', action='store_true',
+                        help='serve engine.FakeEngine stand-ins instead of MATLAB, for testing')
+    args = parser.parse_args()
+
+    factory = fake_engine_factory() if args.fake else start_matlab
+    server = EngineServer(args.address, factory, args.engines, args.warm,
+                          load_authkey(args.authkey_file, create=True))
+    print('Serving MATLAB engines on {} (at most {}, {} warm)'.format(args.address, args.engines, args.warm))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        sys.exit(0)
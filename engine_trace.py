@@ -0,0 +1,422 @@
+# Recording of engine calls and deterministic replay without MATLAB
+#
+# A TraceRecorder wraps the engine of a MatlabInterface and logs every call
+# (eval, run, workspace get/set) with its arguments, result, output, error
+# and duration, and every line typed at a prompt, as gzipped JSON lines. A
+# ReplayEngine then serves the recorded responses in order, optionally with
+# the recorded or scaled latency, so a session recorded on a machine with
+# MATLAB can be re-run headlessly as a benchmark anywhere:
+#
+#   python engine_trace.py replay session.trace [--latency recorded|none|SCALE]
+#   python engine_trace.py compare before.json after.json
+#
+# Records are numbered when the call is issued and written when it completes,
+# so background calls are replayed in the order they were issued. Their output
+# is replayed at once rather than streamed. Calls of the background jobs, the
+# parallel batches and the tab completion are made on other engines or
+# threads and are not part of the replay.
+
+import sys
+import json
+import gzip
+import atexit
+import argparse
+import threading
+from io import StringIO
+from time import perf_counter, sleep
+from contextlib import redirect_stdout
+from engine import matlab, MatlabTerminated, EngineCall, FakeFuture
+from helper import redirect_stdin
+
+trace_version = 1
+
+# Kinds of the records served by a ReplayEngine
+engine_kinds = ('eval', 'run', 'workspace_get', 'workspace_set')
+
+# Default of ReplayEngine.serve, None being a valid (missing) record
+unclaimed = object()
+
+class TraceMismatch(Exception):
+    pass
+
+class MatlabReplayError(Exception):
+    # Error raised by MATLAB during the recording
+    pass
+
+def encode_value(value):
+    # JSON form of an engine value; matlab arrays keep their class
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {'$dict': {str(key): encode_value(item) for key, item in value.items()}}
+    if matlab is not None and type(value).__module__.startswith('matlab'):
+        try:
+            return {'$matlab': type(value).__name__, 'rows': [list(row) for row in value]}
+        except TypeError:
+            pass
+    return {'$repr': repr(value)}
+
+def decode_value(value):
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    if isinstance(value, dict):
+        if '$dict' in value:
+            return {key: decode_value(item) for key, item in value['$dict'].items()}
+        if '$matlab' in value:
+            if matlab is not None:
+                return getattr(matlab, value['$matlab'])(value['rows'])
+            return value['rows']
+        return value.get('$repr')
+    return value
+
+def load_trace(path: str) -> list:
+    # Records in the order the calls were issued
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    header = records[0] if records and records[0].get('k') == 'header' else None
+    if header is None or header.get('version') != trace_version:
+        raise ValueError('{} is not a trace of version {}'.format(path, trace_version))
+    return sorted(records[1:], key=lambda record: record['s'])
+
+class TeeStream:
+    # Forwards the output of a call, keeping a copy for the trace
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+
+    def write(self, text: str) -> int:
+        self.chunks.append(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+    def getvalue(self) -> str:
+        return ''.join(self.chunks)
+
+class TraceRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.calls = 0
+        self.write({'k': 'header', 'version': trace_version, 's': -1})
+        atexit.register(self.close)
+
+    def next_seq(self) -> int:
+        with self.lock:
+            self.seq = self.seq + 1
+            return self.seq
+
+    def write(self, record: dict):
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def record_call(self, seq: int, kind: str, args: list, result, out, err, error, duration: float):
+        record = {'k': kind, 's': seq, 'a': args, 't': round(duration, 6)}
+        if result is not None:
+            record['r'] = encode_value(result)
+        if out is not None and out.chunks:
+            record['o'] = out.getvalue()
+        if err is not None and err.chunks:
+            record['e'] = err.getvalue()
+        if error is not None:
+            record['x'] = {'terminated': isinstance(error, MatlabTerminated), 'message': str(error)}
+        self.calls = self.calls + 1
+        self.write(record)
+
+    def record_input(self, prompt: str, line: str):
+        self.write({'k': 'input', 's': self.next_seq(), 'p': prompt, 'r': line})
+
+    def wrap(self, engine):
+        if engine is None or isinstance(engine, TracingEngine):
+            return engine
+        return TracingEngine(engine, self)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def untraced(engine):
+    return engine.engine if isinstance(engine, TracingEngine) else engine
+
+class TracedFuture:
+    # Future of a background call, recorded once it has completed
+    def __init__(self, future, on_done):
+        self.future = future
+        self.on_done = on_done
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def cancel(self) -> bool:
+        return self.future.cancel()
+
+    def result(self, timeout: float = None):
+        try:
+            value = self.future.result(timeout)
+        except TimeoutError:
+            raise
+        except Exception as e:
+            self.complete(None, e)
+            raise
+        self.complete(value, None)
+        return value
+
+    def complete(self, value, error):
+        if self.on_done is not None:
+            on_done, self.on_done = self.on_done, None
+            on_done(value, error)
+
+    def __getattr__(self, name: str):
+        return getattr(self.future, name)
+
+class TracingEngine:
+    class Workspace:
+        def __init__(self, owner):
+            self.owner = owner
+
+        def __getitem__(self, name):
+            return self.owner.call('workspace_get', [name], None, None, False,
+                                   lambda out, err: self.owner.engine.workspace[name])
+
+        def __setitem__(self, name, value):
+            # Only the name is kept, the replay has nothing to return
+            self.owner.call('workspace_set', [name], None, None, False,
+                            lambda out, err: self.owner.engine.workspace.__setitem__(name, value))
+
+        def __contains__(self, name):
+            return name in self.owner.engine.workspace
+
+    def __init__(self, engine, recorder: TraceRecorder):
+        self.engine = engine
+        self.recorder = recorder
+        self.workspace = self.Workspace(self)
+
+    def call(self, kind: str, args: list, stdout, stderr, background: bool, start_call):
+        seq = self.recorder.next_seq()
+        out = TeeStream(stdout) if stdout is not None else None
+        err = TeeStream(stderr) if stderr is not None else None
+        start = perf_counter()
+
+        def done(value, error):
+            self.recorder.record_call(seq, kind, args, value, out, err, error, perf_counter() - start)
+        try:
+            result = start_call(out, err)
+        except Exception as e:
+            done(None, e)
+            raise
+        if background:
+            return TracedFuture(result, done)
+        done(result, None)
+        return result
+
+    def eval(self, code: str, nargout: int = 1, stdout = None, stderr = None, background = False):
+        return self.call('eval', [code, nargout], stdout, stderr, background, lambda out, err: self.engine.eval(
+            code, nargout=nargout, stdout=out, stderr=err, background=background))
+
+    def run(self, script_path: str, nargout: int = 0, stdout = None, stderr = None, background = False):
+        return self.call('run', [script_path], stdout, stderr, background, lambda out, err: self.engine.run(
+            script_path, nargout=nargout, stdout=out, stderr=err, background=background))
+
+    def quit(self):
+        return self.engine.quit()
+
+    def __getattr__(self, name: str):
+        return getattr(self.engine, name)
+
+class ReplayEngine:
+    # Serves the recorded responses. A call is matched with the first unused
+    # record of the same kind and arguments within window records, so calls
+    # made by other threads in a different order still find theirs. Calls
+    # without a record count as mismatches (or raise TraceMismatch if strict)
+    # and return None
+    class Workspace:
+        def __init__(self, owner):
+            self.owner = owner
+
+        def __getitem__(self, name):
+            return self.owner.serve('workspace_get', [name], None, None)
+
+        def __setitem__(self, name, value):
+            self.owner.serve('workspace_set', [name], None, None)
+
+        def __contains__(self, name):
+            return True
+
+    def __init__(self, records: list, latency = None, window: int = 64, strict: bool = False):
+        # latency: None to answer at once, or a factor of the recorded durations
+        self.records = [record for record in records if record['k'] in engine_kinds]
+        self.used = [False] * len(self.records)
+        self.position = 0
+        self.latency = latency
+        self.window = window
+        self.strict = strict
+        self.mismatches = 0
+        self.lock = threading.Lock()
+        self.call_log = []
+        self.workspace = self.Workspace(self)
+
+    @property
+    def calls(self) -> int:
+        return len(self.call_log)
+
+    def engine_time(self) -> float:
+        return sum(call.duration for call in self.call_log)
+
+    def unused(self) -> int:
+        return self.used.count(False)
+
+    def claim(self, kind: str, args: list):
+        with self.lock:
+            end = min(len(self.records), self.position + self.window)
+            for i in range(self.position, end):
+                record = self.records[i]
+                if not self.used[i] and record['k'] == kind and record['a'] == args:
+                    self.used[i] = True
+                    while self.position < len(self.records) and self.used[self.position]:
+                        self.position = self.position + 1
+                    return record
+            self.mismatches = self.mismatches + 1
+        if self.strict:
+            raise TraceMismatch('No recorded {} {!r} near record {}'.format(kind, args, self.position))
+        return None
+
+    def serve(self, kind: str, args: list, stdout, stderr, record = unclaimed):
+        start = perf_counter()
+        if record is unclaimed:
+            record = self.claim(kind, args)
+        try:
+            if record is None:
+                return None
+            if self.latency:
+                sleep(record['t'] * self.latency)
+            if stdout is not None and 'o' in record:
+                stdout.write(record['o'])
+            if stderr is not None and 'e' in record:
+                stderr.write(record['e'])
+            error = record.get('x')
+            if error is not None:
+                if error['terminated']:
+                    raise MatlabTerminated(error['message'])
+                raise MatlabReplayError(error['message'])
+            return decode_value(record.get('r'))
+        finally:
+            self.call_log.append(EngineCall(kind, tuple(args), perf_counter() - start))
+
+    def call(self, kind: str, args: list, stdout, stderr, background: bool):
+        if background:
+            # Claimed now, in the order of the calls
+            record = self.claim(kind, args)
+            return FakeFuture(lambda: self.serve(kind, args, stdout, stderr, record))
+        return self.serve(kind, args, stdout, stderr)
+
+    def eval(self, code: str, nargout: int = 1, stdout = None, stderr = None, background = False):
+        return self.call('eval', [code, nargout], stdout, stderr, background)
+
+    def run(self, script_path: str, nargout: int = 0, stdout = None, stderr = None, background = False):
+        return self.call('run', [script_path], stdout, stderr, background)
+
+    def quit(self):
+        pass
+
+def replay(path: str, latency = None, show_output: bool = False) -> dict:
+    # Re-runs the recorded session: the typed lines are fed to the terminal
+    # and the engine calls are answered from the trace
+    from matlab_interface import MatlabInterface
+    records = load_trace(path)
+    lines = ''.join(record['r'] + '\n' for record in records if record['k'] == 'input')
+    engine = ReplayEngine(records, latency)
+    # A crash of the recording restarted the engine, whose calls follow in the trace
+    interface = MatlabInterface(engine, engine_factory=lambda background=False: engine)
+    interface.clear = lambda: None
+    out = sys.stdout if show_output else StringIO()
+    start = perf_counter()
+    with redirect_stdout(out), redirect_stdin(StringIO(lines)):
+        while True:
+            try:
+                command = input().strip()
+            except EOFError:
+                break
+            if command and not interface.handle_command(command):
+                break
+    wall = perf_counter() - start
+    interface.jobs.close()
+    calls = {}
+    for call in engine.call_log:
+        calls[call.kind] = calls.get(call.kind, 0) + 1
+    return {'trace': path, 'calls': calls, 'total_calls': engine.calls, 'wall': wall,
+            'engine_time': engine.engine_time(), 'python_time': wall - engine.engine_time(),
+            'mismatches': engine.mismatches, 'unused': engine.unused()}
+
+def summary(result: dict) -> str:
+    lines = ['{}: {} call(s), {:.3f} s in Python, {:.3f} s in the engine, {} mismatch(es), '
+             '{} record(s) unused'.format(result['trace'], result['total_calls'], result['python_time'],
+                                          result['engine_time'], result['mismatches'], result['unused'])]
+    for kind, count in sorted(result['calls'].items()):
+        lines.append('  {:<14} {:>8}'.format(kind, count))
+    return '\n'.join(lines)
+
+def compare(before: dict, after: dict) -> str:
+    lines = ['{:<14} {:>10} {:>10} {:>10}'.format('', 'before', 'after', 'delta')]
+    for kind in sorted(set(before['calls']) | set(after['calls'])):
+        a = before['calls'].get(kind, 0)
+        b = after['calls'].get(kind, 0)
+        lines.append('{:<14} {:>10} {:>10} {:>+10}'.format(kind, a, b, b - a))
+    lines.append('{:<14} {:>10} {:>10} {:>+10}'.format(
+        'calls', before['total_calls'], after['total_calls'], after['total_calls'] - before['total_calls']))
+    ratio = after['python_time'] / before['python_time'] if before['python_time'] else 0
+    lines.append('{:<14} {:>10.3f} {:>10.3f} {:>+10.3f}  ({:.2f}x)'.format(
+        'python s', before['python_time'], after['python_time'],
+        after['python_time'] - before['python_time'], ratio))
+    lines.append('{:<14} {:>10} {:>10} {:>+10}'.format(
+        'mismatches', before['mismatches'], after['mismatches'], after['mismatches'] - before['mismatches']))
+    return '\n'.join(lines)
+
+def parse_latency(text: str):
+    if text == 'none':
+        return None
+    if text == 'recorded':
+        return 1.0
+    return float(text)
+
+def load_result(path: str, latency) -> dict:
+    # A result saved by replay --save, or a trace replayed now
+    if path.endswith('.json'):
+        with open(path) as f:
+            return json.load(f)
+    return replay(path, latency)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded terminal sessions without MATLAB')
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help='re-run a recorded session')
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--latency', default='none',
+                               help="'none' (default), 'recorded' or a factor of the recorded durations")
+    replay_parser.add_argument('--repeat', type=int, default=1, help='keep the fastest of N replays')
+    replay_parser.add_argument('--save', metavar='FILE', help='save the result as JSON, for compare')
+    replay_parser.add_argument('--output', action='store_true', help='print the output of the session')
+    compare_parser = commands.add_parser('compare', help='compare two replays (saved results or traces)')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--latency', default='none')
+    args = parser.parse_args()
+
+    latency = parse_latency(args.latency)
+    if args.command == 'replay':
+        results = [replay(args.trace, latency, args.output) for _ in range(max(1, args.repeat))]
+        result = min(results, key=lambda result: result['python_time'])
+        print(summary(result))
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(result, f, indent=1)
+    else:
+        print(compare(load_result(args.before, latency), load_result(args.after, latency)))
@@ -1,6 +1,12 @@
 from typing import Any
 from collections import namedtuple
+from array import array
+from bisect import bisect_right
+import locale
+import mmap
+import os
 import re
+import sys
 
 class IndexedFile:
     class __IndexedPosition(namedtuple('IdxedPos', "pos idx")):
@@ -79,8 +85,109 @@ class IndexedFile:
             self.cur_idx = idxed_pos.idx
         return ret
     
+class MappedIndexedFile:
+    # Drop-in replacement of IndexedFile. The file is memory-mapped once and
+    # the offsets of the line starts are indexed, so line N and the line
+    # containing an offset are found in O(1) and O(log N). Decoded lines are
+    # cached, so seeking back and re-reading a loop body costs no decoding.
+    # Positions returned by tell are plain byte offsets
+    def __init__(self, path: str, encoding: str = None):
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b''
+        # Start of every line, followed by the end of the file
+        self.offsets = array('Q', [0])
+        pos = self.data.find(b'\n')
+        while pos != -1:
+            self.offsets.append(pos + 1)
+            pos = self.data.find(b'\n', pos + 1)
+        if self.offsets[-1] != len(self.data):
+            self.offsets.append(len(self.data))
+        self.n_lines = len(self.offsets) - 1
+        self.lines = [None] * self.n_lines
+        self.pos = 0
+        self.cur_idx = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, trace):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __len__(self) -> int:
+        return self.n_lines
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def line(self, idx: int) -> str:
+        # Line idx (0-based), decoded once
+        line = self.lines[idx]
+        if line is None:
+            raw = self.data[self.offsets[idx]:self.offsets[idx + 1]]
+            line = raw.decode(self.encoding).replace('\r\n', '\n')
+            self.lines[idx] = line
+        return line
+
+    def line_index(self, offset: int) -> int:
+        # Index of the line containing offset
+        return bisect_right(self.offsets, offset) - 1
+
+    def readline(self) -> str:
+        idx = self.cur_idx
+        if idx >= self.n_lines:
+            return ''
+        offsets = self.offsets
+        line = self.lines[idx]
+        if self.pos != offsets[idx]:
+            # In the middle of the line
+            raw = self.data[self.pos:offsets[idx + 1]]
+            line = raw.decode(self.encoding).replace('\r\n', '\n')
+        elif line is None:
+            line = self.line(idx)
+        self.pos = offsets[idx + 1]
+        self.cur_idx = idx + 1
+        return line
+
+    def readlines(self) -> list:
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            line = self.readline()
+        return lines
+
+    def read(self, size: int = -1) -> str:
+        end = len(self.data) if size < 0 else min(self.pos + size, len(self.data))
+        text = self.data[self.pos:end].decode(self.encoding).replace('\r\n', '\n')
+        self.seek(end)
+        return text
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, pos) -> int:
+        # Also accepts the positions returned by IndexedFile.tell
+        pos = int(getattr(pos, 'pos', pos))
+        self.pos = pos
+        self.cur_idx = self.line_index(pos) if pos < len(self.data) else self.n_lines
+        return pos
+
 def openIndexedFile(path):
-    return IndexedFile(path)
+    return MappedIndexedFile(path)
 
 rb_extractor = re.compile(r'\((.*)\)')
 sb_extractor = re.compile(r'\[(.*)\]')
@@ -91,6 +198,30 @@ def extArgsInRdBrac(expr: str) -> list:
 def extArgsInSqBrac(expr: str) -> list:
     return re.findall(sb_extractor, expr)[0].split(',')
 
+def cache_path(*parts) -> str:
+    # Path in the cache folder of pymatlab (~/.cache/pymatlab by default)
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'pymatlab', *parts)
+
+def matlab_quote(text: str) -> str:
+    # MATLAB char literal of text
+    return "'{}'".format(text.replace("'", "''"))
+
+def cd_cmd(folder: str) -> str:
+    return 'cd({});'.format(matlab_quote(folder))
+
+class redirect_stdin:
+    # Like contextlib.redirect_stdout, for the lines read by input()
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __enter__(self):
+        self.saved = sys.stdin
+        sys.stdin = self.stream
+
+    def __exit__(self, type, value, trace):
+        sys.stdin = self.saved
+
 if __name__ == "__main__":
     a = IndexedFile._IndexedFile__IndexedPosition(1, 2)
     b = IndexedFile._IndexedFile__IndexedPosition(5, 3)
@@ -0,0 +1,80 @@
+# Typed transfer of the values typed at an input() prompt
+#
+# Numeric literals (scalars, vectors, matrices) are parsed in Python and sent
+# with a single workspace write, instead of being formatted into MATLAB source
+# which MATLAB then has to parse again. Strings are sent as native values, so
+# no quoting is involved. Anything else is left to an eval.
+
+import re
+
+try:
+    import matlab
+except ImportError:
+    matlab = None
+
+# Characters of numeric literals, including Inf and NaN in any case
+numeric_matcher = re.compile(r'[0-9.eE+\-,;\s\[\]InfNaina]+')
+
+def parse_numeric(text: str):
+    # Returns the rows of a numeric literal ('3', '[1 2 3]', '[1, 2; 3, 4]'),
+    # or None when the text is not one and must be evaluated by MATLAB
+    text = text.strip()
+    if not numeric_matcher.fullmatch(text):
+        return None
+    if text[0] == '[' and text[-1] == ']':
+        text = text[1:-1]
+    if '[' in text or ']' in text:
+        return None
+    rows = []
+    for row in text.replace('\n', ';').split(';'):
+        items = row.replace(',', ' ').split()
+        if not items:
+            continue
+        try:
+            rows.append([float(item) for item in items])
+        except ValueError:
+            # e.g. '1-2', an expression
+            return None
+    if any(len(row) != len(rows[0]) for row in rows):
+        return None
+    return rows
+
+def to_engine_value(rows: list):
+    # Scalars become Python floats, which the engine turns into doubles
+    if len(rows) == 1 and len(rows[0]) == 1:
+        return rows[0][0]
+    if not rows:
+        return matlab.double([]) if matlab is not None else []
+    return matlab.double(rows) if matlab is not None else rows
+
+def matlab_string(literal: str) -> str:
+    # Value of a MATLAB char or string literal, e.g. an input prompt
+    literal = literal.strip()
+    if len(literal) >= 2 and literal[0] == literal[-1] and literal[0] in '\'"':
+        quote = literal[0]
+        literal = literal[1:-1].replace(quote * 2, quote)
+    return literal.replace('\\n', '\n')
+
+def split_args(args: str) -> list:
+    # Splits the arguments of a call on the commas outside of quotes and
+    # brackets, e.g. "'a, b: ', 's'" -> ["'a, b: '", "'s'"]
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, c in enumerate(args):
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in '\'"' and (c == '"' or i == 0 or not (args[i - 1].isalnum() or args[i - 1] in ')]}\'_.')):
+            # A quote after a value is the transpose operator
+            quote = c
+        elif c in '([{':
+            depth = depth + 1
+        elif c in ')]}':
+            depth = depth - 1
+        elif c == ',' and depth == 0:
+            parts.append(args[start:i].strip())
+            start = i + 1
+    parts.append(args[start:].strip())
+    return [part for part in parts if part]
@@ -0,0 +1,177 @@
+# Background jobs of the asynchronous REPL
+#
+# A command ending with '&' becomes a job, run through a background call on an
+# engine of its own, so the engine of the terminal stays free for inspecting
+# and preparing work meanwhile. Job engines are started on demand and kept for
+# the next jobs, and are cleared before each job, so a job does not see the
+# workspace of the previous ones. The output of every job is kept in a bounded buffer, which
+# drops the oldest output once full.
+
+import threading
+from collections import deque
+from time import perf_counter
+from engine import start_matlab, MatlabTerminated
+from helper import cd_cmd
+
+class JobOutput:
+    def __init__(self, max_bytes: int = 1 << 20):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.size = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        with self.lock:
+            self.chunks.append(text)
+            self.size = self.size + len(text)
+            while self.size > self.max_bytes:
+                # Only the tail of the output is kept
+                excess = self.size - self.max_bytes
+                head = self.chunks[0]
+                if len(head) <= excess:
+                    self.chunks.popleft()
+                    cut = len(head)
+                else:
+                    self.chunks[0] = head[excess:]
+                    cut = excess
+                self.size = self.size - cut
+                self.dropped = self.dropped + cut
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self) -> str:
+        with self.lock:
+            text = ''.join(self.chunks)
+        if self.dropped:
+            text = '[{} byte(s) of earlier output dropped]\n{}'.format(self.dropped, text)
+        return text
+
+class Job:
+    # status: 'starting' (waiting for an engine), 'running', 'done', 'error'
+    # (handled by MATLAB), 'cancelled' or 'terminated' (engine crashed)
+    def __init__(self, job_id: int, command: str, max_output: int):
+        self.id = job_id
+        self.command = command
+        self.status = 'starting'
+        self.output = JobOutput(max_output)
+        self.errors = JobOutput(max_output)
+        self.future = None
+        self.cancelled = False
+        self.reported = False
+        self.start = perf_counter()
+        self.end = None
+        self.finished = threading.Event()
+
+    def done(self) -> bool:
+        return self.finished.is_set()
+
+    def duration(self) -> float:
+        return (self.end or perf_counter()) - self.start
+
+    def summary(self) -> str:
+        size = self.output.size + self.output.dropped
+        return '[{}] {:<11} {:>9.1f} s {:>10} B  {}'.format(
+            self.id, self.status, self.duration(), size, self.command)
+
+class JobManager:
+    def __init__(self, engine_factory = start_matlab, max_output: int = 1 << 20):
+        self.engine_factory = engine_factory
+        self.max_output = max_output
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.next_id = 1
+        self.idle_engines = []
+
+    def submit(self, command: str, folder: str = None) -> Job:
+        # command is a script path (*.m) or MATLAB code. folder is the current
+        # folder of the terminal, where the job starts
+        with self.lock:
+            job = Job(self.next_id, command, self.max_output)
+            self.jobs[job.id] = job
+            self.next_id = self.next_id + 1
+        threading.Thread(target=self.run, args=(job, folder), daemon=True).start()
+        return job
+
+    def acquire_engine(self):
+        with self.lock:
+            if self.idle_engines:
+                return self.idle_engines.pop()
+        return self.engine_factory()
+
+    def run(self, job: Job, folder: str):
+        eng = None
+        try:
+            eng = self.acquire_engine()
+            setup = 'clear;'
+            if folder:
+                setup = 'clear;\n' + cd_cmd(folder)
+            eng.eval(setup, nargout=0)
+            with self.lock:
+                if job.cancelled:
+                    return
+                job.status = 'running'
+                if job.command.endswith('.m'):
+                    job.future = eng.run(job.command, nargout=0, stdout=job.output,
+                                         stderr=job.errors, background=True)
+                else:
+                    job.future = eng.eval(job.command, nargout=0, stdout=job.output,
+                                          stderr=job.errors, background=True)
+            job.future.result()
+            job.status = 'done'
+        except MatlabTerminated:
+            job.status = 'terminated'
+            eng = None
+        except Exception as e: # The other exceptions are handled by Matlab
+            if job.cancelled:
+                job.status = 'cancelled'
+            else:
+                job.status = 'error'
+                if not job.errors.size:
+                    job.errors.write(str(e))
+        finally:
+            if job.cancelled and job.status in ('starting', 'running'):
+                job.status = 'cancelled'
+            job.end = perf_counter()
+            if eng is not None:
+                with self.lock:
+                    self.idle_engines.append(eng)
+            job.finished.set()
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.done():
+            return False
+        with self.lock:
+            job.cancelled = True
+            future = job.future
+        if future is not None:
+            future.cancel()
+        return True
+
+    def get(self, job_id: int) -> Job:
+        return self.jobs.get(job_id)
+
+    def running(self) -> list:
+        return [job for job in self.jobs.values() if not job.done()]
+
+    def newly_finished(self) -> list:
+        # The jobs finished since the last call
+        finished = [job for job in self.jobs.values() if job.done() and not job.reported]
+        for job in finished:
+            job.reported = True
+        return finished
+
+    def close(self):
+        for job in self.running():
+            self.cancel(job.id)
+        with self.lock:
+            engines = self.idle_engines
+            self.idle_engines = []
+        for eng in engines:
+            try:
+                eng.quit()
+            except Exception:
+                pass
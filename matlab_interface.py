@@ -12,36 +12,31 @@ import sys
 from io import StringIO
 from textwrap import dedent
 import argparse
-from time import sleep
+import asyncio
+import threading
+from collections import deque
+from time import perf_counter
 from helper import *
+from engine import matlab, start_matlab, MatlabTerminated
+from streaming import stream_call
+from workspace import WorkspaceSnapshot, WorkspaceTracker, describe, whos_expr, parse_whos, format_size
+from query_cache import QueryCache, mutable_scopes, not_cached
+from profiler import ScriptProfiler, ProfiledEngine
+from jobs import JobManager
+from checkpoint import WorkspaceCheckpointer
+from completion import SymbolIndex, install_completer
+from engine_trace import untraced
+from input_values import parse_numeric, to_engine_value, matlab_string, split_args
+from batch_runner import BatchRunner, run_captured
+from script_parser import parse_script, ScriptSyntaxError
+from script_compiler import *
 
-global import_fail
-try: # Check if the Matlab Engine is installed
-    import matlab.engine
-    from matlab.engine import RejectedExecutionError as MatlabTerminated
-except ImportError:
+# Check if the Matlab Engine is installed
+import_fail = matlab is None
+if import_fail:
     print("MATLAB Engine for Python cannot be detected. Please install it for the extension to work.")
-    import_fail = True
-else:
-    import_fail = False
-
-# For lauch animation
-frames = [
-    "[ =    ]",
-    "[  =   ]",
-    "[   =  ]",
-    "[    = ]",
-    "[     =]",
-    "[    = ]",
-    "[   =  ]",
-    "[  =   ]",
-    "[ =    ]",
-    "[=     ]",
-]
 
 # For running script (sr: script runner)
-initiators = ['if', 'while', 'for', 'switch', 'function']
-terminators = ['else', 'elseif', 'end', 'case', 'otherwise']
 sr_parser = argparse.ArgumentParser()
 sr_parser.add_argument("script", help="path of the script to run")
 sr_parser.add_argument("-i", "--interactive", 
@@ -49,62 +44,284 @@ sr_parser.add_argument("-i", "--interactive",
                                Activate this option if your script has pause''',
                        action="store_true")
 sr_parser.add_argument("-d", "--debug", help="Debug the script", action="store_true")
+sr_parser.add_argument("--no-batch", 
+                       help='''Step through every statement and loop iteration from Python
+                               instead of sending batches and non-interactive blocks to MATLAB''',
+                       action="store_true")
+sr_parser.add_argument("--profile",
+                       help='''Run the script interactively and print the time spent in MATLAB
+                               and in Python for each line. Every statement and loop iteration is
+                               stepped through (as with --no-batch), so each line is timed on its own''',
+                       action="store_true")
+sr_parser.add_argument("--profile-json", metavar="FILE", help="Also save the profile as JSON (implies --profile)")
+sr_parser.add_argument("--profile-trace", metavar="FILE",
+                       help="Also save a Chrome trace of the run (implies --profile)")
 
-class MatlabInterface:
-    global import_fail
+# For running independent scripts in parallel
+batch_parser = argparse.ArgumentParser(prog='batch')
+batch_parser.add_argument("scripts", nargs='+', help="paths of the scripts to run")
+batch_parser.add_argument("-j", "--jobs", type=int, default=1,
+                          help="number of MATLAB engines running scripts at the same time")
+
+def parse_command(parser: argparse.ArgumentParser, tokens: list):
+    # argparse exits on a bad argument or on --help, after printing the usage
+    # or the error. The terminal stays up: None is returned instead
+    try:
+        return parser.parse_args(tokens)
+    except SystemExit:
+        return None
 
-    def __init__(self):
+def is_batch_command(cmd_tokens: list) -> bool:
+    # Tells the batch command apart from MATLAB's own batch function
+    if cmd_tokens[0] != 'batch' or len(cmd_tokens) < 2:
+        return False
+    return all(token.endswith('.m') or token.startswith('-') or token.isdigit()
+               for token in cmd_tokens[1:])
+
+class MatlabInterface:
+    def __init__(self, engine = None, engine_factory = start_matlab, engine_pool = None,
+                 streaming = False, parse_cache = None, query_cache = None, checkpointer = None,
+                 recorder = None):
+        # engine: an already started engine (e.g. engine.FakeEngine), in which
+        # case MATLAB is not launched
+        # engine_factory: called to start a new engine, in the background at
+        # startup and synchronously after a crash
+        # engine_pool: optional engine_pool.EnginePool, whose standby engines
+        # replace a terminated engine instead of a cold start
+        # streaming: print the output of commands and scripts as it is produced
+        # parse_cache: optional parse_cache.ParseCache persisting parsed scripts
+        # query_cache: query_cache.QueryCache memoizing the interpreter's own
+        # queries (release, pwd, workspace listings), a default one if None
         # OS checks related work
         if os.name == 'nt':
             self.cls_str = 'cls'
         else:
             self.cls_str = 'clear'
+        self.engine_factory = engine_factory
+        self.engine_pool = engine_pool
+        self.recovery_times = []
+        self.batch_engines = []
+        self.streaming = streaming
+        self.first_output_times = []
+        self.auto_watch = False
+        self.workspace_tracker = WorkspaceTracker()
+        # engine_trace.TraceRecorder logging the engine calls and typed lines
+        self.recorder = recorder
+        self.eng = self.traced(engine)
+        self.debug_mode = False
+        self.debug_pause = False
+        # line -> number of passes of its breakpoint, for hit-count breakpoints
+        self.breakpoint_hits = {}
+        self.batch_statements = True
+        self.program_cache = {}
+        self.script_cache = {}
+        self.parse_cache = parse_cache
+        self.query_cache = query_cache if query_cache is not None else QueryCache()
+        self.profiler = None
+        self.jobs = JobManager(engine_factory)
+        # Manual checkpoints only, unless the checkpointer given is automatic
+        self.checkpoints = checkpointer if checkpointer is not None else WorkspaceCheckpointer()
+        # Index of the tab completion, once enabled by the terminal
+        self.symbols = None
+        self.at_prompt = False
+
+        # Commands needing the engine are queued until it is ready
+        self.engine_lock = threading.RLock()
+        self.engine_ready = threading.Event()
+        self.engine_future = None
+        self.startup_failed = False
+        self.pending = deque()
+        self.startup_time = perf_counter()
+        self.startup_metrics = {}
+        if engine is not None:
+            self.engine_ready.set()
+            return
         self.clear()
 
-        if not import_fail:
+        if not import_fail or engine_factory is not start_matlab:
             try:
-                future = matlab.engine.start_matlab(background=True)
-                print('Starting Matlab engine ', frames[-1], end = '', flush = True)
-                while not future.done():
-                    for i in range(len(frames)):
-                        sleep(0.5)
-                        print('\b\b\b\b\b\b\b\b{}'.format(frames[i]), end = '', flush = True)
-                self.clear()
-                self.eng = future.result()
-                intro = '''\
-                MATLAB Interactive Terminal (R{release})
-                
-                To get started, type one of these commands:
-                    helpwin          Provide access to help comments for all functions
-                    helpdesk         Open help browser
-                    demo             Access product examples in Help browser
-                
-                For product information, visit https://www.mathworks.com.
-                '''.format(release=self.release())
-                print(dedent(intro))
-
+                self.engine_future = self.engine_factory(background=True)
             except Exception as e:
-                self.clear()
                 print("MATLAB Engine for Python exited prematurely.")
                 print(e)
                 sys.exit()
-
+            print('Starting Matlab engine in the background. Commands are queued until it is ready.')
+            threading.Thread(target=self.wait_engine, daemon=True).start()
         else:
+            self.startup_failed = True
             print("Launching MATLAB failed: Error starting MATLAB process in MATLAB Engine for Python.")
-    
+
+    def wait_engine(self):
+        # Blocks on the future itself, so the engine is reported ready as soon
+        # as it has started
+        try:
+            eng = self.engine_future.result()
+        except Exception as e:
+            print("\nMATLAB Engine for Python exited prematurely.")
+            print(e)
+            self.startup_failed = True
+            self.engine_ready.set()
+            return
+
+        with self.engine_lock:
+            self.eng = self.traced(eng)
+            self.query_cache.invalidate()
+            self.startup_metrics['engine_ready'] = perf_counter() - self.startup_time
+            try:
+                self.print_intro()
+                while self.pending:
+                    self.run_command(self.pending.popleft())
+            finally:
+                self.engine_ready.set()
+
+    def print_intro(self):
+        intro = '''\
+            MATLAB Interactive Terminal (R{release})
+            
+            To get started, type one of these commands:
+                helpwin          Provide access to help comments for all functions
+                helpdesk         Open help browser
+                demo             Access product examples in Help browser
+            
+            For product information, visit https://www.mathworks.com.
+            '''.format(release=self.release())
+        print('\n' + dedent(intro))
+
+    def wait_ready(self) -> bool:
+        if not self.engine_ready.is_set():
+            print('Waiting for the MATLAB engine to start...')
+            self.engine_ready.wait()
+        return not self.startup_failed
+
+    def record_first_command(self, name: str):
+        if name not in self.startup_metrics:
+            self.startup_metrics[name] = perf_counter() - self.startup_time
+
+    def print_startup_metrics(self):
+        if not self.startup_metrics:
+            print('No startup metrics recorded')
+        for name in ('engine_ready', 'first_command', 'first_result'):
+            if name in self.startup_metrics:
+                print('{:<16}{:>10.3f} s'.format(name, self.startup_metrics[name]))
+
     def __del__(self):
-        if not import_fail:
+        if getattr(self, 'jobs', None) is not None:
+            self.jobs.close()
+        if getattr(self, 'engine_pool', None) is not None:
+            self.engine_pool.close()
+        for eng in getattr(self, 'batch_engines', []):
+            eng.quit()
+        if getattr(self, 'eng', None) is not None:
             self.eng.quit()
+        elif getattr(self, 'engine_future', None) is not None:
+            self.engine_future.cancel()
 
     def clear(self):
         os.system(self.cls_str)
 
     def release(self):
         release_str = "version('-release');"
-        res = self.eng.eval(release_str)
+        res = self.query(release_str, ('engine',))
         return res
 
+    def query(self, expr: str, scopes: tuple = mutable_scopes):
+        # Evaluates a side-effect-free expression, answered from the query
+        # cache while none of the scopes it depends on may have changed.
+        # Exceptions are raised as by eng.eval
+        value = self.query_cache.get(expr)
+        if value is not_cached:
+            value = self.eng.eval(expr, nargout=1)
+            self.query_cache.put(expr, value, scopes)
+        return value
+
+    def traced(self, eng):
+        return self.recorder.wrap(eng) if self.recorder is not None else eng
+
+    def read_input(self, prompt = '') -> str:
+        # Every line typed by the user, so recorded sessions can be replayed
+        line = input(prompt)
+        if self.recorder is not None:
+            self.recorder.record_input(prompt, line)
+        return line
+
+    def restart_engine(self):
+        print("MATLAB process terminated.")
+        start = perf_counter()
+        if self.engine_pool is not None:
+            print("Switching to a standby MATLAB Engine for Python...")
+            self.eng = self.traced(self.engine_pool.acquire())
+        else:
+            print("Restarting MATLAB Engine for Python...")
+            self.eng = self.traced(self.engine_factory())
+        self.query_cache.invalidate()
+        self.recovery_times.append(perf_counter() - start)
+        print("Restarted MATLAB process in {:.1f} s.".format(self.recovery_times[-1]))
+        if self.checkpoints.active:
+            # The workspace of the last checkpoint of the session comes back
+            self.restore_checkpoint()
+
+    def take_checkpoint(self, verbose = False):
+        start = perf_counter()
+        directory = self.checkpoints.directory
+        try:
+            saved, removed, n_bytes = self.checkpoints.checkpoint(self.eng)
+        except MatlabTerminated:
+            self.restart_engine()
+            return
+        except Exception as e:
+            print('Checkpoint failed: {}'.format(e))
+            return
+        if self.checkpoints.directory != directory:
+            print('{} is used by another session, checkpoints are saved to {}'.format(
+                directory, self.checkpoints.directory))
+        if verbose:
+            print('Checkpoint: {} variable(s) saved ({} byte(s)), {} removed in {:.2f} s, {}'.format(
+                len(saved), n_bytes, len(removed), perf_counter() - start, self.checkpoints.summary()))
+
+    def restore_checkpoint(self):
+        start = perf_counter()
+        try:
+            n_restored = self.checkpoints.restore(self.eng)
+        except MatlabTerminated:
+            print("MATLAB process terminated.")
+            return
+        except Exception as e:
+            print('Restore failed: {}'.format(e))
+            return
+        finally:
+            self.query_cache.invalidate(mutable_scopes)
+        print('Restored {} variable(s) from {} in {:.2f} s.'.format(
+            n_restored, self.checkpoints.directory, perf_counter() - start))
+
+    def after_statements(self, n_statements = 1):
+        if self.checkpoints.tick(n_statements):
+            self.take_checkpoint()
+
+    def run_streamed(self, start_call) -> bool:
+        # Runs a background engine call with its output written to the terminal
+        # as it is produced, instead of being buffered until the call returns
+        start = perf_counter()
+        self.query_cache.invalidate(mutable_scopes)
+        try:
+            future, sink, err_sink = stream_call(self.eng, start_call)
+            if sink.first_output is not None:
+                self.first_output_times.append(sink.first_output - start)
+            return True
+
+        except KeyboardInterrupt:
+            print("\nCancelled.")
+            return False
+
+        except MatlabTerminated:
+            self.restart_engine()
+            return False
+
+        except : # The other exceptions are handled by Matlab
+            return False
+
     def run_line(self, line: str, output = True):
+        # Any statement or condition may cd or modify the workspace
+        self.query_cache.invalidate(mutable_scopes)
         try:
             stream = StringIO()
             err_stream = StringIO()
@@ -113,41 +330,155 @@ class MatlabInterface:
                 output = stream.getvalue()
                 if output:
                     print(output)
+                self.after_statements()
                 return True
             else:
                 return self.eng.eval(line, nargout=1, stdout=stream, stderr=err_stream)
                 
         except MatlabTerminated:
             print(stream.getvalue(), err_stream.getvalue(), sep="\n")
-            print("MATLAB process terminated.")
-            print("Restarting MATLAB Engine for Python...")
-            self.eng = matlab.engine.start_matlab()
-            print("Restarted MATLAB process.")
+            self.restart_engine()
+            return False
+
+        except : # The other exceptions are handled by Matlab
+            print(stream.getvalue(), err_stream.getvalue(), sep="\n")
             return False
 
+    def run_internal(self, code: str, nargout = 0):
+        # Bookkeeping of the interpreter (e.g. the ranges of stepped loops):
+        # not a statement of the user, so it does not count for checkpoints.
+        # Returns False when MATLAB failed
+        self.query_cache.invalidate(mutable_scopes)
+        stream = StringIO()
+        err_stream = StringIO()
+        try:
+            result = self.eng.eval(code, nargout=nargout, stdout=stream, stderr=err_stream)
+            return True if nargout == 0 else result
+        except MatlabTerminated:
+            print(stream.getvalue(), err_stream.getvalue(), sep="\n")
+            self.restart_engine()
+            return False
         except : # The other exceptions are handled by Matlab
             print(stream.getvalue(), err_stream.getvalue(), sep="\n")
             return False
 
+    def run_selector(self, code: str):
+        # Runs an if/elseif or switch selector (see SELECT). Returns the index
+        # of the branch taken, 0 for none, or None when MATLAB failed
+        self.query_cache.invalidate(mutable_scopes)
+        stream = StringIO()
+        err_stream = StringIO()
+        try:
+            self.eng.eval(code, nargout=0, stdout=stream, stderr=err_stream)
+        except MatlabTerminated:
+            print(stream.getvalue(), err_stream.getvalue(), sep="\n")
+            self.restart_engine()
+            return None
+        except : # The other exceptions are handled by Matlab
+            print(select_marker.sub('', stream.getvalue()), err_stream.getvalue(), sep="\n")
+            return None
+        output = stream.getvalue()
+        match = select_marker.search(output)
+        # Conditions may display something
+        output = select_marker.sub('', output)
+        if output:
+            print(output)
+        return int(match.group(1)) if match else 0
+
+    def run_line_or_stop(self, code: str, node) -> bool:
+        # Runs a statement guarded by the condition of its breakpoint (see
+        # guarded_cmd). Returns True when the statement was not run, because the
+        # condition held or could not be evaluated, so the script must stop
+        self.query_cache.invalidate(mutable_scopes)
+        stream = StringIO()
+        err_stream = StringIO()
+        try:
+            self.eng.eval(code, nargout=0, stdout=stream, stderr=err_stream)
+        except MatlabTerminated:
+            print(stream.getvalue(), err_stream.getvalue(), sep="\n")
+            self.restart_engine()
+            return False
+        except : # The other exceptions are handled by Matlab
+            output = stream.getvalue()
+            print(batch_marker.sub('', output), err_stream.getvalue(), sep="\n")
+            if not batch_marker.search(output):
+                print('The breakpoint condition of line {} failed'.format(node.line_no))
+                return True
+            return False
+        output = stream.getvalue()
+        stopped = stop_marker.search(output) is not None
+        output = batch_marker.sub('', stop_marker.sub('', output))
+        if output:
+            print(output)
+        return stopped
+
     def run_script(self, script_path):
-        if not import_fail:
+        if self.eng is not None:
+            print("File: \"{}\"".format(script_path))
+            if self.streaming:
+                self.run_streamed(lambda stream, err_stream: self.eng.run(
+                    script_path, nargout=0, stdout=stream, stderr=err_stream, background=True))
+                return
+            self.query_cache.invalidate(mutable_scopes)
+            result = run_captured(self.eng, script_path)
+            if result.status == 'ok':
+                print(result.output)
+            else: # The other exceptions are handled by Matlab
+                print(result.output, result.errors, sep="\n")
+                if result.status == 'terminated':
+                    self.restart_engine()
 
-            try:
-                print("File: \"{}\"".format(script_path))
-                stream = StringIO()
-                err_stream = StringIO()
-                self.eng.run(script_path, nargout=0, stdout=stream, stderr=err_stream)
-                print(stream.getvalue())
+    def get_batch_engines(self, jobs: int) -> list:
+        # Batches run on their own engines, never on the one of the terminal,
+        # whose workspace is left alone. They are started in parallel and kept
+        # for the next batches
+        missing = jobs - len(self.batch_engines)
+        if missing > 0:
+            print('Starting {} additional MATLAB engine(s)...'.format(missing))
+            futures = [self.engine_factory(background=True) for _ in range(missing)]
+            self.batch_engines.extend(future.result() for future in futures)
+        return self.batch_engines[:jobs]
 
-            except MatlabTerminated:
-                print(stream.getvalue(), err_stream.getvalue(), sep="\n")
-                print("MATLAB process terminated.")
-                print("Restarting MATLAB Engine for Python...")
-                self.eng = matlab.engine.start_matlab()
-                print("Restarted MATLAB process.")
+    def run_scripts_parallel(self, script_paths: list, jobs: int, callback = None) -> list:
+        # Runs independent scripts across jobs engines and returns their
+        # batch_runner.ScriptResult, in the order of script_paths
+        folder = self.query('pwd', ('cwd',))
+        engines = self.get_batch_engines(max(1, min(jobs, len(script_paths))))
+        runner = BatchRunner(engines, self.engine_factory, folder)
+        try:
+            return runner.run(script_paths, callback)
+        finally:
+            # Terminated engines have been replaced by the runner
+            self.batch_engines[:len(runner.engines)] = runner.engines
 
-            except : # The other exceptions are handled by Matlab
-                print(stream.getvalue(), err_stream.getvalue(), sep="\n")
+    def run_batch_command(self, args):
+        def report(result):
+            print('==> {}: {} ({:.2f} s)'.format(result.path, result.status, result.duration))
+            if result.output:
+                print(result.output)
+            if result.errors:
+                print(result.errors)
+
+        start = perf_counter()
+        try:
+            results = self.run_scripts_parallel(args.scripts, args.jobs, report)
+        except KeyboardInterrupt:
+            print('Batch cancelled')
+            return
+        except MatlabTerminated:
+            self.restart_engine()
+            return
+        except Exception as e:
+            print(e)
+            return
+        wall_time = perf_counter() - start
+
+        print('{:<40} {:<12} {:>10}'.format('script', 'status', 'time (s)'))
+        for result in results:
+            print('{:<40} {:<12} {:>10.2f}'.format(result.path, result.status, result.duration))
+        total = sum(result.duration for result in results)
+        print('{} script(s) in {:.2f} s on {} engine(s), speedup {:.1f}x'.format(
+            len(results), wall_time, min(args.jobs, len(results)), total / wall_time if wall_time else 0))
 
 ######################### Experimental feature #########################
     def process_input(self, line) -> bool:
@@ -161,31 +492,53 @@ class MatlabInterface:
             expr = line
 
         # Extract input arguments
-        args = extArgsInRdBrac(expr)
+        found = rb_extractor.findall(expr)
+        args = split_args(found[0]) if found else []
         if not args:
             print('Not enough arguments for the input command')
             return False
-        
+        if len(args) > 1 and args[1].find('s') == -1:
+            print('Unrecognized argument{}'.format(args[1]))
+            return False
+
         # Get the input via python
-        prompt = eval(args[0])
-        user_input = input(prompt)
+        prompt = matlab_string(args[0])
+        if self.profiler is not None:
+            self.profiler.suspend()
+        user_input = self.read_input(prompt)
+        if self.profiler is not None:
+            self.profiler.resume()
 
         # Assign the input value to the variable
         if name:
-            if len(args) > 1:
-                if args[1].find('s') != -1:
-                    self.run_line("assignin('base','{}','{}')".format(name.strip(), user_input))
-                else:
-                    print('Unrecognized argument{}'.format(args[1]))
-                    return False
-            else:
-                self.run_line("assignin('base','{}',{})".format(name.strip(), user_input))
+            return self.assign_input(name.strip(), user_input, len(args) > 1)
         return True
 
-    def debug_loop(self, f) -> bool:
+    def assign_input(self, name: str, user_input: str, as_text: bool) -> bool:
+        # Text and numeric literals are transferred as values with a single
+        # workspace write. Other expressions are evaluated by MATLAB
+        if as_text:
+            value = user_input
+        else:
+            rows = parse_numeric(user_input)
+            if rows is None:
+                return self.run_line("assignin('base','{}',{})".format(name, user_input))
+            value = to_engine_value(rows)
+        self.query_cache.invalidate(('workspace',))
+        try:
+            self.eng.workspace[name] = value
+            return True
+        except MatlabTerminated:
+            self.restart_engine()
+            return False
+        except Exception as e:
+            print(e)
+            return False
+
+    def debug_loop(self) -> bool:
         while True:
             print('dbg >>> ', end = '')
-            dbg_cmd = input().strip()
+            dbg_cmd = self.read_input().strip()
             if dbg_cmd == 'exit':
                 return False
             elif dbg_cmd == 'step':
@@ -193,275 +546,384 @@ class MatlabInterface:
             elif dbg_cmd == 'continue' or dbg_cmd == 'c':
                 self.debug_pause = False
                 break
+            elif dbg_cmd == 'watch --changed':
+                self.watch_changed()
             elif dbg_cmd.startswith('watch'):
-                vars = self.run_line('who', output = False)
-                if not vars:
-                    print('There is no variable in the workspace')
-                    continue
-                try:
-                    var = dbg_cmd.split()[1]
-                    if var in vars:
-                        self.run_line(var)
-                    else:
-                        print('No variable named {}'.format(var))
-                except IndexError:
-                    for var in vars:
-                        # To make the output more readable
-                        self.run_line(var)
-                        # print('{}: {}'.format(var, self.eng.workspace[var]))  
+                self.watch(dbg_cmd.split()[1:])
+            elif dbg_cmd in ('autowatch on', 'autowatch off'):
+                self.auto_watch = dbg_cmd.endswith('on')
+                if self.auto_watch:
+                    self.watch_changed()
         return True
-        
-    def run_sequential(self, f) -> bool:
-        line = f.readline()
-        while line:
-            line = line.strip()
-            # empty line or comment
-            if line == '' or line[0] == '%':
-                line = f.readline()
-                continue
-
-            if self.debug_mode and self.debug_pause:
-                print('Stop at line {}:\n-> {}'.format(f.cur_idx, line))
-                if not self.debug_loop(f):
-                    return False
-                line = line.replace('dbg', '')
 
-            first_word = line.split()[0]
-            if first_word == 'if':
-                if not self.run_if_block(f, line.lstrip('if')):
-                    print('Error occurred around line {}:\n    {}'.format(f.cur_idx, line))
-                    return False
-            elif first_word == 'while':
-                if not self.run_while_block(f, line.lstrip('while')):
-                    print('Error occurred around line {}:\n    {}'.format(f.cur_idx, line))
-                    return False
-            elif first_word == 'for':
-                if not self.run_for_block(f, line.lstrip('for')):
-                    print('Error occurred around line {}:\n    {}'.format(f.cur_idx, line))
-                    return False
-            elif first_word == 'switch':
-                if not self.run_switch_block(f, line.lstrip('switch')):
-                    print('Error occurred around line {}:\n    {}'.format(f.cur_idx, line))
-                    return False
-            elif first_word == 'function':
-                f.seek(self.get_keyword_pos(f, 'end'))
+    def watch_changed(self):
+        # Only the fingerprints of the workspace are fetched, in one call. The
+        # values of the new and changed variables are then fetched and shown
+        try:
+            new, changed, possibly_changed, removed = self.workspace_tracker.update(self.eng, self.query)
+        except MatlabTerminated:
+            self.restart_engine()
+            return
+        except Exception as e:
+            print(e)
+            return
+        if not (new or changed or possibly_changed or removed):
+            print('No variable changed')
+        for label, variables in (('new', new), ('changed', changed)):
+            for info in variables:
+                try:
+                    value = self.workspace_tracker.value(self.eng, info)
+                    print('[{}] {}'.format(label, describe(info, value)))
+                except Exception:
+                    print('[{}] {}'.format(label, info.name))
+                    self.run_line(info.name)
+        for info in possibly_changed:
+            # Too large to be hashed at every watch: watch NAME shows it
+            print('[possibly changed] {} ({} {})'.format(info.name, format_size(info.size), info.cls))
+        for name in removed:
+            print('[removed] {}'.format(name))
 
-            elif first_word in terminators:
-                break
-            
-            else:
-                if line.endswith('dbg'):
-                    line = line.rstrip('dbg')
-                    self.debug_pause = self.debug_mode
-                    continue
+    def watch(self, names: list):
+        # The metadata of all variables comes in a single call, and only the
+        # values of the requested variables are fetched
+        try:
+            snapshot = WorkspaceSnapshot(self.eng, parse_whos(self.query(whos_expr, ('workspace',))))
+        except MatlabTerminated:
+            self.restart_engine()
+            return
+        except Exception as e:
+            print(e)
+            return
+        if not snapshot:
+            print('There is no variable in the workspace')
+            return
+        if not names:
+            print(snapshot.table())
+            return
+        for name in names:
+            if name not in snapshot:
+                print('No variable named {}'.format(name))
+                continue
+            try:
+                print(snapshot.describe(name))
+            except Exception:
+                # The value cannot be transferred to Python (e.g. objects),
+                # so let MATLAB display it
+                self.run_line(name)
 
-                elif line.find('input(') != -1:
-                    if not self.process_input(line):
-                        print('Error occurred around line {}:\n    {}'.format(f.cur_idx, line))
-                        return False
+    def check_breakpoint(self, node) -> bool:
+        if node.breakpoint and self.breakpoint_hit(node):
+            self.debug_pause = self.debug_mode
+        return self.stop_at(node)
 
-                elif line.find('pause') != -1 :
-                    line = line.replace('pause', '')
-                    output = self.run_line(line)
-                    input()
+    def count_hit(self, node) -> int:
+        count = self.breakpoint_hits.get(node.line_no, 0) + 1
+        self.breakpoint_hits[node.line_no] = count
+        return count
 
-                else:
-                    output = self.run_line(line)
+    def breakpoint_hit(self, node) -> bool:
+        # Plain and hit-count breakpoints are decided in Python. Conditions of
+        # statements are tested by EVAL_OR_STOP, the others here
+        count = self.count_hit(node)
+        breakpoint = node.breakpoint
+        if breakpoint is True:
+            return True
+        if breakpoint.hits is not None:
+            return count == breakpoint.hits
+        return bool(self.run_line(breakpoint.condition, output = False))
 
-            line = f.readline()
+    def stop_at(self, node) -> bool:
+        if self.debug_mode and self.debug_pause:
+            if self.profiler is not None:
+                # Neither the prompt nor the watches are charged to the line
+                self.profiler.leave()
+            print('Stop at line {}:\n-> {}'.format(node.line_no, node.text))
+            if self.auto_watch:
+                self.watch_changed()
+            return self.debug_loop()
         return True
-    
-    def get_keyword_pos(self, f, key: str, pos_max: int = -1) -> int:
-        init_pos = f.tell()
-        if key == 'end' and init_pos in self.pos_cache:
-            # print('cache hit')
-            return self.pos_cache[init_pos]
-        found = False
-        key_pos = init_pos
-        line = f.readline()
-        while line:
-            if pos_max != -1 and key_pos >= pos_max:
-                break
+
+    def run_batch(self, nodes, code, hits = ()) -> tuple:
+        # Runs consecutive native nodes with a single eval. Returns the number
+        # of nodes handled, the remaining ones have to be stepped through, and
+        # where a breakpoint of a guarded loop held: (line of the statement,
+        # [range variable, iteration, count] of its for loops), or None.
+        # hits: the statements whose hit count is kept engine-side
+        n_handled = 0
+        self.query_cache.invalidate(mutable_scopes)
+        profiler = self.profiler
+        if profiler is not None:
+            code = profiled_batch_code(nodes, self.debug_mode)
+        while n_handled < len(nodes):
+            stream = StringIO()
+            err_stream = StringIO()
+            counts = ''.join(hits_init_cmd.format(node.line_no, self.breakpoint_hits.get(node.line_no, 0))
+                             + '\n' for node in hits)
             try:
-                first_word = line.lstrip().split()[0]
-                if first_word in initiators:
-                    key_pos = self.get_keyword_pos(f, 'end', pos_max)
-                    if key_pos < 0:
-                        print('Syntax error: the end of if block is missing!')
-                        print('Error occurred around line {}:\n    {}'.format(f.cur_idx, line))
-                        f.seek(init_pos)
-                        return -2
-                    if first_word == 'function':
-                        signature = line.strip().split(' ', 1)[1]
-                        self.func_cache[f.tell()] = key_pos
-                    f.seek(key_pos)
-                    f.readline()
-                # 'elseif' is considered the same as 'else'
-                elif first_word.startswith(key):
-                    found = True
-                    break
-            except IndexError:
-                # the line is empty
-                pass
-            key_pos = f.tell()
-            line = f.readline()
-        f.seek(init_pos)
-        if found:
-            if key == 'end':
-                # print('cache store')
-                self.pos_cache[init_pos] = key_pos
-            return key_pos
-        else:
-            return -1
-        
-    def run_if_block(self, f, condition: str) -> bool:
-        pos_end = self.get_keyword_pos(f, 'end')
-
-        if self.run_line(condition, output = False):
-            # 1st case
-            # if True
-            #   statements
-            # (
-            # else/elseif xxx
-            #   statements
-            # )
-            # end
-            if not self.run_sequential(f):
-                return False
+                self.eng.eval(counts + code, nargout=0, stdout=stream, stderr=err_stream)
+                failed = False
+            except MatlabTerminated:
+                print(stream.getvalue(), err_stream.getvalue(), sep="\n")
+                self.restart_engine()
+                return len(nodes), None
+            except : # The other exceptions are handled by Matlab
+                failed = True
 
-            # go to the start of next block
-            f.seek(pos_end)
-            f.readline()
-        else:
-            pos_else = self.get_keyword_pos(f, 'else', pos_end)
-            if pos_else == -1:
-                # 2th case
-                # if False
-                #   statements
-                # end
-                f.seek(pos_end)
-                f.readline()
-            else:
-                f.seek(pos_else)
-                line = f.readline()
-                if line.startswith('elseif'):
-                    # 3nd case
-                    # if False
-                    #   statements
-                    # elseif xxx
-                    #   statements
-                    # (
-                    # else/elseif xxx
-                    #   statements
-                    # )
-                    # end
-
-                    # elseif statement can be regarded as if statement 
-                    if not self.run_if_block(f, line.lstrip('elseif').strip()):
-                        return False
+            output = stream.getvalue()
+            stop = None
+            if self.debug_mode:
+                for line_no, count in hits_marker.findall(output):
+                    self.breakpoint_hits[int(line_no)] = int(count)
+                match = stop_marker.search(output)
+                if match:
+                    stop = (int(match.group(1)), [[loop_range_var.format(line_no), int(i), int(count)]
+                                                  for line_no, i, count in loop_state_marker.findall(output)])
+                output = stop_marker.sub('', loop_state_marker.sub('', hits_marker.sub('', output)))
+            if profiler is not None:
+                line_times = {int(line_no): (int(count), float(time))
+                              for line_no, count, time in profile_marker.findall(output)}
+                output = profile_marker.sub('', output)
+            # [output before the first marker, line, output, line, output, ...]
+            parts = batch_marker.split(output)
+            n_done = (len(parts) - 1) // 2
+            if failed and n_done == 0:
+                # Nothing was executed, e.g. a syntax error in the batch
+                return n_handled, None
+
+            outputs = parts[2::2]
+            if profiler is not None:
+                # Everything written but the output of the nodes
+                marker_bytes = len(stream.getvalue()) - sum(len(part) for part in parts[0::2])
+                profiler.split_batch(nodes[n_handled:n_handled + n_done], outputs, line_times, marker_bytes)
+                if failed:
+                    # The accumulator of the timings is left behind
+                    self.run_internal('clear pymatlab_prof pymatlab_t')
+            for output in outputs[:n_done - 1] if failed else outputs:
+                if output:
+                    print(output)
+            if not failed:
+                self.after_statements(len(nodes))
+                return len(nodes), stop
+            if self.debug_mode and nodes[-1].guarded:
+                # Only the last node can be guarded (see Compiler.compile)
+                self.run_internal('clear ' + ' '.join(guard_vars(nodes)))
+
+            # The statement following the last marker raised the error
+            node = nodes[n_handled + n_done - 1]
+            print(outputs[-1], err_stream.getvalue(), sep="\n")
+            print('Error occurred around line {}:\n    {}'.format(node.line_no, node.text))
+            n_handled = n_handled + n_done
+            code = batch_code(nodes[n_handled:], self.debug_mode)
+            if profiler is not None:
+                code = profiled_batch_code(nodes[n_handled:], self.debug_mode)
+        return n_handled, None
+
+    def get_program(self, body):
+        # Bodies are lowered once per debug mode. The body is kept with its
+        # program so its id cannot be reused while cached
+        key = (id(body), self.debug_mode)
+        cached = self.program_cache.get(key)
+        if cached is None:
+            cached = (body, compile_body(body, self.debug_mode))
+            self.program_cache[key] = cached
+        return cached[1]
+
+    def run_sequential(self, body) -> bool:
+        return self.run_program(self.get_program(body))
+
+    def run_program(self, program) -> bool:
+        # Returns False when the script is aborted. The ranges of the loops
+        # left by an abort are cleared from the workspace
+        loops = [] # [range variable, iteration, count] of the running for loops
+        try:
+            return self.dispatch(program, loops)
+        finally:
+            if loops:
+                self.run_internal('clear ' + ' '.join(loop[0] for loop in loops))
+
+    def dispatch(self, program, loops: list) -> bool:
+        # Dispatch loop over the flat instruction list of script_compiler
+        pc = 0
+        n = len(program)
+        cond = False
+        profiler = self.profiler
+        while pc < n:
+            op, node, arg, target = program[pc]
+            pc = pc + 1
+            if profiler is not None:
+                profiler.enter(node, op)
+
+            if op == EVAL:
+                self.run_line(arg)
+
+            elif op == BATCH:
+                if self.batch_statements and not (self.debug_mode and self.debug_pause):
+                    nodes = arg[0]
+                    n_handled, stop = self.run_batch(nodes, arg[1], arg[3])
+                    if stop is not None:
+                        # A breakpoint held in a guarded loop, which was left:
+                        # its stepped version resumes after the statement
+                        line_no, stopped_loops = stop
+                        node, pc = arg[2][line_no]
+                        loops.extend(stopped_loops)
+                        if profiler is not None:
+                            profiler.enter(node, EVAL)
+                        self.debug_pause = True
+                        if not self.stop_at(node):
+                            return False
+                        self.run_line(node.code)
+                    elif n_handled == len(nodes):
+                        pc = target
+                    elif n_handled > 0:
+                        # Step through the remaining nodes after a fallback
+                        if not self.run_program(compile_body(nodes[n_handled:], self.debug_mode, False)):
+                            return False
+                        pc = target
+                # Otherwise the stepped version follows
+
+            elif op == EVAL_COND:
+                cond = self.run_line(arg, output = False)
+
+            elif op == JUMP_IF_FALSE:
+                if not cond:
+                    pc = target
+
+            elif op == JUMP:
+                pc = target
+
+            elif op == FOR_NEXT:
+                loop = loops[-1]
+                if loop[1] == loop[2]:
+                    loops.pop()
+                    self.run_internal('clear ' + loop[0])
+                    pc = target
                 else:
-                    # 4rd case
-                    # if False
-                    #   statements
-                    # else
-                    #   statements
-                    # end
-                    # The file pointer already points to the start of next
-                    # block after the call of run_sequential
-                    if not self.run_sequential(f):
+                    loop[1] = loop[1] + 1
+                    if not self.run_internal(loop_next_cmd.format(node.var, loop[0], loop[1])):
+                        # e.g. the range was deleted by a clear in the body
+                        print('Error occurred around line {}:\n    {}'.format(node.line_no, node.text))
+                        print('The range of the loop is kept in {}, which clear, clearvars '
+                              'and clear all in the loop also delete'.format(loop[0]))
                         return False
-        return True
-    
-    def run_while_block(self, f, condition: str):
-        pos_begin = f.tell()
-        pos_end = self.get_keyword_pos(f, 'end')
 
-        while self.run_line(condition, output = False):
-            if not self.run_sequential(f):
-                return False
-            f.seek(pos_begin)
-        # Go to the start of next block
-        f.seek(pos_end)
-        f.readline()
-        return True
+            elif op == FOR_INIT:
+                # The range never leaves MATLAB, only its number of columns
+                range_var = loop_range_var.format(node.line_no)
+                count = False
+                if self.run_internal(loop_init_cmd.format(range_var, node.range_expr)):
+                    count = self.run_internal(loop_count_expr.format(range_var), nargout = 1)
+                if count is False:
+                    print('Error occurred around line {}:\n    {}'.format(node.line_no, node.text))
+                    return False
+                loops.append([range_var, 0, int(count)])
 
-    # TODO: support for vector loop variable
-    def run_for_block(self, f, expr: str):
-        def get_loop_variable(expr: str):
-            [name, range_expr] = expr.split('=')
-            range = self.run_line(range_expr.strip(), output = False)
-            return {'name': name.strip(), 'range': range[0]}
-        
-        loop_var = get_loop_variable(expr)
-        pos_begin = f.tell()
-        pos_end = self.get_keyword_pos(f, 'end')
-        
-        for i in loop_var['range']:
-            self.eng.workspace[loop_var['name']] = i
-            if not self.run_sequential(f):
-                return False
-            f.seek(pos_begin)
-        # Go to the start of next block
-        f.seek(pos_end)
-        f.readline()
-        return True
+            elif op == SELECT:
+                index = self.run_selector(arg)
+                if index is None:
+                    print('Error occurred around line {}:\n    {}'.format(node.line_no, node.text))
+                    return False
+                pc = target[index]
 
-    def run_switch_block(self, f, swtich_expr) -> bool:
-        def expr_match(swtich_expr, case_expr) -> bool:
-            return self.run_line('{}=={}'.format(swtich_expr, case_expr), output = False)
-        
-        pos_end = self.get_keyword_pos(f, 'end')
-        pos_otherwise = self.get_keyword_pos(f, 'otherwise', pos_end)
-        done = False
-
-        pos_case = self.get_keyword_pos(f, 'case', pos_end)
-        if pos_case == -1:
-            print('Syntax error: No case in switch block')
-            return False
-        while pos_case != -1:
-            f.seek(pos_case)
-            line = f.readline()
-            case_expr = line.lstrip().lstrip('case').strip()
-            if expr_match(swtich_expr, case_expr):
-                if not self.run_sequential(f):
+            elif op == BREAKPOINT:
+                if not self.check_breakpoint(node):
                     return False
-                done = True
-                break
-            pos_case = self.get_keyword_pos(f, 'case', pos_end)
 
-        if not done and pos_otherwise != -1:
-            f.seek(pos_otherwise)
-            line = f.readline()
-            if not self.run_sequential(f):
-                return False
-        # Go to the start of next block
-        f.seek(pos_end)
-        f.readline()
+            elif op == EVAL_OR_STOP:
+                # Passes where the condition does not hold cost the eval of the
+                # statement only. When stepping, the script stops anyway
+                self.count_hit(node)
+                if self.debug_pause or self.run_line_or_stop(arg, node):
+                    self.debug_pause = True
+                    if not self.stop_at(node):
+                        return False
+                    self.run_line(node.code)
+
+            elif op == INPUT:
+                if not self.process_input(arg):
+                    print('Error occurred around line {}:\n    {}'.format(node.line_no, node.text))
+                    return False
+
+            elif op == PAUSE:
+                if arg:
+                    self.run_line(arg)
+                if profiler is not None:
+                    profiler.suspend()
+                self.read_input()
+                if profiler is not None:
+                    profiler.resume()
         return True
-    
+
+    def load_script(self, script_path, report = True):
+        # Parse the entire script once into a block tree. Syntax errors are
+        # reported here, before anything is executed. Trees are kept until the
+        # file is modified, so scripts pre-parsed during startup are reused,
+        # and persisted across sessions by the parse cache. report: print
+        # the errors
+        try:
+            path = os.path.abspath(script_path)
+            mtime = os.path.getmtime(path)
+            cached = self.script_cache.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            if self.parse_cache is not None:
+                script = self.parse_cache.load(path)
+            else:
+                script = parse_script(path)
+            self.script_cache[path] = (mtime, script)
+            return script
+        except FileNotFoundError:
+            if report:
+                print("File is not found!")
+        except ScriptSyntaxError as e:
+            if report:
+                print(e)
+                print('Error occurred around line {}:\n    {}'.format(e.line_no, e.line))
+        return None
+
     def run_interactive_script(self, script_path):
-        if not import_fail:
-            # Scan the entire script to create a cache which store the pairs of 
-            # postions for all block initiators and their corresponding ends
-            # 
-            # The cache action is done in get_keyword_pos
-            self.pos_cache = {}
-            self.func_cache = {}
-            script_root = self.run_line('pwd', output = False)
+        if self.eng is not None:
+            self.program_cache = {}
+            self.workspace_tracker.reset()
+            self.breakpoint_hits = {}
+            try:
+                script_root = self.query('pwd', ('cwd',))
+            except MatlabTerminated:
+                self.restart_engine()
+                return
+            except Exception as e:
+                print(e)
+                return
             os.chdir(script_root)
             print("File: \"{}\"".format(script_path))
-            # Exexcute line by line
-            try:
-                with openIndexedFile(script_path) as s:
-                    # We strip each line before match it with the keyword, 
-                    # so we can be sure to reach the end of the file by searching space 
-                    if self.get_keyword_pos(s, ' ') != -2:
-                        self.run_sequential(s)
-            except FileNotFoundError:
-                print("File is not found!")
-            # Clear the cache
-            self.pos_cache.clear()
-            self.func_cache.clear()
+            # Exexcute the block tree node by node
+            script = self.load_script(script_path)
+            if script is not None:
+                self.run_sequential(script.body)
+            self.program_cache.clear()
+
+    def run_profiled_script(self, args):
+        # Runs the script interactively with every instruction and engine call
+        # recorded, then prints the hotspots and saves the requested exports
+        profiler = ScriptProfiler(trace = args.profile_trace is not None)
+        self.profiler = profiler
+        self.eng = ProfiledEngine(self.eng, profiler)
+        try:
+            self.run_interactive_script(args.script)
+        finally:
+            profiler.finish()
+            self.profiler = None
+            # The engine may have been replaced by a restart
+            if isinstance(self.eng, ProfiledEngine):
+                self.eng = self.eng.engine
+        print(profiler.report())
+        for path, export in ((args.profile_json, profiler.export_json),
+                             (args.profile_trace, profiler.export_trace)):
+            if path:
+                try:
+                    export(path)
+                    print('Profile saved to {}'.format(path))
+                except OSError as e:
+                    print(e)
 
 #######################################################################################
 
@@ -499,36 +961,205 @@ class MatlabInterface:
     #             os.remove(temp_path)
     #             os.rmdir(os.path.dirname(temp_path))
 
+    def run_command(self, command: str):
+        # Runs a command needing the engine
+        cmd_tokens = command.split()
+        if is_batch_command(cmd_tokens):
+            args = parse_command(batch_parser, cmd_tokens[1:])
+            if args is not None:
+                self.run_batch_command(args)
+        elif cmd_tokens == ['checkpoint']:
+            self.take_checkpoint(verbose = True)
+        elif cmd_tokens == ['restore']:
+            self.restore_checkpoint()
+        elif cmd_tokens[0].endswith('.m'):
+            # script runner mode
+            args = parse_command(sr_parser, cmd_tokens)
+            if args is None:
+                return
+            self.debug_mode = args.debug
+            self.debug_pause = False
+            self.batch_statements = not args.no_batch
+            if args.profile or args.profile_json or args.profile_trace:
+                self.run_profiled_script(args)
+            elif self.debug_mode or args.interactive:
+                self.run_interactive_script(args.script)
+            else:
+                self.run_script(args.script)
+                self.after_statements()
+        elif self.streaming:
+            # command window mode
+            self.run_streamed(lambda stream, err_stream: self.eng.eval(
+                command, nargout=0, stdout=stream, stderr=err_stream, background=True))
+            self.after_statements()
+        else:
+            self.run_line(command)
+        if self.symbols is not None:
+            self.symbols.after_command(command)
+        self.record_first_command('first_result')
+
+    def submit_command(self, command: str):
+        self.record_first_command('first_command')
+        cmd_tokens = command.split()
+        if cmd_tokens[0].endswith('.m') and not self.engine_ready.is_set():
+            args = parse_command(sr_parser, cmd_tokens)
+            if args is not None and (args.debug or args.interactive or args.profile or args.profile_json or args.profile_trace):
+                # Interactive scripts need the terminal, so they cannot be
+                # queued. Parse the script while the engine is starting. This
+                # is best effort: the script is found relative to the folder
+                # of Python, which may not be the one MATLAB starts in, and
+                # the errors are reported when it runs
+                self.load_script(args.script, report = False)
+                if not self.wait_ready():
+                    return
+
+        with self.engine_lock:
+            if not self.engine_ready.is_set():
+                self.pending.append(command)
+                print('MATLAB is starting, the command is queued ({} pending)'.format(len(self.pending)))
+                return
+        if not self.startup_failed:
+            with self.engine_lock:
+                self.run_command(command)
+
+    def handle_command(self, command: str) -> bool:
+        # Returns False when the terminal has to be left
+        cmd_tokens = command.split()
+
+        if cmd_tokens[0] == 'exit' or cmd_tokens[0] == 'exit()': # Keywords to leave the engine
+            return False
+
+        elif cmd_tokens[0] == 'clc' or cmd_tokens[0] == 'clc()': # matlab terminal clearing must be reimplemented
+            self.clear()
+
+        elif cmd_tokens[0] == 'startup_metrics':
+            self.print_startup_metrics()
+
+        elif cmd_tokens[0] == 'query_stats':
+            print(self.query_cache.stats())
+
+        else:
+            self.submit_command(command)
+        return True
+
+    def enable_completion(self):
+        # Tab completion from a symbol index, built in the background as soon
+        # as the engine is ready
+        index = SymbolIndex(self.symbol_query)
+        if not install_completer(index):
+            return
+        self.symbols = index
+
+        def build():
+            self.engine_ready.wait()
+            if not self.startup_failed:
+                index.refresh()
+        threading.Thread(target=build, daemon=True).start()
+
+    def symbol_query(self, expr: str):
+        # Not recorded: the index is refreshed from other threads at any time
+        with self.engine_lock:
+            return untraced(self.eng).eval(expr, nargout=1)
+
     def interactive_loop(self):
         loop = True # Looping allows for an interactive terminal
+        self.enable_completion()
 
-        while loop and not import_fail:
-            print('>>> ', end='')
-            command = input().strip()
-            cmd_tokens = command.split()
+        while loop and not self.startup_failed:
+            # The prompt is given to input for the line editing of readline
+            command = self.read_input('>>> ').strip()
 
             # Input is empty
-            if not cmd_tokens:
+            if not command:
                 continue
-            
-            if cmd_tokens[0] == 'exit' or cmd_tokens[0] == 'exit()': # Keywords to leave the engine
-                loop=False
+            loop = self.handle_command(command)
 
-            elif cmd_tokens[0] == 'clc' or cmd_tokens[0] == 'clc()': # matlab terminal clearing must be reimplemented
-                self.clear()
-                
+    def submit_job(self, command: str):
+        # The job starts in the current folder of the terminal
+        folder = None
+        if self.engine_ready.is_set() and not self.startup_failed:
+            with self.engine_lock:
+                try:
+                    folder = self.query('pwd', ('cwd',))
+                except Exception:
+                    pass
+        job = self.jobs.submit(command, folder)
+        print('[{}] {}'.format(job.id, command))
+
+    def select_jobs(self, ids: list) -> list:
+        if not ids:
+            return list(self.jobs.jobs.values())
+        selected = []
+        for job_id in ids:
+            job = self.jobs.get(int(job_id)) if job_id.isdigit() else None
+            if job is None:
+                print('No job {}'.format(job_id))
             else:
-                if cmd_tokens[0].endswith('.m'):
-                    # script runner mode
-                    args = sr_parser.parse_args(cmd_tokens)
-                    self.debug_mode = args.debug
-                    self.debug_pause = False
-                    if self.debug_mode:
-                        self.run_interactive_script(args.script)
-                    elif args.interactive:
-                        self.run_interactive_script(args.script)
-                    else:
-                        self.run_script(args.script)
-                else:
-                    # command window mode
-                    output = self.run_line(command)
+                selected.append(job)
+        return selected
+
+    def print_jobs(self):
+        if not self.jobs.jobs:
+            print('No job')
+        for job in self.jobs.jobs.values():
+            print(job.summary())
+
+    async def wait_jobs(self, ids: list):
+        # Waits for the jobs (all of them by default) and prints their output
+        for job in self.select_jobs(ids):
+            # Reported here rather than by report_jobs
+            job.reported = True
+            while not job.done():
+                await asyncio.sleep(0.05)
+            print(job.summary())
+            for text in (job.output.getvalue(), job.errors.getvalue()):
+                if text:
+                    print(text, end='' if text.endswith('\n') else '\n')
+
+    def cancel_jobs(self, ids: list):
+        for job in self.select_jobs(ids):
+            if self.jobs.cancel(job.id):
+                print('[{}] cancelling {}'.format(job.id, job.command))
+
+    async def report_jobs(self, poll: float = 0.2):
+        # Announces the finished jobs, also while a foreground command runs
+        while True:
+            await asyncio.sleep(poll)
+            for job in self.jobs.newly_finished():
+                print('\n{}'.format(job.summary()))
+                if self.at_prompt:
+                    print('>>> ', end='', flush=True)
+
+    def async_interactive_loop(self):
+        asyncio.run(self.async_repl())
+
+    async def async_repl(self):
+        # Non-blocking terminal: the prompt and the foreground commands run in
+        # worker threads, so jobs submitted with a trailing '&' are managed and
+        # reported while they run
+        loop = asyncio.get_running_loop()
+        reporter = asyncio.ensure_future(self.report_jobs())
+        self.enable_completion()
+        try:
+            while not self.startup_failed:
+                self.at_prompt = True
+                command = (await loop.run_in_executor(None, self.read_input, '>>> ')).strip()
+                self.at_prompt = False
+                cmd_tokens = command.split()
+                if not cmd_tokens:
+                    continue
+
+                if command.endswith('&'):
+                    if command[:-1].strip():
+                        self.submit_job(command[:-1].strip())
+                elif cmd_tokens[0] == 'jobs':
+                    self.print_jobs()
+                elif cmd_tokens[0] == 'wait':
+                    await self.wait_jobs(cmd_tokens[1:])
+                elif cmd_tokens[0] == 'cancel':
+                    self.cancel_jobs(cmd_tokens[1:])
+                elif not await loop.run_in_executor(None, self.handle_command, command):
+                    break
+        finally:
+            reporter.cancel()
+            self.jobs.close()
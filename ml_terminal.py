@@ -1,6 +1,56 @@
 # Developed by Aurelien Pommel and other contributors
 
+import argparse
 from matlab_interface import MatlabInterface
+from engine_pool import EnginePool
+from parse_cache import ParseCache
+from checkpoint import WorkspaceCheckpointer
+from engine_trace import TraceRecorder
+from engine_server import RemoteEngine, remote_engine_factory, load_authkey, print_queued
 
-matlab = MatlabInterface()
-matlab.interactive_loop()
\ No newline at end of file
+parser = argparse.ArgumentParser(description='MATLAB interactive terminal')
+parser.add_argument('--standby', type=int, default=0,
+                    help='number of standby engines kept warm to recover from a crash')
+parser.add_argument('--startup', action='append', default=[], metavar='COMMAND',
+                    help='MATLAB command replayed on a standby engine when it is promoted, e.g. "cd dir"')
+parser.add_argument('--stream', action='store_true',
+                    help='print the output of commands and scripts as it is produced')
+parser.add_argument('--no-parse-cache', action='store_true',
+                    help='do not keep parsed interactive scripts on disk between sessions')
+parser.add_argument('--async', dest='async_repl', action='store_true',
+                    help='non-blocking terminal, where commands ending with & run as background jobs')
+parser.add_argument('--connect', metavar='ADDRESS',
+                    help='use an engine of the engine server at ADDRESS (HOST:PORT or socket path) '
+                         'instead of starting MATLAB')
+parser.add_argument('--authkey-file', default=None,
+                    help='key file shared with the engine server (default: the one it creates)')
+parser.add_argument('--checkpoint-every', type=int, default=None, metavar='N',
+                    help='checkpoint the workspace after every N statements, to restore it after a crash')
+parser.add_argument('--checkpoint-interval', type=float, default=None, metavar='SECONDS',
+                    help='checkpoint the workspace when SECONDS have passed since the last checkpoint')
+parser.add_argument('--checkpoint-dir', default=None,
+                    help='folder of the workspace checkpoints (default: ~/.cache/pymatlab/checkpoint)')
+parser.add_argument('--record', metavar='FILE',
+                    help='record the engine calls and typed lines of the session to FILE, '
+                         'for replay with engine_trace.py')
+args = parser.parse_args()
+
+pool = EnginePool(size=args.standby, startup_hook=args.startup) if args.standby > 0 else None
+parse_cache = None if args.no_parse_cache else ParseCache()
+checkpointer = WorkspaceCheckpointer(args.checkpoint_dir, args.checkpoint_every, args.checkpoint_interval)
+recorder = TraceRecorder(args.record) if args.record else None
+if args.connect:
+    # Thin client: a crashed engine is replaced by a new session
+    authkey = load_authkey(args.authkey_file)
+    engine = RemoteEngine(args.connect, authkey, on_queued=print_queued)
+    print('Connected to the engine server at {} (session {})'.format(args.connect, engine.session))
+    matlab = MatlabInterface(engine, remote_engine_factory(args.connect, authkey),
+                             streaming=args.stream, parse_cache=parse_cache, checkpointer=checkpointer,
+                             recorder=recorder)
+else:
+    matlab = MatlabInterface(engine_pool=pool, streaming=args.stream, parse_cache=parse_cache,
+                             checkpointer=checkpointer, recorder=recorder)
+if args.async_repl:
+    matlab.async_interactive_loop()
+else:
+    matlab.interactive_loop()
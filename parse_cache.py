@@ -0,0 +1,113 @@
+# Persistent cache of parsed scripts
+#
+# The block tree of every script run in interactive or debug mode is pickled
+# to a cache directory. An entry is reused as is while the mtime and size of
+# the script are unchanged, and after a content hash check otherwise. The
+# least recently used entries are evicted when the directory grows too big.
+
+import os
+import locale
+import pickle
+import hashlib
+from helper import cache_path
+from script_parser import parse_lines
+
+# To be increased whenever the block tree changes, so old entries are ignored
+cache_version = 4
+
+def default_cache_dir() -> str:
+    return cache_path('parse')
+
+class ParseCache:
+    def __init__(self, directory: str = None, max_bytes: int = 64 * 2 ** 20):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, path: str) -> str:
+        key = hashlib.sha1('{}:{}'.format(cache_version, path).encode()).hexdigest()
+        return os.path.join(self.directory, key + '.pickle')
+
+    def read_entry(self, entry_path: str):
+        try:
+            with open(entry_path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+
+    def write_entry(self, entry_path: str, entry: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+
+    def load(self, path: str):
+        # Returns the parsed script, from the cache when possible. Raises
+        # FileNotFoundError and script_parser.ScriptSyntaxError like parse_script
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry_path = self.entry_path(path)
+        entry = self.read_entry(entry_path)
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            self.hits = self.hits + 1
+            self.touch(entry_path)
+            return entry['script']
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()
+        if entry is not None and entry['hash'] == digest:
+            # Touched but unchanged
+            self.hits = self.hits + 1
+            script = entry['script']
+        else:
+            self.misses = self.misses + 1
+            # Decoded and split like helper.MappedIndexedFile does in
+            # script_parser.parse_script: on '\n' only, so line numbers match
+            lines = content.decode(locale.getpreferredencoding(False)).replace('\r\n', '\n').split('\n')
+            if not lines[-1]:
+                lines.pop()
+            script = parse_lines(lines, path)
+        try:
+            self.write_entry(entry_path, {'mtime': stat.st_mtime, 'size': stat.st_size,
+                                          'hash': digest, 'script': script})
+        except (OSError, pickle.PicklingError, RecursionError):
+            # The cache is only an optimization
+            pass
+        return script
+
+    def touch(self, entry_path: str):
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+    def evict(self):
+        # Least recently used entries first, until the total size fits
+        try:
+            entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                       if name.endswith('.pickle')]
+            stats = sorted(((os.stat(entry), entry) for entry in entries),
+                           key=lambda item: item[0].st_mtime)
+        except OSError:
+            return
+        total = sum(stat.st_size for stat, _ in stats)
+        for stat, entry in stats:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+                total = total - stat.st_size
+            except OSError:
+                pass
+
+    def clear(self):
+        try:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pickle'):
+                    os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
@@ -0,0 +1,256 @@
+# Per-line profiler of the interactive and debug mode
+#
+# The interpreter notifies the profiler before every instruction it runs, and
+# the engine is wrapped in a ProfiledEngine timing every call. The time of a
+# line is split between the engine (inside calls) and Python (the rest of the
+# time until the next instruction). A batch is charged to its first line, then
+# its engine time is split between the lines of its statements, timed by
+# MATLAB itself (see profiled_batch_code), and its output between its nodes.
+# What is left (the conditions and headers of blocks, the overhead of the
+# call) stays with the first line. Nothing is recorded when no profiler is
+# attached, the interpreter then only tests for None once per instruction.
+
+import json
+from collections import namedtuple
+from time import perf_counter
+from script_compiler import *
+from script_parser import child_bodies
+
+LineStats = namedtuple('LineStats', 'line_no text count engine python output')
+
+# Kind of the engine calls made by each instruction
+op_kinds = {EVAL: 'eval', BATCH: 'batch', EVAL_COND: 'condition', SELECT: 'condition',
+            FOR_INIT: 'for', FOR_NEXT: 'for', INPUT: 'input', PAUSE: 'eval',
+            BREAKPOINT: 'debugger', EVAL_OR_STOP: 'eval', JUMP_IF_FALSE: 'jump', JUMP: 'jump'}
+
+# Instructions counted as one execution of their line
+counted_ops = (EVAL, EVAL_OR_STOP, BATCH, EVAL_COND, FOR_NEXT, SELECT, INPUT, PAUSE)
+
+class ScriptProfiler:
+    def __init__(self, trace: bool = False):
+        # trace: keep every line and engine call as an event, for export_trace
+        self.trace = trace
+        self.events = []
+        # line_no -> [text, count, engine time, python time, output bytes]
+        self.lines = {}
+        # kind -> [calls, time]
+        self.calls = {}
+        self.start = perf_counter()
+        self.end = None
+        self.node = None
+        self.kind = 'query'
+        self.segment_start = self.start
+        self.segment_engine = 0.0
+
+    def enter(self, node, op: int):
+        # Called before each instruction: the time since the previous one is
+        # charged to the previous line
+        now = perf_counter()
+        self.close_segment(now)
+        self.node = node
+        self.kind = op_kinds.get(op, 'eval')
+        if op in counted_ops:
+            stats = self.line_stats(node)
+            stats[1] = stats[1] + 1
+
+    def leave(self):
+        # Called when the program is done, e.g. before the debugger prompt
+        self.close_segment(perf_counter())
+        self.node = None
+        self.kind = 'query'
+
+    def suspend(self):
+        # Called before waiting for the user (input, pause), whose time is
+        # not charged to the line. Calls still are, until the next instruction
+        self.close_segment(perf_counter())
+
+    def resume(self):
+        self.segment_start = perf_counter()
+        self.segment_engine = 0.0
+
+    def close_segment(self, now: float):
+        if self.node is not None and now > self.segment_start:
+            stats = self.line_stats(self.node)
+            stats[3] = stats[3] + max(0.0, now - self.segment_start - self.segment_engine)
+            if self.trace:
+                self.events.append({'name': 'line {}'.format(self.node.line_no), 'cat': 'line',
+                                    'ph': 'X', 'pid': 1, 'tid': 1,
+                                    'ts': (self.segment_start - self.start) * 1e6,
+                                    'dur': (now - self.segment_start) * 1e6,
+                                    'args': {'text': self.node.text}})
+        self.segment_start = now
+        self.segment_engine = 0.0
+
+    def line_stats(self, node) -> list:
+        stats = self.lines.get(node.line_no)
+        if stats is None:
+            stats = self.lines[node.line_no] = [node.text, 0, 0.0, 0.0, 0]
+        return stats
+
+    def record_call(self, kind: str, start: float, duration: float, output: int = 0):
+        # kind is None for eval, which is then named after the instruction
+        kind = kind or self.kind
+        calls = self.calls.setdefault(kind, [0, 0.0])
+        calls[0] = calls[0] + 1
+        calls[1] = calls[1] + duration
+        if self.node is not None:
+            stats = self.line_stats(self.node)
+            stats[2] = stats[2] + duration
+            stats[4] = stats[4] + output
+            self.segment_engine = self.segment_engine + duration
+        if self.trace:
+            self.events.append({'name': kind, 'cat': 'engine', 'ph': 'X', 'pid': 1, 'tid': 2,
+                                'ts': (start - self.start) * 1e6, 'dur': duration * 1e6,
+                                'args': {'line': self.node.line_no if self.node is not None else None}})
+
+    def split_batch(self, nodes, outputs: list, line_times: dict, marker_bytes: int = 0):
+        # Moves the time and output of a batch from the line charged with the
+        # call to the lines of its nodes and statements. outputs is the output
+        # of every node run, line_times the (count, engine time) of every line
+        # timed by MATLAB, marker_bytes the size of the markers, which are not
+        # output of the script
+        charged = self.line_stats(self.node)
+        charged[4] = max(0, charged[4] - marker_bytes)
+        for node, output in zip(nodes, outputs):
+            stats = self.line_stats(node)
+            if node is not self.node and node.line_no not in line_times:
+                # The charged node is counted by enter, timed lines below
+                stats[1] = stats[1] + 1
+            if stats is not charged:
+                moved = min(len(output), charged[4])
+                charged[4] = charged[4] - moved
+                stats[4] = stats[4] + moved
+        if not line_times:
+            return
+        # The timed statements, down the blocks of the batch
+        statements = {}
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if node.kind == 'statement':
+                statements[node.line_no] = node
+            for body in child_bodies(node):
+                stack.extend(body)
+        for line_no, (count, time) in line_times.items():
+            if line_no not in statements:
+                continue
+            stats = self.line_stats(statements[line_no])
+            if stats is charged and self.node.kind == 'statement':
+                count = count - 1
+            stats[1] = stats[1] + count
+            if stats is not charged:
+                moved = min(time, charged[2])
+                charged[2] = charged[2] - moved
+                stats[2] = stats[2] + moved
+
+    def finish(self):
+        self.leave()
+        self.end = perf_counter()
+
+    def line_table(self) -> list:
+        # Hottest lines first
+        rows = [LineStats(line_no, *stats) for line_no, stats in self.lines.items()]
+        return sorted(rows, key=lambda row: row.engine + row.python, reverse=True)
+
+    def report(self, limit: int = 20) -> str:
+        total = (self.end or perf_counter()) - self.start
+        rows = self.line_table()
+        engine = sum(row.engine for row in rows)
+        python = sum(row.python for row in rows)
+        lines = ['Profile: {:.3f} s in total, {:.3f} s in MATLAB, {:.3f} s in Python'.format(
+                     total, engine, python),
+                 '{:>6} {:>8} {:>11} {:>11} {:>9} {:>10}  {}'.format(
+                     'line', 'count', 'engine ms', 'python ms', 'python %', 'output B', 'source')]
+        for row in rows[:limit]:
+            time = row.engine + row.python
+            lines.append('{:>6} {:>8} {:>11.3f} {:>11.3f} {:>9.1f} {:>10}  {}'.format(
+                row.line_no, row.count, row.engine * 1e3, row.python * 1e3,
+                100 * row.python / time if time else 0, row.output, row.text))
+        if len(rows) > limit:
+            lines.append('... {} more line(s)'.format(len(rows) - limit))
+        lines.append('')
+        lines.append('{:<12} {:>8} {:>11} {:>10}'.format('engine call', 'calls', 'total ms', 'mean us'))
+        for kind, (count, time) in sorted(self.calls.items(), key=lambda item: item[1][1], reverse=True):
+            lines.append('{:<12} {:>8} {:>11.3f} {:>10.1f}'.format(kind, count, time * 1e3, time / count * 1e6))
+        return '\n'.join(lines)
+
+    def to_dict(self) -> dict:
+        return {'total': (self.end or perf_counter()) - self.start,
+                'lines': [row._asdict() for row in self.line_table()],
+                'calls': {kind: {'count': count, 'time': time} for kind, (count, time) in self.calls.items()}}
+
+    def export_json(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def export_trace(self, path: str):
+        # Chrome trace event format, viewable in chrome://tracing or Perfetto
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+class CountingStream:
+    # Forwards the output of an engine call, counting its size
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def write(self, text: str) -> int:
+        self.size = self.size + len(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+class ProfiledEngine:
+    # Wraps an engine, reporting the time and output of every call to a
+    # ScriptProfiler. Background calls are only counted, not timed
+    class Workspace:
+        def __init__(self, owner):
+            self.owner = owner
+
+        def __getitem__(self, name):
+            start = perf_counter()
+            try:
+                return self.owner.engine.workspace[name]
+            finally:
+                self.owner.profiler.record_call('workspace get', start, perf_counter() - start)
+
+        def __setitem__(self, name, value):
+            start = perf_counter()
+            try:
+                self.owner.engine.workspace[name] = value
+            finally:
+                self.owner.profiler.record_call('workspace set', start, perf_counter() - start)
+
+        def __contains__(self, name):
+            return name in self.owner.engine.workspace
+
+    def __init__(self, engine, profiler: ScriptProfiler):
+        self.engine = engine
+        self.profiler = profiler
+        self.workspace = self.Workspace(self)
+
+    def eval(self, code: str, nargout: int = 1, stdout = None, stderr = None, **kwargs):
+        if kwargs.get('background'):
+            self.profiler.record_call(None, perf_counter(), 0.0)
+            return self.engine.eval(code, nargout=nargout, stdout=stdout, stderr=stderr, **kwargs)
+        counter = CountingStream(stdout) if stdout is not None else None
+        start = perf_counter()
+        try:
+            return self.engine.eval(code, nargout=nargout, stdout=counter or stdout, stderr=stderr, **kwargs)
+        finally:
+            self.profiler.record_call(None, start, perf_counter() - start, counter.size if counter else 0)
+
+    def run(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return self.engine.run(*args, **kwargs)
+        finally:
+            self.profiler.record_call('run', start, perf_counter() - start)
+
+    def quit(self):
+        return self.engine.quit()
+
+    def __getattr__(self, name: str):
+        return getattr(self.engine, name)
@@ -0,0 +1,68 @@
+# Memoization of the side-effect-free queries the interpreter sends to MATLAB
+#
+# Every entry depends on scopes of the engine state:
+#   'engine'     the MATLAB process itself (e.g. the release)
+#   'cwd'        the current folder (pwd)
+#   'workspace'  the base workspace (whos, fingerprints)
+# Entries are dropped when a scope they depend on is invalidated. Any eval
+# which is not a declared query may cd or assign, so it invalidates 'cwd' and
+# 'workspace', and a new engine invalidates everything. The TTL covers the
+# changes made behind the interpreter's back, e.g. from the MATLAB desktop.
+
+from collections import OrderedDict
+from time import monotonic
+
+# Scopes which any statement may modify
+mutable_scopes = ('cwd', 'workspace')
+
+# Returned by QueryCache.get on a miss, as None is a valid result
+not_cached = object()
+
+class QueryCache:
+    def __init__(self, max_entries: int = 64, ttl: float = 30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # expr -> (value, scopes, expiry time), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, expr: str):
+        entry = self.entries.get(expr)
+        if entry is not None and entry[2] < monotonic():
+            del self.entries[expr]
+            entry = None
+        if entry is None:
+            self.misses = self.misses + 1
+            return not_cached
+        self.hits = self.hits + 1
+        self.entries.move_to_end(expr)
+        return entry[0]
+
+    def put(self, expr: str, value, scopes: tuple):
+        if self.max_entries <= 0:
+            return
+        self.entries[expr] = (value, tuple(scopes), monotonic() + self.ttl)
+        self.entries.move_to_end(expr)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, scopes: tuple = None):
+        # Drops the entries depending on any of scopes, or all of them
+        if not self.entries:
+            return
+        if scopes is None:
+            stale = list(self.entries)
+        else:
+            stale = [expr for expr, entry in self.entries.items()
+                     if any(scope in entry[1] for scope in scopes)]
+        for expr in stale:
+            del self.entries[expr]
+        self.invalidations = self.invalidations + len(stale)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        return '{} hit(s), {} miss(es) ({:.0f}% hit rate), {} invalidated, {} cached'.format(
+            self.hits, self.misses, 100 * self.hits / total if total else 0,
+            self.invalidations, len(self.entries))
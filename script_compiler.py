@@ -0,0 +1,460 @@
+# Lowering of the block tree into a flat instruction list
+#
+# Control flow is resolved once into jumps with precomputed targets, so the
+# interpreter runs a script in a single dispatch loop instead of recursing
+# through the blocks. The lowering itself uses an explicit stack, so neither
+# side has a limit on the nesting depth.
+#
+# An instruction is a tuple (op, node, arg, target):
+#   EVAL          run arg, a statement or a try, parfor or spmd block
+#   BATCH         when batching is allowed, run the native nodes of arg, a
+#                 (nodes, code, resume points, hit-count statements) tuple,
+#                 with a single eval and jump to target. Otherwise fall
+#                 through to the stepped version of the same nodes, which
+#                 follows it and is never batched. When a breakpoint held in
+#                 a guarded loop (see guarded_source), resume the stepped
+#                 version at its statement instead
+#   EVAL_COND     evaluate the condition arg
+#   JUMP_IF_FALSE jump to target if the last condition was false
+#   JUMP          jump to target
+#   FOR_INIT      store the range of the for node in a MATLAB variable
+#   FOR_NEXT      assign the next column of the range to the loop variable, or
+#                 leave the loop by jumping to target
+#   SELECT        run arg, an if/elseif chain or a switch whose branches write
+#                 their index, and jump to target[index], target[0] when no
+#                 branch matched. MATLAB tests the conditions or cases itself,
+#                 with a single eval and its own semantics
+#   BREAKPOINT    debug stop point before node (debug programs only)
+#   EVAL_OR_STOP  run arg, the statement of node guarded by the condition of
+#                 its breakpoint: when it holds, the statement is not run and
+#                 the interpreter stops before it (debug programs only)
+#   INPUT         emulate the input command of node
+#   PAUSE         run arg, then wait for the user
+
+import re
+from script_parser import node_source, native_only, branches, child_bodies
+
+EVAL = 0
+BATCH = 1
+EVAL_COND = 2
+JUMP_IF_FALSE = 3
+JUMP = 4
+FOR_INIT = 5
+FOR_NEXT = 6
+SELECT = 7
+BREAKPOINT = 8
+INPUT = 9
+PAUSE = 10
+EVAL_OR_STOP = 11
+
+op_names = ['EVAL', 'BATCH', 'EVAL_COND', 'JUMP_IF_FALSE', 'JUMP', 'FOR_INIT', 'FOR_NEXT',
+            'SELECT', 'BREAKPOINT', 'INPUT', 'PAUSE', 'EVAL_OR_STOP']
+
+# Every statement or block of a batch is preceded by a marker written to stdout,
+# so the output and errors can be attributed to their line
+batch_marker_cmd = "fprintf('%c%d\\n', 30, {});"
+batch_marker = re.compile('\x1e(\\d+)\n')
+
+# When profiling, every statement of a batch, including those inside its
+# blocks, is timed engine-side: a count and a time per line are accumulated in
+# pymatlab_prof and written after the output once the batch is done, one
+# marker per line. toc of a zero tic value reads the timer of MATLAB from its
+# origin, without touching the tic of the user. Statements clearing the
+# workspace (or calling a script which does) delete the accumulator, whose
+# lines are then not timed
+profile_init_cmd = 'pymatlab_prof = zeros(2, {});'
+profile_start_cmd = 'pymatlab_t = toc(uint64(0));'
+profile_stop_cmd = ("if exist('pymatlab_prof', 'var')\n"
+                    "pymatlab_prof(:, {0}) = pymatlab_prof(:, {0}) + [1; toc(uint64(0)) - pymatlab_t];\nend")
+profile_report_cmd = ("if exist('pymatlab_prof', 'var')\n"
+                      "fprintf('%c%d %d %.9f\\n', [28 * ones(1, {0}); {1}; pymatlab_prof(:, {1})]);\nend\n"
+                      "clear pymatlab_prof pymatlab_t")
+profile_marker = re.compile('\x1c(\\d+) (\\d+) (\\S+)\n')
+
+# Written by the branch taken by a SELECT selector
+select_marker_cmd = "fprintf('%c%d\\n', 29, {});"
+select_marker = re.compile('\x1d(\\d+)\n')
+
+# Written instead of running a statement whose breakpoint condition holds, so
+# the condition costs no call of its own. The batch marker in the other branch
+# tells an error of the statement from an error of the condition
+stop_marker_cmd = "fprintf('%c%d\\n', 31, {})"
+stop_marker = re.compile('\x1f(\\d+)\n')
+guarded_cmd = 'if {}\n' + stop_marker_cmd + ';\nelse\n' + batch_marker_cmd + '\n{}\nend'
+
+# The range of a stepped for loop stays in MATLAB, in a variable named after
+# the line of the loop. The loop variable is assigned engine-side column by
+# column like MATLAB does, so matrix and cell ranges work and no data goes
+# through Python. The pymatlab_ prefix is reserved: clearing the range in
+# the body (clear, clearvars, clear all) aborts the script
+loop_range_var = 'pymatlab_range{}'
+loop_init_cmd = '{} = {};'
+# A(:,:) folds the trailing dimensions of N-D ranges into the columns
+loop_count_expr = 'size({}(:,:), 2)'
+loop_next_cmd = '{} = {}(:,{});'
+
+# In debug programs, the loops holding conditional or hit-count breakpoints
+# (guarded nodes) are batched too: their statements test the breakpoint
+# engine-side, hit counts in pymatlab_hits<line>. When one holds, the stop
+# marker is written after the state of every enclosing for loop, and the
+# loops are left through pymatlab_stop. The interpreter then resumes their
+# stepped version at the statement, with the same iterations: guarded for
+# loops store their range like stepped ones and count their iterations in
+# pymatlab_i<line>. The hit counts are written back once the batch is done
+stop_flag_init_cmd = 'pymatlab_stop = false;'
+guard_cmd = 'if {}\n{}' + stop_marker_cmd + ';\npymatlab_stop = true;\nbreak\nend'
+loop_index_var = 'pymatlab_i{}'
+loop_state_cmd = "fprintf('%c%d %d %d\\n', 31, {0}, pymatlab_i{0}, size(pymatlab_range{0}(:,:), 2));"
+loop_state_marker = re.compile('\x1f(\\d+) (\\d+) (\\d+)\n')
+hits_var = 'pymatlab_hits{}'
+hits_init_cmd = hits_var + ' = {};'
+hits_report_cmd = "fprintf('%c%d %d\\n', 31, {0}, pymatlab_hits{0});"
+hits_marker = re.compile('\x1f(\\d+) (\\d+)\n')
+
+def is_conditional(node) -> bool:
+    return node.kind == 'statement' and node.breakpoint not in (True, False) \
+        and node.breakpoint.condition is not None
+
+def if_selector(branches) -> str:
+    # if/elseif chain writing the index of the first true condition
+    lines = []
+    for i, branch in enumerate(branches, 1):
+        lines.append('{} {}'.format('if' if i == 1 else 'elseif', branch.expr))
+        lines.append(select_marker_cmd.format(i))
+    lines.append('end')
+    return '\n'.join(lines)
+
+def switch_selector(expr: str, cases) -> str:
+    # switch writing the index of the matching case
+    lines = ['switch ' + expr]
+    for i, case in enumerate(cases, 1):
+        lines.append('case ' + case.expr)
+        lines.append(select_marker_cmd.format(i))
+    lines.append('end')
+    return '\n'.join(lines)
+
+def guarded_nodes(nodes):
+    # The guarded nodes of nodes and of their guarded blocks, without recursion
+    stack = [iter(nodes)]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+        elif node.guarded:
+            yield node
+            stack.extend(iter(body) for body in child_bodies(node))
+
+def hit_guards(nodes) -> list:
+    # Statements of nodes whose hit-count breakpoint is tested engine-side
+    return [node for node in guarded_nodes(nodes)
+            if node.kind == 'statement' and node.breakpoint.hits is not None]
+
+def guard_vars(nodes, ranges: bool = True) -> list:
+    # Variables of the guarded nodes, e.g. left behind by a failed batch
+    names = ['pymatlab_stop']
+    for node in guarded_nodes(nodes):
+        if node.kind == 'for':
+            if ranges:
+                names.append(loop_range_var.format(node.line_no))
+            names.append(loop_index_var.format(node.line_no))
+        elif node.kind == 'statement' and node.breakpoint.hits is not None:
+            names.append(hits_var.format(node.line_no))
+    return names
+
+def guarded_source(node, statement_code = None) -> str:
+    # node_source of a node whose guarded statements stop the batch when
+    # their breakpoint holds (see guard_cmd). Items are kept on a stack with
+    # the lines of their enclosing guarded for loops, and whether they are in
+    # a guarded loop: its end then leaves the enclosing loop too on a stop
+    lines = []
+    stack = [(node, (), False)]
+    while stack:
+        item, loops, nested = stack.pop()
+        if isinstance(item, str):
+            lines.append(item)
+            continue
+        if not item.guarded:
+            lines.append(node_source(item, statement_code))
+            continue
+        kind = item.kind
+        if kind == 'statement':
+            breakpoint = item.breakpoint
+            condition = breakpoint.condition
+            if breakpoint.hits is not None:
+                hits = hits_var.format(item.line_no)
+                lines.append('{0} = {0} + 1;'.format(hits))
+                condition = '{} == {}'.format(hits, breakpoint.hits)
+            lines.append(guard_cmd.format(condition, ''.join(
+                loop_state_cmd.format(line_no) + '\n' for line_no in loops), item.line_no))
+            lines.append(statement_code(item) if statement_code is not None else item.code)
+            continue
+        if kind in ('if', 'switch'):
+            inner = (loops, nested)
+            parts = [item.text] if kind == 'switch' else []
+            for branch in branches(item):
+                parts.append(branch.text)
+                parts.extend(branch.body)
+            parts.append('end')
+        elif kind == 'while':
+            inner = (loops, True)
+            parts = [item.text] + item.body + ['end']
+            if nested:
+                parts.append('if pymatlab_stop\nbreak\nend')
+        else:
+            inner = (loops + (item.line_no,), True)
+            range_var = loop_range_var.format(item.line_no)
+            index_var = loop_index_var.format(item.line_no)
+            cleanup = 'clear {} {}'.format(range_var, index_var)
+            parts = [loop_init_cmd.format(range_var, item.range_expr), index_var + ' = 0;',
+                     'for {} = {}'.format(item.var, range_var), '{0} = {0} + 1;'.format(index_var)]
+            parts += item.body + ['end']
+            # The range is kept for the stepped version on a stop
+            if nested:
+                parts.append('if pymatlab_stop\nbreak\nend\n' + cleanup)
+            else:
+                parts.append('if ~pymatlab_stop\n' + cleanup + '\nend')
+        stack.extend(reversed([(part, None, None) if isinstance(part, str) else (part,) + inner
+                               for part in parts]))
+    return '\n'.join(lines)
+
+def batch_code(nodes, debug: bool = False, statement_code = None) -> str:
+    # debug: the breakpoints of the guarded nodes are tested. The counts of
+    # their hit-count breakpoints are then expected to be set first
+    # (hits_init_cmd). statement_code: see node_source
+    guarded = debug and any(node.guarded for node in nodes)
+    source = guarded_source if guarded else node_source
+    code = '\n'.join(batch_marker_cmd.format(node.line_no) + '\n' + source(node, statement_code)
+                     for node in nodes)
+    if not guarded:
+        return code
+    hits = hit_guards(nodes)
+    return '\n'.join([stop_flag_init_cmd, code] + [hits_report_cmd.format(node.line_no) for node in hits]
+                     + ['clear ' + ' '.join(guard_vars(nodes, False))])
+
+def profiled_batch_code(nodes, debug: bool = False) -> str:
+    # batch_code with its statements timed (see profile_init_cmd)
+    line_nos = []
+    def timed(node):
+        line_nos.append(node.line_no)
+        return '\n'.join((profile_start_cmd, node.code, profile_stop_cmd.format(node.line_no)))
+    code = batch_code(nodes, debug, timed)
+    if not line_nos:
+        return code
+    line_nos = sorted(set(line_nos))
+    return '\n'.join((profile_init_cmd.format(line_nos[-1]), code, profile_report_cmd.format(
+        len(line_nos), '[{}]'.format(' '.join(str(line_no) for line_no in line_nos)))))
+
+class Compiler:
+    def __init__(self, debug: bool, batch: bool = True):
+        self.debug = debug
+        self.batch = batch
+        self.code = []
+        # Line of each guarded statement -> (statement, index of the next
+        # instruction after its stepped version), where a BATCH resumes
+        self.resume = {}
+        # Frames of [body, next index, called when the body is done, batching allowed]
+        self.stack = []
+
+    def emit(self, op: int, node = None, arg = None, target = None) -> list:
+        instr = [op, node, arg, target]
+        self.code.append(instr)
+        return instr
+
+    def here(self) -> int:
+        return len(self.code)
+
+    def push(self, body: list, on_done = None, batch: bool = True):
+        self.stack.append([body, 0, on_done, batch])
+
+    def stop_point(self, node):
+        # Conditional statements stop from their own eval
+        if self.debug and not is_conditional(node):
+            self.emit(BREAKPOINT, node)
+
+    def compile(self, body: list) -> list:
+        self.push(body, None, self.batch)
+        while self.stack:
+            frame = self.stack[-1]
+            body, i, on_done, batch = frame
+            if i >= len(body):
+                self.stack.pop()
+                if on_done is not None:
+                    on_done()
+                continue
+
+            node = body[i]
+            if batch and node.native:
+                end = i
+                while end < len(body) and body[end].native:
+                    end = end + 1
+                    if self.debug and body[end - 1].guarded:
+                        # Nothing may run after a stop inside the loop
+                        break
+                run = body[i:end]
+                if len(run) > 1 or run[0].kind != 'statement':
+                    frame[1] = end
+                    instr = self.emit(BATCH, run[0], (run, batch_code(run, self.debug), self.resume,
+                                                      hit_guards(run) if self.debug else []))
+                    # Nothing of the stepped version is batched again
+                    self.push(run, lambda instr=instr: instr.__setitem__(3, self.here()), False)
+                    continue
+
+            frame[1] = i + 1
+            self.lower(node, batch)
+        return [tuple(instr) for instr in self.code]
+
+    def lower(self, node, batch: bool):
+        kind = node.kind
+        if kind == 'function':
+            # Function definitions are skipped
+            return
+        self.stop_point(node)
+
+        if kind == 'statement':
+            if self.debug and is_conditional(node):
+                self.emit(EVAL_OR_STOP, node, guarded_cmd.format(
+                    node.breakpoint.condition, node.line_no, node.line_no, node.code))
+            else:
+                self.emit(EVAL, node, node.code)
+            if node.guarded:
+                self.resume[node.line_no] = (node, self.here())
+        elif kind == 'input':
+            self.emit(INPUT, node, node.code)
+        elif kind == 'pause':
+            self.emit(PAUSE, node, node.code)
+        elif kind == 'if':
+            self.lower_if(node, batch)
+        elif kind == 'while':
+            self.lower_while(node, batch)
+        elif kind == 'for':
+            self.lower_for(node, batch)
+        elif kind == 'switch':
+            self.lower_switch(node, batch)
+        elif kind in native_only:
+            self.emit(EVAL, node, node_source(node))
+
+    def lower_while(self, node, batch: bool):
+        head = self.here()
+        self.emit(EVAL_COND, node, node.condition)
+        exit_jump = self.emit(JUMP_IF_FALSE, node)
+
+        def done():
+            self.emit(JUMP, node, None, head)
+            exit_jump[3] = self.here()
+        self.push(node.body, done, batch)
+
+    def lower_for(self, node, batch: bool):
+        init = self.emit(FOR_INIT, node)
+        head = self.here()
+        next_instr = self.emit(FOR_NEXT, node)
+
+        def done():
+            self.emit(JUMP, node, None, head)
+            init[3] = next_instr[3] = self.here()
+        self.push(node.body, done, batch)
+
+    def lower_select(self, node, code: str, bodies: list, default, batch: bool):
+        # SELECT followed by the bodies, each ending with a jump to the end.
+        # default is the body run when no branch matched (else, otherwise)
+        targets = [None] * (len(bodies) + 1)
+        self.emit(SELECT, node, code, targets)
+        end_jumps = []
+
+        def next_body(i):
+            if i > 1:
+                end_jumps.append(self.emit(JUMP, node))
+            if i <= len(bodies):
+                targets[i] = self.here()
+                self.push(bodies[i - 1], lambda: next_body(i + 1), batch)
+            else:
+                targets[0] = self.here()
+                if default is not None:
+                    self.push(default, close, batch)
+                else:
+                    close()
+
+        def close():
+            for jump in end_jumps:
+                jump[3] = self.here()
+        next_body(1)
+
+    def lower_if(self, node, batch: bool):
+        if not (self.debug and any(branch.breakpoint for branch in node.branches[1:])):
+            default = node.else_branch.body if node.else_branch is not None else None
+            self.lower_select(node, if_selector(node.branches),
+                              [branch.body for branch in node.branches], default, batch)
+            return
+        # The debugger may stop between the conditions, which are then tested
+        # one by one:
+        #     EVAL_COND c1; JUMP_IF_FALSE L1; body1; JUMP end
+        # L1: EVAL_COND c2; JUMP_IF_FALSE L2; body2; JUMP end
+        # L2: body3
+        # end:
+        end_jumps = []
+        branches = list(node.branches)
+
+        def next_branch(skip_jump = None):
+            if skip_jump is not None:
+                end_jumps.append(self.emit(JUMP, node))
+                skip_jump[3] = self.here()
+            if branches:
+                branch = branches.pop(0)
+                if branch.kind == 'elseif':
+                    self.stop_point(branch)
+                self.emit(EVAL_COND, branch, branch.expr)
+                jump = self.emit(JUMP_IF_FALSE, branch)
+                self.push(branch.body, lambda: next_branch(jump), batch)
+            elif node.else_branch is not None:
+                self.push(node.else_branch.body, close, batch)
+            else:
+                close()
+
+        def close():
+            for jump in end_jumps:
+                jump[3] = self.here()
+        next_branch()
+
+    def lower_switch(self, node, batch: bool):
+        if not (self.debug and any(case.breakpoint for case in node.cases)):
+            default = node.otherwise.body if node.otherwise is not None else None
+            self.lower_select(node, switch_selector(node.expr, node.cases),
+                              [case.body for case in node.cases], default, batch)
+            return
+        # The debugger may stop between the cases, which are then tested one
+        # by one, each with a single-case selector
+        end_jumps = []
+        cases = list(node.cases)
+
+        def next_case(skip_targets = None):
+            if skip_targets is not None:
+                end_jumps.append(self.emit(JUMP, node))
+                skip_targets[0] = self.here()
+            if cases:
+                case = cases.pop(0)
+                self.stop_point(case)
+                targets = [None, None]
+                self.emit(SELECT, node, switch_selector(node.expr, [case]), targets)
+                targets[1] = self.here()
+                self.push(case.body, lambda: next_case(targets), batch)
+            elif node.otherwise is not None:
+                self.push(node.otherwise.body, close, batch)
+            else:
+                close()
+
+        def close():
+            for jump in end_jumps:
+                jump[3] = self.here()
+        next_case()
+
+def compile_body(body: list, debug: bool = False, batch: bool = True) -> list:
+    return Compiler(debug, batch).compile(body)
+
+def disassemble(program: list) -> str:
+    lines = []
+    for pc, (op, node, arg, target) in enumerate(program):
+        if op == BATCH:
+            arg = '{} node(s)'.format(len(arg[0]))
+        lines.append('{:>5} {:<14} {:>5} {:<30} {}'.format(
+            pc, op_names[op], node.line_no if node is not None else '',
+            repr(arg) if arg is not None else '', '-> {}'.format(target) if target is not None else ''))
+    return '\n'.join(lines)
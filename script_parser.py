@@ -0,0 +1,374 @@
+# One-pass parser turning a MATLAB script into an in-memory block tree
+#
+# The interpreter used to steer through the script file with seek/readline and
+# rescan it for every else/case/otherwise lookup. The whole file is now parsed
+# once, and script_compiler lowers the resulting tree for the interpreter.
+
+import re
+from collections import namedtuple
+from helper import openIndexedFile
+
+initiators = ['if', 'while', 'for', 'switch', 'function', 'try', 'parfor', 'spmd']
+terminators = ['else', 'elseif', 'end', 'case', 'otherwise', 'catch']
+# Blocks which are always sent to MATLAB as a whole: error handling and
+# parallel execution cannot be stepped through from Python
+native_only = ('try', 'parfor', 'spmd')
+
+# Keywords are only recognized at the beginning of a line
+keyword_matcher = re.compile(r'({})\b'.format('|'.join(initiators + terminators)))
+pause_matcher = re.compile(r'\bpause\b(\s*\([^)]*\))?')
+input_matcher = re.compile(r'\binput\s*\(')
+# Breakpoint markers: 'dbg', 'dbg if <condition>' and 'dbg hits=<N>'
+breakpoint_matcher = re.compile(r'\bdbg\s+(?:if\s+(?P<condition>.+?)|hits\s*=\s*(?P<hits>\d+))$')
+
+# Conditional or hit-count breakpoint. The breakpoint attribute of nodes holds
+# one of these, True for a plain 'dbg' or False
+Breakpoint = namedtuple('Breakpoint', 'condition hits')
+
+class ScriptSyntaxError(Exception):
+    def __init__(self, msg: str, line_no: int, line: str):
+        super().__init__(msg)
+        self.line_no = line_no
+        self.line = line
+
+class Node:
+    # native is set when the node can be sent to MATLAB as a whole, i.e. when
+    # neither the node nor any nested node is an input, a pause or a breakpoint.
+    # guarded is set when conditional and hit-count breakpoints of statements
+    # are all that keep the node from being native: a loop holding them is
+    # native anyway, as the debugger tests them engine-side (see
+    # script_compiler)
+    __slots__ = ('kind', 'line_no', 'text', 'breakpoint', 'native', 'guarded')
+
+    def __init__(self, kind: str, line_no: int, text: str, breakpoint: bool = False):
+        self.kind = kind
+        self.line_no = line_no
+        self.text = text
+        self.breakpoint = breakpoint
+        self.native = False
+        self.guarded = False
+
+    def __repr__(self) -> str:
+        return '{}(line {}: {!r})'.format(type(self).__name__, self.line_no, self.text)
+
+class Statement(Node):
+    # kind is one of 'statement', 'input' or 'pause'
+    # For pause statements, code holds the line without the pause command
+    __slots__ = ('code',)
+
+    def __init__(self, line_no: int, text: str, breakpoint: bool = False):
+        if input_matcher.search(text):
+            kind = 'input'
+            code = text
+        elif pause_matcher.search(text):
+            kind = 'pause'
+            code = pause_matcher.sub('', text).strip()
+            if code.strip(',;') == '':
+                code = ''
+        else:
+            kind = 'statement'
+            code = text
+        super().__init__(kind, line_no, text, breakpoint)
+        self.code = code
+        self.native = kind == 'statement' and not breakpoint
+        self.guarded = kind == 'statement' and breakpoint not in (True, False)
+
+class Branch(Node):
+    # A guarded body: if/elseif conditions, switch cases, else and otherwise
+    __slots__ = ('expr', 'body')
+
+    def __init__(self, kind: str, line_no: int, text: str, expr: str, breakpoint: bool = False):
+        super().__init__(kind, line_no, text, breakpoint)
+        self.expr = expr
+        self.body = []
+
+class Block(Node):
+    __slots__ = ('end_line',)
+
+    def __init__(self, kind: str, line_no: int, text: str, breakpoint: bool = False):
+        super().__init__(kind, line_no, text, breakpoint)
+        self.end_line = -1
+
+class IfBlock(Block):
+    __slots__ = ('branches', 'else_branch')
+
+    def __init__(self, line_no: int, text: str, condition: str, breakpoint: bool = False):
+        super().__init__('if', line_no, text, breakpoint)
+        self.branches = [Branch('if', line_no, text, condition, breakpoint)]
+        self.else_branch = None
+
+class WhileBlock(Block):
+    __slots__ = ('condition', 'body')
+
+    def __init__(self, line_no: int, text: str, condition: str, breakpoint: bool = False):
+        super().__init__('while', line_no, text, breakpoint)
+        self.condition = condition
+        self.body = []
+
+class ForBlock(Block):
+    __slots__ = ('var', 'range_expr', 'body')
+
+    def __init__(self, line_no: int, text: str, expr: str, breakpoint: bool = False):
+        super().__init__('for', line_no, text, breakpoint)
+        try:
+            [name, range_expr] = expr.split('=', 1)
+        except ValueError:
+            raise ScriptSyntaxError('Syntax error: invalid loop variable', line_no, text)
+        self.var = name.strip().lstrip('(').strip()
+        self.range_expr = range_expr.strip()
+        if self.range_expr.endswith(')') and expr.lstrip().startswith('('):
+            self.range_expr = self.range_expr[:-1].strip()
+        self.body = []
+
+class SwitchBlock(Block):
+    __slots__ = ('expr', 'cases', 'otherwise')
+
+    def __init__(self, line_no: int, text: str, expr: str, breakpoint: bool = False):
+        super().__init__('switch', line_no, text, breakpoint)
+        self.expr = expr
+        self.cases = []
+        self.otherwise = None
+
+class NativeBlock(Block):
+    # try/catch, parfor or spmd. Breakpoints inside are ignored, and input and
+    # pause are not allowed, as the block never runs stepped
+    __slots__ = ('body', 'catch_branch')
+
+    def __init__(self, kind: str, line_no: int, text: str, breakpoint: bool = False):
+        super().__init__(kind, line_no, text, breakpoint)
+        self.body = []
+        self.catch_branch = None
+
+class FunctionBlock(Block):
+    __slots__ = ('signature', 'name', 'body')
+
+    def __init__(self, line_no: int, text: str, signature: str, breakpoint: bool = False):
+        super().__init__('function', line_no, text, breakpoint)
+        self.signature = signature
+        head = signature.split('=', 1)[-1]
+        self.name = head.split('(', 1)[0].strip()
+        self.body = []
+
+class Script:
+    def __init__(self, path: str, body: list, functions: dict, n_lines: int):
+        self.path = path
+        self.body = body
+        self.functions = functions
+        self.n_lines = n_lines
+
+    def walk(self):
+        # Depth-first iteration over all nodes, without recursion
+        stack = [iter(self.body)]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                continue
+            yield node
+            for body in reversed(child_bodies(node)):
+                stack.append(iter(body))
+
+def child_bodies(node: Node) -> list:
+    kind = node.kind
+    if kind == 'if':
+        bodies = [branch.body for branch in node.branches]
+        if node.else_branch is not None:
+            bodies.append(node.else_branch.body)
+        return bodies
+    elif kind == 'switch':
+        bodies = [case.body for case in node.cases]
+        if node.otherwise is not None:
+            bodies.append(node.otherwise.body)
+        return bodies
+    elif kind == 'try':
+        bodies = [node.body]
+        if node.catch_branch is not None:
+            bodies.append(node.catch_branch.body)
+        return bodies
+    elif kind in ('while', 'for', 'function', 'parfor', 'spmd'):
+        return [node.body]
+    return []
+
+def branches(node: Node) -> list:
+    if node.kind == 'if':
+        return node.branches + ([node.else_branch] if node.else_branch is not None else [])
+    elif node.kind == 'switch':
+        return node.cases + ([node.otherwise] if node.otherwise is not None else [])
+    elif node.kind == 'try':
+        return [node.catch_branch] if node.catch_branch is not None else []
+    return []
+
+def is_native(node: Node) -> bool:
+    # Children are complete when their block is closed, so their flag is final
+    if node.breakpoint or node.kind == 'function':
+        return False
+    if any(branch.breakpoint for branch in branches(node)):
+        return False
+    return all(child.native for body in child_bodies(node) for child in body)
+
+def is_guarded(node: Node) -> bool:
+    if node.breakpoint or node.kind not in ('if', 'switch', 'while', 'for'):
+        return False
+    if any(branch.breakpoint for branch in branches(node)):
+        return False
+    children = [child for body in child_bodies(node) for child in body]
+    return all(child.native or child.guarded for child in children) \
+        and any(child.guarded for child in children)
+
+def node_source(node: Node, statement_code = None) -> str:
+    # MATLAB source of a native node, reconstructed from the tree. Pending
+    # nodes and lines are kept on a stack, so deep nesting is not a problem.
+    # statement_code, if given, returns the code emitted for each statement
+    lines = []
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            lines.append(item)
+        elif item.kind == 'statement' and statement_code is not None:
+            lines.append(statement_code(item))
+        elif item.kind in ('statement', 'input', 'pause'):
+            lines.append(item.code)
+        else:
+            parts = []
+            if item.kind in ('if', 'switch'):
+                if item.kind == 'switch':
+                    parts.append(item.text)
+                for branch in branches(item):
+                    parts.append(branch.text)
+                    parts.extend(branch.body)
+            else:
+                parts.append(item.text)
+                parts.extend(item.body)
+                # catch of a try block
+                for branch in branches(item):
+                    parts.append(branch.text)
+                    parts.extend(branch.body)
+            parts.append('end')
+            stack.extend(reversed(parts))
+    return '\n'.join(lines)
+
+def split_breakpoint(line: str) -> tuple:
+    # Splits a stripped line into its code and breakpoint marker
+    match = breakpoint_matcher.search(line)
+    if match:
+        hits = match.group('hits')
+        return line[:match.start()].rstrip(), Breakpoint(match.group('condition'),
+                                                         int(hits) if hits else None)
+    if line.endswith('dbg'):
+        return line[:-3].rstrip(), True
+    return line, False
+
+def parse_lines(lines, path: str = '') -> Script:
+    root = []
+    functions = {}
+    # Stack of (open block, body receiving the next statements)
+    stack = []
+    body = root
+    line_no = 0
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        # empty line or comment
+        if line == '' or line[0] == '%':
+            continue
+
+        line, breakpoint = split_breakpoint(line)
+        if breakpoint and line == '':
+            continue
+        in_native = any(node.kind in native_only for node, _ in stack)
+        if in_native:
+            breakpoint = False
+
+        match = keyword_matcher.match(line)
+        keyword = match.group(1) if match else None
+        rest = line[match.end():].strip() if match else ''
+
+        if stack and stack[-1][0].kind == 'switch' and body is None \
+                and keyword not in ('case', 'otherwise', 'end'):
+            raise ScriptSyntaxError('Syntax error: statement outside of case in switch block',
+                                    line_no, line)
+
+        if keyword in initiators:
+            if keyword == 'if':
+                node = IfBlock(line_no, line, rest, breakpoint)
+                child_body = node.branches[0].body
+            elif keyword == 'while':
+                node = WhileBlock(line_no, line, rest, breakpoint)
+                child_body = node.body
+            elif keyword == 'for':
+                node = ForBlock(line_no, line, rest, breakpoint)
+                child_body = node.body
+            elif keyword == 'switch':
+                node = SwitchBlock(line_no, line, rest, breakpoint)
+                # Statements are only allowed after the first case
+                child_body = None
+            elif keyword in native_only:
+                node = NativeBlock(keyword, line_no, line, breakpoint)
+                child_body = node.body
+            else:
+                node = FunctionBlock(line_no, line, rest, breakpoint)
+                functions[node.name] = node
+                child_body = node.body
+            body.append(node)
+            stack.append((node, body))
+            body = child_body
+
+        elif keyword == 'end':
+            if not stack:
+                raise ScriptSyntaxError("Syntax error: unexpected 'end'", line_no, line)
+            node, body = stack.pop()
+            if node.kind == 'switch' and not node.cases:
+                raise ScriptSyntaxError('Syntax error: No case in switch block',
+                                        node.line_no, node.text)
+            node.end_line = line_no
+            node.guarded = is_guarded(node)
+            node.native = is_native(node) or node.guarded and node.kind in ('while', 'for')
+
+        elif keyword in ('elseif', 'else'):
+            if not stack or stack[-1][0].kind != 'if' or stack[-1][0].else_branch is not None:
+                raise ScriptSyntaxError("Syntax error: unexpected '{}'".format(keyword),
+                                        line_no, line)
+            node = stack[-1][0]
+            branch = Branch(keyword, line_no, line, rest, breakpoint)
+            if keyword == 'elseif':
+                node.branches.append(branch)
+            else:
+                node.else_branch = branch
+            body = branch.body
+
+        elif keyword in ('case', 'otherwise'):
+            if not stack or stack[-1][0].kind != 'switch' or stack[-1][0].otherwise is not None:
+                raise ScriptSyntaxError("Syntax error: unexpected '{}'".format(keyword),
+                                        line_no, line)
+            node = stack[-1][0]
+            branch = Branch(keyword, line_no, line, rest, breakpoint)
+            if keyword == 'case':
+                node.cases.append(branch)
+            else:
+                node.otherwise = branch
+            body = branch.body
+
+        elif keyword == 'catch':
+            if not stack or stack[-1][0].kind != 'try' or stack[-1][0].catch_branch is not None:
+                raise ScriptSyntaxError("Syntax error: unexpected 'catch'", line_no, line)
+            node = stack[-1][0]
+            node.catch_branch = Branch(keyword, line_no, line, rest)
+            body = node.catch_branch.body
+
+        else:
+            statement = Statement(line_no, line, breakpoint)
+            if in_native and statement.kind != 'statement':
+                raise ScriptSyntaxError('Syntax error: {} is not supported in a {} block'.format(
+                    statement.kind, next(node.kind for node, _ in stack if node.kind in native_only)),
+                    line_no, line)
+            body.append(statement)
+
+    if stack:
+        node = stack[-1][0]
+        raise ScriptSyntaxError('Syntax error: the end of {} block is missing!'.format(node.kind),
+                                node.line_no, node.text)
+    return Script(path, root, functions, line_no)
+
+def parse_script(path: str) -> Script:
+    with openIndexedFile(path) as f:
+        return parse_lines(f.readlines(), path)
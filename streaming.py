@@ -0,0 +1,189 @@
+# Streaming of engine output while a background call is running
+#
+# The engine API writes the stdout of a background call to the given stream
+# only within result(), once the call is done, so the output cannot be taken
+# from there while it runs. MATLAB writes it to its diary file as it goes
+# though: a temporary diary is turned on for the call and tailed to the
+# terminal until the call is done, then the diary of the user is restored.
+# The output delivered by result() is then dropped, as it was already shown.
+# When the diary of the user is on, it is left alone, and when the diary
+# stays empty, the output delivered by result() is written instead, so
+# nothing is lost either way.
+#
+# The stderr sink holds at most max_chunks chunks, so a chatty writer waits
+# instead of growing the memory. An engine may also deliver the output from
+# the thread which drains, e.g. within result(): it is then written through.
+
+import codecs
+import os
+import queue
+import sys
+import tempfile
+import threading
+from time import perf_counter
+from helper import matlab_quote
+
+# Whether the diary is on, and its file
+diary_state_expr = "{get(0, 'Diary'), get(0, 'DiaryFile')}"
+diary_on_cmd = 'diary({});'
+diary_off_cmd = "diary off\nset(0, 'DiaryFile', {});"
+
+class StreamSink:
+    def __init__(self, max_chunks: int = 256):
+        self.chunks = queue.Queue(max_chunks)
+        self.closed = False
+        # Thread draining the sink and where to, set by stream_call
+        self.reader = None
+        self.out = None
+        self.first_output = None
+        self.total_bytes = 0
+        self.queued_bytes = 0
+        self.peak_bytes = 0
+
+    def write(self, text: str) -> int:
+        if not text or self.closed:
+            return len(text)
+        if self.first_output is None:
+            self.first_output = perf_counter()
+        self.total_bytes = self.total_bytes + len(text)
+        if self.reader == threading.get_ident():
+            # Waiting for room would wait for ourselves
+            self.drain(self.out)
+            self.out.write(text)
+            self.out.flush()
+            return len(text)
+        while not self.closed:
+            try:
+                self.chunks.put(text, timeout=0.1)
+            except queue.Full:
+                continue
+            self.queued_bytes = self.queued_bytes + len(text)
+            self.peak_bytes = max(self.peak_bytes, self.queued_bytes)
+            break
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def drain(self, out, timeout: float = 0.0) -> int:
+        # Writes the queued chunks to out, waiting up to timeout for the first one
+        written = 0
+        try:
+            text = self.chunks.get(timeout=timeout) if timeout else self.chunks.get_nowait()
+            while True:
+                self.queued_bytes = self.queued_bytes - len(text)
+                out.write(text)
+                written = written + len(text)
+                text = self.chunks.get_nowait()
+        except queue.Empty:
+            pass
+        if written:
+            out.flush()
+        return written
+
+    def close(self):
+        # Later writes, e.g. from a cancelled call, are dropped
+        self.closed = True
+
+class DiaryTail:
+    # Reads what MATLAB appended to a diary file since the last read
+    def __init__(self, path: str, chunk_size: int = 1 << 16):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.position = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def read_into(self, sink: StreamSink, out) -> int:
+        # Writes the new text to out, one chunk at a time, and accounts for it
+        # in sink. Returns the number of bytes read
+        read = 0
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.position)
+                while True:
+                    data = f.read(self.chunk_size)
+                    if not data:
+                        break
+                    read = read + len(data)
+                    text = self.decoder.decode(data)
+                    if text:
+                        if sink.first_output is None:
+                            sink.first_output = perf_counter()
+                        sink.total_bytes = sink.total_bytes + len(text)
+                        sink.peak_bytes = max(sink.peak_bytes, len(text))
+                        out.write(text)
+        except OSError:
+            return 0
+        self.position = self.position + read
+        if read:
+            out.flush()
+        return read
+
+def start_diary(eng):
+    # Turns a temporary diary on, unless the diary of the user is on. Returns
+    # (DiaryTail, previous diary file), or None
+    try:
+        state, previous = eng.eval(diary_state_expr, nargout=1)
+        if state == 'on':
+            return None
+        fd, path = tempfile.mkstemp(prefix='pymatlab_', suffix='.txt')
+        os.close(fd)
+        eng.eval(diary_on_cmd.format(matlab_quote(path)), nargout=0)
+    except Exception:
+        return None
+    return DiaryTail(path), previous
+
+def stop_diary(eng, diary):
+    # Turns the temporary diary off, which flushes it, and restores the diary
+    # file of the user
+    try:
+        eng.eval(diary_off_cmd.format(matlab_quote(diary[1])), nargout=0)
+    except Exception:
+        pass
+
+def stream_call(eng, start_call, out = None, poll: float = 0.05):
+    # start_call receives (stdout, stderr) sinks and returns the future of a
+    # background call of eng. The output is written to out (sys.stdout by
+    # default) while the call runs. Returns (future, stdout sink, stderr sink)
+    # once the call has completed, and raises its error if any. Ctrl-C
+    # cancels the call and is re-raised
+    out = out or sys.stdout
+    sink = StreamSink()
+    err_sink = StreamSink()
+    for stream in (sink, err_sink):
+        stream.reader = threading.get_ident()
+        stream.out = out
+    diary = start_diary(eng)
+    diary_on = diary is not None
+    try:
+        future = start_call(sink, err_sink)
+        try:
+            diary_bytes = 0
+            while not future.done():
+                if diary is not None:
+                    diary_bytes = diary_bytes + diary[0].read_into(sink, out)
+                err_sink.drain(out, poll)
+            if diary_on:
+                stop_diary(eng, diary)
+                diary_on = False
+                diary_bytes = diary_bytes + diary[0].read_into(sink, out)
+                if diary_bytes:
+                    # Already shown from the diary
+                    sink.close()
+            err_sink.drain(out)
+            future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+    finally:
+        if diary_on:
+            stop_diary(eng, diary)
+        if diary is not None:
+            try:
+                os.remove(diary[0].path)
+            except OSError:
+                pass
+        err_sink.drain(out)
+        sink.close()
+        err_sink.close()
+    return future, sink, err_sink
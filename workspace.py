@@ -0,0 +1,219 @@
+# Bulk access to the base workspace of an engine
+#
+# The metadata of every variable (name, class, size, bytes) is fetched with a
+# single eval. Values are only fetched on demand, and numeric arrays are
+# converted to NumPy through the buffer protocol instead of element-wise.
+
+from collections import namedtuple, OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+VariableInfo = namedtuple('VariableInfo', 'name cls size bytes')
+
+# One line per variable: name, class, size and bytes separated by tabs
+whos_expr = ("strjoin(arrayfun(@(v) sprintf('%s\\t%s\\t%s\\t%d', v.name, v.class, "
+             "num2str(v.size), v.bytes), whos, 'UniformOutput', false)', char(10))")
+
+numeric_classes = ('double', 'single', 'int8', 'uint8', 'int16', 'uint16',
+                   'int32', 'uint32', 'int64', 'uint64', 'logical')
+
+# Same as whos_expr, with a fingerprint computed engine-side: the MD5 digest
+# of the serialized value (getByteStreamFromArray, hashed by the JVM), so any
+# change of the content is seen, whatever the class. Hashing reads the whole
+# variable, so only the variables up to max_bytes are hashed. The others, and
+# those which cannot be serialized or hashed (e.g. without the JVM), get '-'
+# (unfingerprinted): they can never be shown unchanged. The hash of every
+# variable is evaluated with a catch expression, so one failure does not
+# fail the whole listing
+fingerprint_template = (
+    "strjoin(arrayfun(@(v) sprintf('%s\\t%s\\t%s\\t%d\\t%s', v.name, v.class, num2str(v.size), v.bytes, "
+    "eval(feval(@(c) c{{1 + (v.bytes <= {max_bytes})}}, {{'''-''', "
+    "['feval(@(d) reshape(dec2hex(typecast(d.digest(getByteStreamFromArray(evalin(''base'', ''' "
+    "v.name '''))), ''uint8''))'', 1, []), java.security.MessageDigest.getInstance(''MD5''))']}}), "
+    "'''-''')), whos, 'UniformOutput', false)', char(10))")
+
+def fingerprint_expr(max_bytes: int = None) -> str:
+    # max_bytes: None hashes every variable
+    return fingerprint_template.format(max_bytes='Inf' if max_bytes is None else max_bytes)
+
+# Fingerprint of the variables whose values are not hashed
+unfingerprinted = '-'
+
+# Temporary variables of the interpreter (e.g. the ranges of stepped loops)
+# are left out of every view of the workspace
+internal_prefix = 'pymatlab_'
+
+def parse_whos(text: str) -> list:
+    variables = []
+    for line in text.split('\n'):
+        fields = line.split('\t')
+        if len(fields) != 4 or fields[0].startswith(internal_prefix):
+            continue
+        name, cls, size, n_bytes = fields
+        variables.append(VariableInfo(name, cls, tuple(int(n) for n in size.split()), int(n_bytes)))
+    return variables
+
+def parse_fingerprints(text: str) -> dict:
+    # name -> (VariableInfo, fingerprint)
+    fingerprints = {}
+    for line in text.split('\n'):
+        fields = line.split('\t')
+        if len(fields) != 5 or fields[0].startswith(internal_prefix):
+            continue
+        name, cls, size, n_bytes, fingerprint = fields
+        info = VariableInfo(name, cls, tuple(int(n) for n in size.split()), int(n_bytes))
+        fingerprints[name] = (info, fingerprint)
+    return fingerprints
+
+def to_numpy(value):
+    # Zero-copy view of a matlab numeric array when possible
+    if np is None:
+        return value
+    try:
+        # Recent engine versions implement the buffer protocol
+        memoryview(value)
+        return np.asarray(value)
+    except TypeError:
+        pass
+    data = getattr(value, '_data', None)
+    size = getattr(value, 'size', None)
+    if data is not None and isinstance(size, tuple):
+        # Older versions keep a flat column-major array.array
+        array = np.frombuffer(data, dtype=data.typecode)
+        return array.reshape(size, order='F')
+    return value
+
+def format_size(size: tuple) -> str:
+    return 'x'.join(str(n) for n in size)
+
+class WorkspaceSnapshot:
+    def __init__(self, eng, variables: list):
+        self.eng = eng
+        self.variables = {info.name: info for info in variables}
+        self.values = {}
+
+    @classmethod
+    def fetch(cls, eng):
+        return cls(eng, parse_whos(eng.eval(whos_expr, nargout=1)))
+
+    def __len__(self) -> int:
+        return len(self.variables)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.variables
+
+    def names(self) -> list:
+        return list(self.variables)
+
+    def value(self, name: str):
+        # Fetched once, on first access
+        if name not in self.values:
+            value = self.eng.workspace[name]
+            if self.variables[name].cls in numeric_classes:
+                value = to_numpy(value)
+            self.values[name] = value
+        return self.values[name]
+
+    def table(self) -> str:
+        lines = ['{:<24} {:<16} {:<12} {:>12}'.format('Name', 'Size', 'Class', 'Bytes')]
+        for info in self.variables.values():
+            lines.append('{:<24} {:<16} {:<12} {:>12}'.format(
+                info.name, format_size(info.size), info.cls, info.bytes))
+        return '\n'.join(lines)
+
+    def describe(self, name: str) -> str:
+        return describe(self.variables[name], self.value(name))
+
+def describe(info: VariableInfo, value, max_items: int = 100, max_chars: int = 2000) -> str:
+    # Large arrays are summarized instead of being printed in full
+    header = '{} ({} {})'.format(info.name, format_size(info.size), info.cls)
+    if np is not None and isinstance(value, np.ndarray):
+        if value.size > max_items and value.dtype.kind in 'biuf':
+            summary = 'min {}, max {}, mean {}'.format(value.min(), value.max(), value.mean())
+            body = '{}\n{}'.format(np.array2string(value, threshold=max_items, edgeitems=3), summary)
+        else:
+            body = np.array2string(value, threshold=max_items, edgeitems=3)
+    else:
+        body = str(value)
+    if len(body) > max_chars:
+        body = body[:max_chars] + ' ...'
+    return '{} =\n{}'.format(header, body)
+
+class ValueCache:
+    # LRU cache of fetched values, bounded by the size of the variables in
+    # MATLAB. Values larger than the bound are never kept
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.values = OrderedDict()
+
+    def get(self, name: str):
+        if name not in self.values:
+            return None
+        self.values.move_to_end(name)
+        return self.values[name][0]
+
+    def put(self, name: str, value, n_bytes: int):
+        self.discard(name)
+        if n_bytes > self.max_bytes:
+            return
+        self.values[name] = (value, n_bytes)
+        self.total_bytes = self.total_bytes + n_bytes
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted) = self.values.popitem(last=False)
+            self.total_bytes = self.total_bytes - evicted
+
+    def discard(self, name: str):
+        if name in self.values:
+            self.total_bytes = self.total_bytes - self.values.pop(name)[1]
+
+class WorkspaceTracker:
+    # Keeps the fingerprints of the workspace between two watches, so only
+    # the new and changed variables have to be fetched and displayed
+    def __init__(self, max_cache_bytes: int = 64 * 2 ** 20, hash_bytes: int = 32 * 2 ** 20):
+        # hash_bytes: larger variables are not hashed at every watch, they
+        # are reported as possibly changed instead
+        self.fingerprints = {}
+        self.values = ValueCache(max_cache_bytes)
+        self.expr = fingerprint_expr(hash_bytes)
+
+    def reset(self):
+        self.fingerprints = {}
+        self.values = ValueCache(self.values.max_bytes)
+
+    def update(self, eng, query = None):
+        # Returns the (new, changed, possibly changed, removed) variables since
+        # the last update. Possibly changed: same metadata, but not hashed.
+        # query, if given, evaluates the fingerprint expression instead of eng
+        text = query(self.expr, ('workspace',)) if query is not None else eng.eval(self.expr, nargout=1)
+        fingerprints = parse_fingerprints(text)
+        new = []
+        changed = []
+        possibly_changed = []
+        for name, (info, fingerprint) in fingerprints.items():
+            previous = self.fingerprints.get(name)
+            if previous is None:
+                new.append(info)
+            elif previous[0] != info or previous[1] != fingerprint:
+                changed.append(info)
+                self.values.discard(name)
+            elif fingerprint == unfingerprinted:
+                possibly_changed.append(info)
+                self.values.discard(name)
+        removed = [name for name in self.fingerprints if name not in fingerprints]
+        for name in removed:
+            self.values.discard(name)
+        self.fingerprints = fingerprints
+        return new, changed, possibly_changed, removed
+
+    def value(self, eng, info: VariableInfo):
+        value = self.values.get(info.name)
+        if value is None:
+            value = eng.workspace[info.name]
+            if info.cls in numeric_classes:
+                value = to_numpy(value)
+            self.values.put(info.name, value, info.bytes)
+        return value